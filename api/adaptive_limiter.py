@@ -0,0 +1,231 @@
+"""
+Адаптивное ограничение параллелизма (AIMD)
+Лимит растет на 1, пока p95 задержки и доля ошибок в норме, и уменьшается в разы при 429 / ResourceExhausted / таймаутах
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, List, Optional
+
+import httpx
+
+from quota_governor import PRIORITIES
+
+try:
+    from google.api_core import exceptions as google_exceptions
+except ImportError:  # google-api-core приходит вместе с google-generativeai
+    google_exceptions = None
+
+logger = logging.getLogger(__name__)
+
+
+def classify_error(exc: BaseException) -> Optional[str]:
+    """Сигнал перегрузки по исключению: throttled | timeout | error, None — ошибка не связана с нагрузкой"""
+    if isinstance(exc, (asyncio.TimeoutError, httpx.TimeoutException)):
+        return "timeout"
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        if status in (429, 503):
+            return "throttled"
+        return "error" if status >= 500 else None
+    if google_exceptions is not None:
+        if isinstance(exc, (google_exceptions.TooManyRequests, google_exceptions.ServiceUnavailable)):
+            return "throttled"
+        if isinstance(exc, google_exceptions.DeadlineExceeded):
+            return "timeout"
+        if isinstance(exc, google_exceptions.ServerError):
+            return "error"
+    return None
+
+
+class AdaptiveLimiter:
+    """Ограничитель одновременных операций с AIMD-подстройкой лимита.
+
+    Ожидающие обслуживаются по классам приоритета (quota_governor.PRIORITIES), внутри класса — FIFO.
+    batch не занимает последние int(limit * reserve) слотов: они остаются interactive-запросам,
+    даже когда очередь заполнена воркерами.
+
+    ENV (<PREFIX> — FETCH или LLM):
+      <PREFIX>_CONCURRENCY_INITIAL  — стартовый лимит (5)
+      <PREFIX>_CONCURRENCY_MIN      — нижняя граница (1)
+      <PREFIX>_CONCURRENCY_MAX      — верхняя граница (64 для FETCH, 32 для LLM)
+      <PREFIX>_LATENCY_TARGET       — допустимый p95 задержки, сек (10 для FETCH, 20 для LLM)
+      <PREFIX>_INTERACTIVE_RESERVE  — доля лимита, недоступная batch (0 для FETCH, 0.2 для LLM)
+      ADAPTIVE_WINDOW               — операций в окне оценки (20)
+      ADAPTIVE_MAX_ERROR_RATE       — допустимая доля ошибок в окне (0.1)
+    """
+
+    def __init__(self, name: str, initial: int = 5, min_limit: int = 1, max_limit: int = 64,
+                 latency_target: float = 10.0, window: Optional[int] = None,
+                 max_error_rate: Optional[float] = None, decrease_factor: float = 0.5,
+                 interactive_reserve: float = 0.0):
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = min(max(initial, self.min_limit), self.max_limit)
+        self.latency_target = latency_target
+        self.window = window or int(os.getenv("ADAPTIVE_WINDOW", "20"))
+        self.max_error_rate = max_error_rate if max_error_rate is not None else float(os.getenv("ADAPTIVE_MAX_ERROR_RATE", "0.1"))
+        self.decrease_factor = decrease_factor
+        self.interactive_reserve = min(max(interactive_reserve, 0.0), 1.0)
+        self.in_flight = 0
+        self.history: Deque[Dict[str, Any]] = deque(maxlen=100)
+        self._latencies: List[float] = []
+        self._errors = 0
+        self._peak_in_flight = 0
+        self._cooldown_until = 0.0
+        self._waiters: Dict[int, Deque[asyncio.Future]] = {rank: deque() for rank in sorted(set(PRIORITIES.values()))}
+        self._record_change("initial")
+
+    @classmethod
+    def from_env(cls, prefix: str, max_limit: int, latency_target: float,
+                 interactive_reserve: float = 0.0) -> "AdaptiveLimiter":
+        return cls(
+            name=prefix.lower(),
+            initial=int(os.getenv(f"{prefix}_CONCURRENCY_INITIAL", "5")),
+            min_limit=int(os.getenv(f"{prefix}_CONCURRENCY_MIN", "1")),
+            max_limit=int(os.getenv(f"{prefix}_CONCURRENCY_MAX", str(max_limit))),
+            latency_target=float(os.getenv(f"{prefix}_LATENCY_TARGET", str(latency_target))),
+            interactive_reserve=float(os.getenv(f"{prefix}_INTERACTIVE_RESERVE", str(interactive_reserve))),
+        )
+
+    def _record_change(self, reason: str, p95: Optional[float] = None, error_rate: Optional[float] = None):
+        entry = {"time": round(time.time(), 3), "limit": self.limit, "reason": reason}
+        if p95 is not None:
+            entry["p95"] = round(p95, 3)
+        if error_rate is not None:
+            entry["error_rate"] = round(error_rate, 3)
+        self.history.append(entry)
+        if reason != "initial":
+            logger.info("Concurrency limit %s -> %d (%s)", self.name, self.limit, reason)
+
+    # --- захват / освобождение ---
+
+    def _capacity(self, rank: int) -> int:
+        """Слотов, доступных классу: interactive — весь лимит, остальным — без резерва"""
+        if rank == PRIORITIES["interactive"]:
+            return self.limit
+        return max(1, self.limit - int(self.limit * self.interactive_reserve))
+
+    def _can_start(self, rank: int) -> bool:
+        if self.in_flight >= self._capacity(rank):
+            return False
+        # Более приоритетные ожидающие обслуживаются первыми
+        return not any(self._waiters[r] for r in self._waiters if r < rank)
+
+    async def acquire(self, priority: str = "interactive"):
+        rank = PRIORITIES.get(priority, PRIORITIES["batch"])
+        waiters = self._waiters[rank]
+        while not self._can_start(rank):
+            waiter = asyncio.get_running_loop().create_future()
+            waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Разбуженный, но отмененный ожидающий передает слот следующему
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+            finally:
+                if waiter in waiters:
+                    waiters.remove(waiter)
+        self.in_flight += 1
+        self._peak_in_flight = max(self._peak_in_flight, self.in_flight)
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        woken = 0
+        for rank, waiters in self._waiters.items():
+            capacity = self._capacity(rank)
+            while waiters and self.in_flight + woken < capacity:
+                waiter = waiters.popleft()
+                if waiter.done():
+                    continue
+                try:
+                    waiter.set_result(None)
+                    woken += 1
+                except RuntimeError:
+                    # Future от уже закрытого event loop
+                    continue
+            if waiters:
+                # Класс ждет свободного слота: менее приоритетные не обгоняют его
+                return
+
+    @asynccontextmanager
+    async def slot(self, priority: str = "interactive"):
+        """Выполнение операции под лимитом с учетом задержки и сигналов перегрузки"""
+        await self.acquire(priority)
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.record(time.monotonic() - started, classify_error(e))
+            raise
+        else:
+            self.record(time.monotonic() - started, None)
+        finally:
+            self.release()
+
+    # --- подстройка лимита ---
+
+    def record(self, latency: float, signal: Optional[str]):
+        now = time.monotonic()
+        if signal in ("throttled", "timeout"):
+            # Мультипликативное уменьшение, не чаще раза за время целевой задержки
+            if now >= self._cooldown_until:
+                self.limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+                self._cooldown_until = now + self.latency_target
+                self._reset_window()
+                self._record_change(signal)
+            return
+        self._latencies.append(latency)
+        if signal == "error":
+            self._errors += 1
+        if len(self._latencies) >= self.window:
+            self._evaluate()
+
+    def _reset_window(self):
+        self._latencies = []
+        self._errors = 0
+        self._peak_in_flight = self.in_flight
+
+    def _evaluate(self):
+        ordered = sorted(self._latencies)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        error_rate = self._errors / len(ordered)
+        # Под одной batch-нагрузкой лимит исчерпан уже на границе резерва
+        saturated = self._peak_in_flight >= self._capacity(PRIORITIES["batch"])
+        self._reset_window()
+
+        if error_rate > self.max_error_rate or p95 > self.latency_target * 1.5:
+            if self.limit > self.min_limit:
+                self.limit -= 1
+                self._record_change("degraded", p95, error_rate)
+        elif p95 <= self.latency_target and saturated and self.limit < self.max_limit:
+            # Рост имеет смысл, только если лимит действительно был исчерпан
+            self.limit += 1
+            self._record_change("healthy", p95, error_rate)
+            self._wake()
+
+    def snapshot(self, history: int = 20) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "min": self.min_limit,
+            "max": self.max_limit,
+            "interactive_reserve": self.interactive_reserve,
+            "waiting": {name: len(self._waiters[rank]) for name, rank in PRIORITIES.items()},
+            "history": list(self.history)[-history:],
+        }
+
+
+# Глобальные ограничители процесса: загрузка сайтов и запросы к LLM
+fetch_limiter = AdaptiveLimiter.from_env("FETCH", max_limit=64, latency_target=10.0)
+llm_limiter = AdaptiveLimiter.from_env("LLM", max_limit=32, latency_target=20.0, interactive_reserve=0.2)
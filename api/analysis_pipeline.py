@@ -5,14 +5,31 @@
 
 import asyncio
 import json
+import logging
 import time
 import os
-from typing import Dict, Any, List, Optional
-import httpx
-from bs4 import BeautifulSoup
-import google.generativeai as genai
+from typing import AsyncIterator, Callable, Dict, Any, List, Optional, Union
 from enum import Enum
 
+from http_clients import HTTPClientRegistry, http_clients as default_http_clients
+from page_cache import CachedPage, PageCache, get_page_cache
+from llm_cache import LLMResponseCache, get_llm_cache, make_cache_key
+from stage_scheduler import StageScheduler
+from extraction_pool import ExtractionPool, extraction_pool as default_extraction_pool
+from model_registry import DEFAULT_MODEL_NAME, ModelRegistry, model_registry as default_model_registry
+from adaptive_limiter import (
+    AdaptiveLimiter,
+    classify_error,
+    fetch_limiter as default_fetch_limiter,
+    llm_limiter as default_llm_limiter,
+)
+from quota_governor import QuotaGovernor, estimate_tokens, get_quota_governor
+from prompt_compaction import CompactPage, PromptCompactor, get_prompt_compactor
+from llm_batcher import MicroBatcher, get_llm_batcher
+from prefilter import PreClassifier, get_pre_classifier
+
+logger = logging.getLogger(__name__)
+
 
 class ProcessingStage(Enum):
     """Этапы обработки"""
@@ -24,6 +41,268 @@ class ProcessingStage(Enum):
     FINAL_DECISION = "final_decision"
 
 
+class PipelineMode(Enum):
+    """Режимы выполнения pipeline"""
+    FULL = "full"    # 4 последовательных запроса к LLM (этапы 2, 3, 4, 6)
+    FAST = "fast"    # этапы 2, 3, 4, 6 одним структурированным запросом
+
+
+# JSON-схема ответа для режима fast
+FUSED_RESPONSE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "initial_classification": {
+            "type": "object",
+            "properties": {
+                "relevance_score": {"type": "integer"},
+                "primary_category": {"type": "string"},
+                "key_indicators": {"type": "array", "items": {"type": "string"}},
+                "confidence": {"type": "integer"},
+                "reasoning": {"type": "string"},
+            },
+            "required": ["relevance_score", "primary_category", "confidence"],
+        },
+        "detailed_analysis": {
+            "type": "object",
+            "properties": {
+                "business_model": {"type": "string"},
+                "target_audience": {"type": "string"},
+                "technology_indicators": {"type": "array", "items": {"type": "string"}},
+                "market_position": {"type": "string"},
+                "growth_stage": {"type": "string", "enum": ["startup", "growth", "mature", "enterprise"]},
+                "detailed_score": {"type": "integer"},
+            },
+            "required": ["business_model", "detailed_score"],
+        },
+        "context_validation": {
+            "type": "object",
+            "properties": {
+                "is_consistent": {"type": "boolean"},
+                "red_flags": {"type": "array", "items": {"type": "string"}},
+                "missing_info": {"type": "array", "items": {"type": "string"}},
+                "evidence_quality": {"type": "string", "enum": ["high", "medium", "low"]},
+                "validation_score": {"type": "integer"},
+            },
+            "required": ["is_consistent", "validation_score"],
+        },
+        "final_decision": {
+            "type": "object",
+            "properties": {
+                "final_classification": {"type": "string"},
+                "relevance_score": {"type": "integer"},
+                "confidence": {"type": "integer"},
+                "decision": {"type": "string", "enum": ["ACCEPT", "REJECT", "REVIEW"]},
+                "reasoning": {"type": "string"},
+                "key_factors": {"type": "array", "items": {"type": "string"}},
+                "recommendations": {"type": "array", "items": {"type": "string"}},
+            },
+            "required": ["final_classification", "relevance_score", "confidence", "decision", "reasoning"],
+        },
+    },
+    "required": ["initial_classification", "detailed_analysis", "context_validation", "final_decision"],
+}
+
+FUSED_GENERATION_CONFIG: Dict[str, Any] = {
+    "response_mime_type": "application/json",
+    "response_schema": FUSED_RESPONSE_SCHEMA,
+}
+
+
+def _profiles_schema(item_properties: Dict[str, Any], item_required: List[str]) -> Dict[str, Any]:
+    """Схема массива profiles: по элементу на профиль с полем profile_type"""
+    return {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {"profile_type": {"type": "string"}, **item_properties},
+            "required": ["profile_type", *item_required],
+        },
+    }
+
+
+def _section_schema(section: str) -> Dict[str, Any]:
+    return FUSED_RESPONSE_SCHEMA["properties"][section]
+
+
+# Схемы анализа нескольких профилей: этапы 2 и 6 — по профилю, этапы 3 и 4 — общие.
+# Профили передаются массивом, а не ключами объекта: набор профилей меняется от запроса к запросу
+MULTI_CLASSIFICATION_GENERATION_CONFIG: Dict[str, Any] = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {"profiles": _profiles_schema(
+            _section_schema("initial_classification")["properties"],
+            _section_schema("initial_classification")["required"],
+        )},
+        "required": ["profiles"],
+    },
+}
+
+MULTI_DECISION_GENERATION_CONFIG: Dict[str, Any] = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {"profiles": _profiles_schema(
+            _section_schema("final_decision")["properties"],
+            _section_schema("final_decision")["required"],
+        )},
+        "required": ["profiles"],
+    },
+}
+
+MULTI_FUSED_GENERATION_CONFIG: Dict[str, Any] = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {
+            "detailed_analysis": _section_schema("detailed_analysis"),
+            "context_validation": _section_schema("context_validation"),
+            "profiles": _profiles_schema(
+                {"initial_classification": _section_schema("initial_classification"),
+                 "final_decision": _section_schema("final_decision")},
+                ["initial_classification", "final_decision"],
+            ),
+        },
+        "required": ["detailed_analysis", "context_validation", "profiles"],
+    },
+}
+
+
+# Этап 2 нескольких сайтов одним запросом (micro-batching batch-анализов)
+BATCHED_CLASSIFICATION_GENERATION_CONFIG: Dict[str, Any] = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {"sites": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"site_id": {"type": "string"}, **_section_schema("initial_classification")["properties"]},
+                "required": ["site_id", *_section_schema("initial_classification")["required"]],
+            },
+        }},
+        "required": ["sites"],
+    },
+}
+
+
+def _entries_by(items: Any, field: str, keys: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Элементы массива ответа LLM по значению field из keys (без учета регистра), без самого поля"""
+    wanted = {k.lower(): k for k in keys}
+    found: Dict[str, Dict[str, Any]] = {}
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        key = wanted.get(str(item.get(field, "")).strip().lower())
+        if key and key not in found:
+            found[key] = {k: v for k, v in item.items() if k != field}
+    return found
+
+
+def _by_profile(items: Any, profile_types: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Элементы массива profiles ответа LLM по запрошенным профилям"""
+    return _entries_by(items, "profile_type", profile_types)
+
+
+def _env_threshold(name: str, default: Optional[float]) -> Optional[float]:
+    """Порог из ENV: не задан — default, пустой/none/off — отключен"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    value = value.strip().lower()
+    return None if value in ("", "none", "off") else float(value)
+
+
+class CascadePolicy:
+    """Политика раннего выхода после этапа 2.
+    
+    Явные отказы (и, если настроено, явные совпадения) получают решение сразу из
+    этапов 2 и 5, без этапов 3, 4 и 6. Порог None отключает соответствующую ветку.
+    
+    ENV:
+      CASCADE_ENABLED                 — включить каскад (true)
+      CASCADE_REJECT_MAX_RELEVANCE    — REJECT при relevance_score <= порога (15)
+      CASCADE_REJECT_MIN_CONFIDENCE   — ...и confidence >= порога (80)
+      CASCADE_ACCEPT_MIN_RELEVANCE    — ACCEPT при relevance_score >= порога (выключено)
+      CASCADE_ACCEPT_MIN_CONFIDENCE   — ...и confidence >= порога (90)
+    """
+    
+    def __init__(self, enabled: bool = True,
+                 reject_max_relevance: Optional[float] = 15, reject_min_confidence: float = 80,
+                 accept_min_relevance: Optional[float] = None, accept_min_confidence: float = 90):
+        self.enabled = enabled
+        self.reject_max_relevance = reject_max_relevance
+        self.reject_min_confidence = reject_min_confidence
+        self.accept_min_relevance = accept_min_relevance
+        self.accept_min_confidence = accept_min_confidence
+    
+    @classmethod
+    def from_env(cls) -> "CascadePolicy":
+        return cls(
+            enabled=os.getenv("CASCADE_ENABLED", "true").lower() == "true",
+            reject_max_relevance=_env_threshold("CASCADE_REJECT_MAX_RELEVANCE", 15),
+            reject_min_confidence=_env_threshold("CASCADE_REJECT_MIN_CONFIDENCE", 80) or 0,
+            accept_min_relevance=_env_threshold("CASCADE_ACCEPT_MIN_RELEVANCE", None),
+            accept_min_confidence=_env_threshold("CASCADE_ACCEPT_MIN_CONFIDENCE", 90) or 0,
+        )
+    
+    def evaluate(self, initial: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Решение каскада по результату этапа 2: {"decision", "reason"} или None"""
+        if not self.enabled:
+            return None
+        try:
+            relevance = float(initial["relevance_score"])
+            confidence = float(initial["confidence"])
+        except (KeyError, TypeError, ValueError):
+            return None
+        
+        if (self.reject_max_relevance is not None and relevance <= self.reject_max_relevance
+                and confidence >= self.reject_min_confidence):
+            return {
+                "decision": "REJECT",
+                "reason": f"relevance {relevance:g} <= {self.reject_max_relevance:g} with confidence {confidence:g} >= {self.reject_min_confidence:g}",
+            }
+        if (self.accept_min_relevance is not None and relevance >= self.accept_min_relevance
+                and confidence >= self.accept_min_confidence):
+            return {
+                "decision": "ACCEPT",
+                "reason": f"relevance {relevance:g} >= {self.accept_min_relevance:g} with confidence {confidence:g} >= {self.accept_min_confidence:g}",
+            }
+        return None
+
+
+async def generate_governed(model: Any, prompt: str, priority: str = "interactive",
+                            quota: Optional[QuotaGovernor] = None, limiter: Optional[AdaptiveLimiter] = None,
+                            quota_stats: Optional[Dict[str, Any]] = None) -> Any:
+    """Запрос к Gemini под общими ограничениями: квота -> слот llm_limiter -> учет фактического расхода.
+
+    429 / ResourceExhausted опустошает ведра квоты для всех процессов; задержка и сигналы
+    перегрузки попадают в AIMD-подстройку limiter.
+    """
+    limiter = limiter or default_llm_limiter
+    reservation = None
+    if quota:
+        reservation = await quota.acquire(quota.estimate(prompt), priority)
+        if quota_stats is not None:
+            quota_stats["requests"] += 1
+            quota_stats["estimated_tokens"] += reservation.tokens
+            quota_stats["wait_seconds"] = round(quota_stats["wait_seconds"] + reservation.waited, 3)
+    try:
+        async with limiter.slot(priority):
+            response = await model.generate_content_async(prompt)
+    except Exception as e:
+        if quota and classify_error(e) == "throttled":
+            quota.penalize()
+        raise
+    if reservation:
+        usage = getattr(response, "usage_metadata", None)
+        actual_tokens = getattr(usage, "total_token_count", None) if usage else None
+        quota.settle(reservation, actual_tokens)
+        if quota_stats is not None:
+            quota_stats["actual_tokens"] += actual_tokens or reservation.tokens
+    return response
+
+
 class ProcessingResult:
     """Результат обработки на каждом этапе"""
     def __init__(self, stage: ProcessingStage, success: bool, data: Dict[str, Any], error: Optional[str] = None):
@@ -32,24 +311,194 @@ class ProcessingResult:
         self.data = data
         self.error = error
         self.timestamp = time.time()
+        # Длительность этапа, сек (заполняется pipeline при публикации результата)
+        self.duration: Optional[float] = None
 
 
 class EnhancedPipeline:
     """6-этапный pipeline анализа сайтов"""
     
-    def __init__(self):
-        self.gemini_model = None
+    MODEL_NAME = DEFAULT_MODEL_NAME
+    GENERATION_CONFIG: Dict[str, Any] = {}
+    
+    # Заглушка входов этапа 3 при спекулятивном запуске параллельно с этапом 2
+    SPECULATIVE_RELEVANCE = int(os.getenv("PIPELINE_SPECULATIVE_RELEVANCE", "75"))
+    SPECULATIVE_TOLERANCE = int(os.getenv("PIPELINE_SPECULATIVE_TOLERANCE", "25"))
+    
+    def __init__(self, http_clients: Optional[HTTPClientRegistry] = None,
+                 page_cache: Optional[PageCache] = None, use_page_cache: bool = True,
+                 llm_cache: Optional[LLMResponseCache] = None, bypass_llm_cache: bool = False,
+                 speculative: Optional[bool] = None, cascade: Optional[CascadePolicy] = None,
+                 extraction_pool: Optional[ExtractionPool] = None,
+                 model_registry: Optional[ModelRegistry] = None,
+                 fetch_limiter: Optional[AdaptiveLimiter] = None, llm_limiter: Optional[AdaptiveLimiter] = None,
+                 quota: Optional[QuotaGovernor] = None, priority: str = "interactive",
+                 compactor: Optional[PromptCompactor] = None, batcher: Optional[MicroBatcher] = None,
+                 prefilter: Optional[PreClassifier] = None):
+        self.models = model_registry or default_model_registry
+        # Адаптивные лимиты параллелизма, общие для всех pipeline процесса
+        self.fetch_limiter = fetch_limiter or default_fetch_limiter
+        self.llm_limiter = llm_limiter or default_llm_limiter
+        # Квоты Gemini RPM/TPM: interactive обслуживается раньше batch
+        self.quota = quota or get_quota_governor()
+        self.priority = priority
+        self.quota_stats = {"requests": 0, "estimated_tokens": 0, "actual_tokens": 0, "wait_seconds": 0.0}
+        self.http_clients = http_clients or default_http_clients
+        self.extraction_pool = extraction_pool or default_extraction_pool
+        self.page_cache = (page_cache or get_page_cache()) if use_page_cache else None
+        self.page_cache_stats = {"hits": 0, "misses": 0, "revalidated": 0}
+        # bypass_llm_cache: не читать из кэша, но сохранить свежий ответ
+        self.llm_cache = llm_cache or get_llm_cache()
+        self.bypass_llm_cache = bypass_llm_cache
+        self.llm_cache_stats = {"hits": 0, "misses": 0}
+        if speculative is None:
+            speculative = os.getenv("PIPELINE_SPECULATIVE", "false").lower() == "true"
+        self.speculative = speculative
+        self.speculation: Optional[str] = None
+        self.cascade = cascade or CascadePolicy.from_env()
+        # Сжатие промптов под бюджет этапа; оценка токенов до/после — по этапам
+        self.compactor = compactor or get_prompt_compactor()
+        self.prompt_stats: Dict[str, Dict[str, int]] = {}
+        self._prompt_saved: Dict[str, int] = {}
+        self._page: Optional[tuple] = None
+        # Этап 2 batch-анализов объединяется с одновременными анализами других сайтов
+        self.batcher = batcher if batcher is not None else (get_llm_batcher() if priority == "batch" else None)
+        # Локальный отсев явных несовпадений до этапа 2
+        self.prefilter = prefilter or get_pre_classifier()
+        self.scheduler = StageScheduler()
         self.results: List[ProcessingResult] = []
+        self._on_result: Optional[Callable[[ProcessingResult], Any]] = None
     
-    async def _get_gemini_model(self):
-        """Получение модели Gemini"""
-        if not self.gemini_model:
-            api_key = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
-            if not api_key:
-                raise ValueError("GEMINI_API_KEY or GOOGLE_API_KEY not set")
-            genai.configure(api_key=api_key)
-            self.gemini_model = genai.GenerativeModel('gemini-1.5-flash')
-        return self.gemini_model
+    def _emit(self, result: ProcessingResult):
+        """Публикация завершенного этапа подписчику analyze_website(on_result=...)"""
+        if self._on_result is None:
+            return
+        timing = self.scheduler.timings.get(result.stage.value)
+        result.duration = timing["duration"] if timing else None
+        try:
+            self._on_result(result)
+        except Exception as e:
+            logger.warning(f"Stage result hook failed for {result.stage.value}: {e}")
+    
+    def _concurrency_limits(self) -> Dict[str, int]:
+        """Текущие адаптивные лимиты на момент завершения анализа"""
+        return {"fetch": self.fetch_limiter.limit, "llm": self.llm_limiter.limit}
+    
+    def _get_gemini_model(self, generation_config: Optional[Dict[str, Any]] = None):
+        """Модель Gemini из общего реестра процесса"""
+        return self.models.get(self.MODEL_NAME, generation_config)
+    
+    def _compact_page(self, content_data: Dict[str, Any]) -> CompactPage:
+        """Текст страницы без повторов и шаблонов (готовится один раз на анализ)"""
+        if self._page is None or self._page[0] is not content_data:
+            self._page = (content_data, self.compactor.prepare(content_data))
+        return self._page[1]
+    
+    def _record_saving(self, stage: str, legacy: str, prompt: str):
+        saved = estimate_tokens(legacy) - estimate_tokens(prompt)
+        self._prompt_saved[stage] = self._prompt_saved.get(stage, 0) + saved
+    
+    def _page_prompt(self, stage: str, content_data: Dict[str, Any], build: Callable[[str, str], str],
+                     text_limit: int, headers_limit: int) -> str:
+        """Промпт build(текст, заголовки) с текстом страницы, сжатым под бюджет этапа.
+        
+        Без сжатия — прежний срез main_text[:text_limit] и первые headers_limit заголовков.
+        """
+        legacy = build(content_data.get('main_text', '')[:text_limit],
+                       ', '.join(content_data.get('headers', [])[:headers_limit]))
+        if not self.compactor.enabled:
+            return legacy
+        page = self._compact_page(content_data)
+        headers = ', '.join(page.headers[:headers_limit])
+        # Сжатый текст не длиннее прежнего среза: бюджет может только уменьшить промпт
+        prompt = self.compactor.fit(page, stage, lambda text: build(text, headers), text_limit // 4)
+        self._record_saving(stage, legacy, prompt)
+        return prompt
+    
+    def _summary_prompt(self, stage: str, build: Callable[[Callable[[Any], str]], str]) -> str:
+        """Промпт build(сериализатор) с результатами прошлых этапов: компактный JSON вместо str(dict)"""
+        legacy = build(str)
+        if not self.compactor.enabled:
+            return legacy
+        prompt = self.compactor.fit_summary(stage, build)
+        self._record_saving(stage, legacy, prompt)
+        return prompt
+    
+    def _record_prompt(self, stage: str, tokens: int) -> Dict[str, int]:
+        """Учет токенов промпта этапа: после сжатия и без него"""
+        entry = self.prompt_stats.setdefault(stage, {"calls": 0, "tokens_before": 0, "tokens_after": 0})
+        entry["calls"] += 1
+        entry["tokens_after"] += tokens
+        entry["tokens_before"] += tokens + self._prompt_saved.pop(stage, 0)
+        return entry
+    
+    async def _generate(self, stage: str, prompt: str, generation_config: Optional[Dict[str, Any]] = None,
+                        record_prompt: bool = True) -> str:
+        """Запрос к Gemini через кэш ответов"""
+        config = generation_config or self.GENERATION_CONFIG
+        if record_prompt:
+            self._record_prompt(stage, estimate_tokens(prompt))
+        key = None
+        if self.llm_cache:
+            key = make_cache_key(self.MODEL_NAME, config, stage, prompt)
+            if not self.bypass_llm_cache:
+                cached = await self.llm_cache.get(key)
+                if cached is not None:
+                    self.llm_cache_stats["hits"] += 1
+                    return cached
+            self.llm_cache_stats["misses"] += 1
+        
+        model = self._get_gemini_model(config)
+        response = await generate_governed(
+            model, prompt, self.priority, self.quota, self.llm_limiter, self.quota_stats,
+        )
+        raw_text = response.text.strip()
+        
+        # Кэшируем только разбираемые ответы, чтобы не закреплять fallback
+        if key:
+            try:
+                json.loads(raw_text)
+                await self.llm_cache.put(key, stage, raw_text)
+            except ValueError:
+                pass
+        return raw_text
+    
+    async def _fetch_page(self, url: str) -> CachedPage:
+        """Загрузка страницы через общий пул с дисковым кэшем и условной ревалидацией"""
+        cached = await self.page_cache.get(url) if self.page_cache else None
+        if cached and cached.is_fresh(self.page_cache.ttl_seconds):
+            self._record_page_cache("hits")
+            return cached
+        
+        headers = cached.conditional_headers() if cached else {}
+        # Потоковая загрузка: не-HTML отсекается до чтения тела, тело ограничено FETCH_MAX_BYTES
+        response = await self.http_clients.fetch_page(url, headers=headers, limiter=self.fetch_limiter, decode=False)
+        
+        if response.status_code == 304:
+            if not cached:
+                raise ValueError("Unexpected 304 Not Modified without cached page")
+            # Страница не изменилась — тело не передавалось
+            await self.page_cache.touch(url, cached)
+            self._record_page_cache("revalidated")
+            return cached
+        
+        page = CachedPage(
+            url=url,
+            final_url=response.url,
+            status_code=response.status_code,
+            body=response.body,
+            encoding=response.encoding,
+            etag=response.headers.get("etag"),
+            last_modified=response.headers.get("last-modified"),
+        )
+        if self.page_cache:
+            await self.page_cache.put(url, page)
+            self._record_page_cache("misses")
+        return page
+    
+    def _record_page_cache(self, outcome: str):
+        self.page_cache_stats[outcome] += 1
+        self.page_cache.record(outcome)
     
     async def _extract_content(self, url: str) -> ProcessingResult:
         """Этап 1: Извлечение контента"""
@@ -57,84 +506,17 @@ class EnhancedPipeline:
             if not url.startswith("http"):
                 url = f"https://{url}"
             
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.get(url, follow_redirects=True)
-                response.raise_for_status()
-                
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                # Извлекаем ключевые элементы
-                title = soup.find('title')
-                title_text = title.get_text().strip() if title else ""
-                
-                # Удаляем скрипты и стили
-                for script in soup(["script", "style", "nav", "footer", "header"]):
-                    script.decompose()
-                
-                # Получаем основной текст более агрессивно
-                text = soup.get_text()
-                lines = (line.strip() for line in text.splitlines())
-                chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-                text = ' '.join(chunk for chunk in chunks if chunk)
-                
-                # Если текст слишком короткий, пробуем альтернативные методы
-                if len(text) < 100:
-                    # Пробуем получить текст из body
-                    body = soup.find('body')
-                    if body:
-                        text = body.get_text()
-                        lines = (line.strip() for line in text.splitlines())
-                        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-                        text = ' '.join(chunk for chunk in chunks if chunk)
-                
-                # Если все еще короткий, используем весь HTML как fallback
-                if len(text) < 100:
-                    text = response.text[:5000]  # Первые 5000 символов HTML
-                
-                # Дополнительно извлекаем текст из всех элементов
-                if len(text) < 200:
-                    all_text_elements = soup.find_all(['p', 'div', 'span', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
-                    additional_text = ' '.join([elem.get_text().strip() for elem in all_text_elements if elem.get_text().strip()])
-                    if additional_text:
-                        text = additional_text[:3000]
-                
-                # Извлекаем мета-теги
-                meta_description = ""
-                meta_desc = soup.find('meta', attrs={'name': 'description'})
-                if meta_desc:
-                    meta_description = meta_desc.get('content', '')
-                
-                # Извлекаем заголовки
-                headers = []
-                for tag in ['h1', 'h2', 'h3']:
-                    for header in soup.find_all(tag):
-                        headers.append(header.get_text().strip())
-                
-                # Извлекаем ссылки
-                links = []
-                for link in soup.find_all('a', href=True):
-                    href = link.get('href')
-                    text = link.get_text().strip()
-                    if href and text:
-                        links.append({'url': href, 'text': text})
-                
-                content_data = {
-                    'url': url,
-                    'title': title_text,
-                    'meta_description': meta_description,
-                    'main_text': text[:5000],  # Ограничиваем размер
-                    'headers': headers[:20],   # Первые 20 заголовков
-                    'links': links[:50],       # Первые 50 ссылок
-                    'content_length': len(text),
-                    'status_code': response.status_code
-                }
-                
-                return ProcessingResult(
-                    stage=ProcessingStage.CONTENT_EXTRACTION,
-                    success=True,
-                    data=content_data
-                )
-                
+            page = await self._fetch_page(url)
+            
+            # Разбор в пуле исполнителей, event loop не блокируется
+            content_data = await self.extraction_pool.extract(page.body, page.encoding, url, page.status_code)
+            
+            return ProcessingResult(
+                stage=ProcessingStage.CONTENT_EXTRACTION,
+                success=True,
+                data=content_data
+            )
+            
         except Exception as e:
             return ProcessingResult(
                 stage=ProcessingStage.CONTENT_EXTRACTION,
@@ -143,19 +525,95 @@ class EnhancedPipeline:
                 error=str(e)
             )
     
+    async def _send_classification_batch(self, blocks: List[str]) -> List[Optional[tuple]]:
+        """Этап 2 нескольких сайтов одним запросом: для каждого блока (результат, доля токенов запроса) или None.
+        
+        Запрос выполняется от имени этого pipeline (квота и статистика кэша — его).
+        """
+        site_ids = [f"s{i}" for i in range(1, len(blocks) + 1)]
+        sites = "\n".join(f"\n            [site {site_id}]{block}" for site_id, block in zip(site_ids, blocks))
+        prompt = f"""
+            Analyze each website below and determine if it matches its target profile.
+            Classify every site independently.
+            
+            Profile Types:
+            - software: Software companies, SaaS platforms, development tools
+            - fintech: Financial technology, payment systems, banking solutions
+            - edtech: Educational technology, online learning platforms
+            - healthtech: Healthcare technology, medical software, telemedicine
+            
+            Websites:
+{sites}
+            
+            Return JSON with one entry per site:
+            {{
+                "sites": [
+                    {{
+                        "site_id": "s1",
+                        "relevance_score": 0-100,
+                        "primary_category": "category name",
+                        "key_indicators": ["indicator1", "indicator2"],
+                        "confidence": 0-100,
+                        "reasoning": "explanation"
+                    }}
+                ]
+            }}
+            """
+        raw_text = await self._generate(
+            "batched_initial_classification", prompt, BATCHED_CLASSIFICATION_GENERATION_CONFIG, record_prompt=False
+        )
+        found = _entries_by(json.loads(raw_text).get("sites"), "site_id", site_ids)
+        # Общая часть промпта делится поровну между сайтами пачки
+        overhead = (estimate_tokens(prompt) - sum(estimate_tokens(block) for block in blocks)) / len(blocks)
+        results: List[Optional[tuple]] = []
+        for site_id, block in zip(site_ids, blocks):
+            data = found.get(site_id)
+            if data is None or "relevance_score" not in data or "confidence" not in data:
+                results.append(None)
+            else:
+                results.append((data, estimate_tokens(block) + round(overhead)))
+        return results
+    
+    async def _initial_classification_batched(self, content_data: Dict[str, Any],
+                                              profile_type: str) -> Optional[ProcessingResult]:
+        """Этап 2 в общем запросе с одновременными batch-анализами; None — нужен одиночный запрос"""
+        stage = ProcessingStage.INITIAL_CLASSIFICATION.value
+        block_stage = "batched_initial_classification"
+        block = self._page_prompt(block_stage, content_data, lambda text, headers: f"""
+            Target Profile: {profile_type}
+            Website Title: {content_data.get('title', '')}
+            Meta Description: {content_data.get('meta_description', '')}
+            Main Content: {text}
+            Headers: {headers}""", 2000, 10)
+        saved = self._prompt_saved.pop(block_stage, 0)
+        outcome = await self.batcher.submit(
+            f"{self.MODEL_NAME}:{block_stage}", block, estimate_tokens(block), self._send_classification_batch
+        )
+        if outcome is None:
+            return None
+        data, tokens = outcome
+        self._prompt_saved[stage] = self._prompt_saved.get(stage, 0) + saved
+        entry = self._record_prompt(stage, tokens)
+        entry["batched"] = entry.get("batched", 0) + 1
+        return ProcessingResult(stage=ProcessingStage.INITIAL_CLASSIFICATION, success=True, data=data)
+    
     async def _initial_classification(self, content_data: Dict[str, Any], profile_type: str) -> ProcessingResult:
         """Этап 2: Первичная классификация"""
         try:
-            model = await self._get_gemini_model()
+            if self.batcher is not None and self.batcher.enabled:
+                batched = await self._initial_classification_batched(content_data, profile_type)
+                if batched is not None:
+                    return batched
             
             # Создаем промпт для первичной классификации
-            prompt = f"""
+            stage = ProcessingStage.INITIAL_CLASSIFICATION.value
+            prompt = self._page_prompt(stage, content_data, lambda text, headers: f"""
             Analyze this website content and determine if it matches the {profile_type} profile.
             
             Website Title: {content_data.get('title', '')}
             Meta Description: {content_data.get('meta_description', '')}
-            Main Content: {content_data.get('main_text', '')[:2000]}
-            Headers: {', '.join(content_data.get('headers', [])[:10])}
+            Main Content: {text}
+            Headers: {headers}
             
             Profile Types:
             - software: Software companies, SaaS platforms, development tools
@@ -171,10 +629,9 @@ class EnhancedPipeline:
                 "confidence": 0-100,
                 "reasoning": "explanation"
             }}
-            """
+            """, 2000, 10)
             
-            response = await model.generate_content_async(prompt)
-            raw_text = response.text.strip()
+            raw_text = await self._generate(stage, prompt)
             
             # Парсим JSON ответ
             try:
@@ -206,13 +663,12 @@ class EnhancedPipeline:
     async def _detailed_analysis(self, content_data: Dict[str, Any], initial_result: Dict[str, Any]) -> ProcessingResult:
         """Этап 3: Детальный анализ"""
         try:
-            model = await self._get_gemini_model()
-            
-            prompt = f"""
+            stage = ProcessingStage.DETAILED_ANALYSIS.value
+            prompt = self._page_prompt(stage, content_data, lambda text, headers: f"""
             Perform detailed analysis of this website based on initial classification.
             
-            Content: {content_data.get('main_text', '')[:3000]}
-            Headers: {', '.join(content_data.get('headers', [])[:15])}
+            Content: {text}
+            Headers: {headers}
             Links: {len(content_data.get('links', []))} links found
             
             Initial Classification: {initial_result.get('primary_category', 'unknown')}
@@ -234,10 +690,9 @@ class EnhancedPipeline:
                 "growth_stage": "startup|growth|mature|enterprise",
                 "detailed_score": 0-100
             }}
-            """
+            """, 3000, 15)
             
-            response = await model.generate_content_async(prompt)
-            raw_text = response.text.strip()
+            raw_text = await self._generate(stage, prompt)
             
             try:
                 result = json.loads(raw_text)
@@ -268,8 +723,6 @@ class EnhancedPipeline:
     async def _context_validation(self, content_data: Dict[str, Any], analysis_results: List[Dict[str, Any]]) -> ProcessingResult:
         """Этап 4: Валидация контекста"""
         try:
-            model = await self._get_gemini_model()
-            
             # Объединяем результаты предыдущих этапов
             combined_data = {
                 'content': content_data,
@@ -277,14 +730,15 @@ class EnhancedPipeline:
                 'detailed': analysis_results[1] if len(analysis_results) > 1 else {}
             }
             
-            prompt = f"""
+            stage = ProcessingStage.CONTEXT_VALIDATION.value
+            prompt = self._summary_prompt(stage, lambda dump: f"""
             Validate the analysis results and check for consistency.
             
             Website: {content_data.get('title', '')}
             URL: {content_data.get('url', '')}
             
-            Initial Classification: {combined_data['initial']}
-            Detailed Analysis: {combined_data['detailed']}
+            Initial Classification: {dump(combined_data['initial'])}
+            Detailed Analysis: {dump(combined_data['detailed'])}
             
             Check for:
             1. Consistency between initial and detailed analysis
@@ -300,10 +754,9 @@ class EnhancedPipeline:
                 "evidence_quality": "high|medium|low",
                 "validation_score": 0-100
             }}
-            """
+            """)
             
-            response = await model.generate_content_async(prompt)
-            raw_text = response.text.strip()
+            raw_text = await self._generate(stage, prompt)
             
             try:
                 result = json.loads(raw_text)
@@ -394,8 +847,6 @@ class EnhancedPipeline:
     async def _final_decision(self, all_results: List[ProcessingResult], profile_type: str) -> ProcessingResult:
         """Этап 6: Финальное решение"""
         try:
-            model = await self._get_gemini_model()
-            
             # Собираем все данные для финального решения
             content_result = next((r for r in all_results if r.stage == ProcessingStage.CONTENT_EXTRACTION), None)
             initial_result = next((r for r in all_results if r.stage == ProcessingStage.INITIAL_CLASSIFICATION), None)
@@ -413,17 +864,18 @@ class EnhancedPipeline:
                 "confidence": confidence_result.data if confidence_result else {}
             }
             
-            prompt = f"""
+            stage = ProcessingStage.FINAL_DECISION.value
+            prompt = self._summary_prompt(stage, lambda dump: f"""
             Make final decision on website classification based on comprehensive 6-stage analysis.
             
             Target Profile: {profile_type}
             Website: {summary['website']}
             
             Analysis Summary:
-            - Initial Classification: {summary['initial_classification']}
-            - Detailed Analysis: {summary['detailed_analysis']}
-            - Validation Results: {summary['validation']}
-            - Confidence Assessment: {summary['confidence']}
+            - Initial Classification: {dump(summary['initial_classification'])}
+            - Detailed Analysis: {dump(summary['detailed_analysis'])}
+            - Validation Results: {dump(summary['validation'])}
+            - Confidence Assessment: {dump(summary['confidence'])}
             
             Make final decision considering:
             1. Overall relevance to {profile_type} profile
@@ -441,10 +893,9 @@ class EnhancedPipeline:
                 "key_factors": ["factor1", "factor2"],
                 "recommendations": ["rec1", "rec2"]
             }}
-            """
+            """)
             
-            response = await model.generate_content_async(prompt)
-            raw_text = response.text.strip()
+            raw_text = await self._generate(stage, prompt)
             
             try:
                 result = json.loads(raw_text)
@@ -477,79 +928,712 @@ class EnhancedPipeline:
                 error=str(e)
             )
     
-    async def analyze_website(self, url: str, domain: str, profile_type: str) -> Dict[str, Any]:
-        """Запуск полного 6-этапного анализа"""
-        start_time = time.time()
-        self.results = []
+    async def _fused_analysis(self, content_data: Dict[str, Any], profile_type: str) -> Dict[str, Any]:
+        """Этапы 2, 3, 4 и 6 одним запросом с JSON-схемой (режим fast)"""
+        prompt = self._page_prompt("fused", content_data, lambda text, headers: f"""
+        Analyze this website against the {profile_type} profile in one pass.
+        
+        Website Title: {content_data.get('title', '')}
+        URL: {content_data.get('url', '')}
+        Meta Description: {content_data.get('meta_description', '')}
+        Main Content: {text}
+        Headers: {headers}
+        Links: {len(content_data.get('links', []))} links found
+        
+        Profile Types:
+        - software: Software companies, SaaS platforms, development tools
+        - fintech: Financial technology, payment systems, banking solutions
+        - edtech: Educational technology, online learning platforms
+        - healthtech: Healthcare technology, medical software, telemedicine
+        
+        Fill every section of the response schema:
+        1. initial_classification: relevance to the {profile_type} profile (0-100), primary category, key indicators, confidence (0-100)
+        2. detailed_analysis: business model, target audience, technology indicators, market position, growth stage, detailed score (0-100)
+        3. context_validation: consistency of 1 and 2, red flags, missing information, evidence quality, validation score (0-100)
+        4. final_decision: final classification, relevance score, confidence, ACCEPT|REJECT|REVIEW decision with reasoning, key factors, recommendations
+        """, 3000, 15)
+        
+        raw_text = await self._generate("fused", prompt, FUSED_GENERATION_CONFIG)
+        result = json.loads(raw_text)
+        for section in ("initial_classification", "detailed_analysis", "context_validation", "final_decision"):
+            if not isinstance(result.get(section), dict):
+                raise ValueError(f"Fused response missing section: {section}")
+        return result
+    
+    async def _run_fused_stages(self, content_data: Dict[str, Any], profile_type: str) -> bool:
+        """Режим fast: один запрос вместо четырех, результаты раскладываются по этапам"""
+        try:
+            fused = await self.scheduler.timed("fused", self._fused_analysis(content_data, profile_type))
+        except Exception:
+            return False
+        
+        for stage, section in ((ProcessingStage.INITIAL_CLASSIFICATION, "initial_classification"),
+                               (ProcessingStage.DETAILED_ANALYSIS, "detailed_analysis"),
+                               (ProcessingStage.CONTEXT_VALIDATION, "context_validation")):
+            self.results.append(ProcessingResult(stage, True, fused[section]))
+            self._emit(self.results[-1])
+        
+        # Этап 5 считается локально, как и в полном режиме
+        confidence_result = await self.scheduler.timed(
+            ProcessingStage.CONFIDENCE_ASSESSMENT.value, self._confidence_assessment(self.results)
+        )
+        self.results.append(confidence_result)
+        self._emit(confidence_result)
         
+        self.results.append(ProcessingResult(ProcessingStage.FINAL_DECISION, True, fused["final_decision"]))
+        self._emit(self.results[-1])
+        return True
+    
+    def _speculation_matches(self, placeholder: Dict[str, Any], actual: Dict[str, Any]) -> bool:
+        """Совпадают ли реальные входы этапа 3 с заглушкой"""
+        expected = str(placeholder.get("primary_category", "")).lower()
+        category = str(actual.get("primary_category", "")).lower()
+        if not category or not (expected in category or category in expected):
+            return False
         try:
-            # Этап 1: Извлечение контента
-            content_result = await self._extract_content(url)
-            self.results.append(content_result)
+            score = float(actual.get("relevance_score", 0))
+        except (TypeError, ValueError):
+            return False
+        return abs(score - placeholder["relevance_score"]) <= self.SPECULATIVE_TOLERANCE
+    
+    def _cascade_decision(self, cascade: Dict[str, Any], initial: Dict[str, Any],
+                          confidence: Dict[str, Any], profile_type: str) -> ProcessingResult:
+        """Финальное решение раннего выхода из этапов 2 и 5, без обращения к LLM"""
+        decision = cascade["decision"]
+        category = initial.get("primary_category") or profile_type
+        return ProcessingResult(
+            stage=ProcessingStage.FINAL_DECISION,
+            success=True,
+            data={
+                "final_classification": category if decision == "ACCEPT" else f"Not {profile_type} ({category})",
+                "relevance_score": initial.get("relevance_score", 0),
+                "confidence": confidence.get("final_confidence", initial.get("confidence", 0)),
+                "decision": decision,
+                "reasoning": f"Early exit after initial classification: {cascade['reason']}. {initial.get('reasoning', '')}".strip(),
+                "key_factors": initial.get("key_indicators", []),
+                "recommendations": [],
+                "cascade": True,
+            }
+        )
+    
+    async def _run_full_stages(self, content_data: Dict[str, Any], profile_type: str):
+        """Режим full: этапы 2-6 как граф зависимостей.
+        
+        Этап 3 читает из этапа 2 только категорию и score, поэтому при speculative=True
+        он стартует параллельно с этапом 2 на заглушке и перезапускается, если заглушка не совпала.
+        Если результат этапа 2 проходит порог CascadePolicy, этапы 3, 4 и 6 пропускаются.
+        """
+        content_result = self.results[0]
+        initial = ProcessingStage.INITIAL_CLASSIFICATION.value
+        detailed = ProcessingStage.DETAILED_ANALYSIS.value
+        validation = ProcessingStage.CONTEXT_VALIDATION.value
+        confidence = ProcessingStage.CONFIDENCE_ASSESSMENT.value
+        final = ProcessingStage.FINAL_DECISION.value
+        scheduler = self.scheduler
+        cascade: Dict[str, Any] = {}
+        
+        # Этапы публикуются по мере завершения (спекулятивный узел — только через reconcile)
+        stage_names = (initial, detailed, validation, confidence, final)
+        def on_complete(name: str, result: Any):
+            if name in stage_names and result is not None:
+                self._emit(result)
+        scheduler.on_complete = on_complete
+        
+        # Этап 2: Первичная классификация (+ проверка раннего выхода)
+        async def classify(inputs: Dict[str, Any]) -> ProcessingResult:
+            result = await self._initial_classification(content_data, profile_type)
+            exit_decision = self.cascade.evaluate(result.data) if result.success else None
+            if exit_decision:
+                cascade.update(exit_decision)
+                skipped = [name for name in scheduler.nodes if name not in (initial, confidence)]
+                scheduler.skip(skipped, f"cascade {exit_decision['decision']}: {exit_decision['reason']}")
+            return result
+        
+        scheduler.add(initial, classify)
+        
+        # Этап 3: Детальный анализ
+        if self.speculative:
+            placeholder = {"primary_category": profile_type, "relevance_score": self.SPECULATIVE_RELEVANCE}
+            speculative_stage = f"{detailed}_speculative"
             
-            if not content_result.success:
-                raise Exception(f"Content extraction failed: {content_result.error}")
+            async def reconcile(inputs: Dict[str, Any]) -> ProcessingResult:
+                initial_data = inputs[initial].data
+                if self._speculation_matches(placeholder, initial_data):
+                    self.speculation = "hit"
+                    return inputs[speculative_stage]
+                self.speculation = "miss"
+                return await self._detailed_analysis(content_data, initial_data)
             
-            # Этап 2: Первичная классификация
-            initial_result = await self._initial_classification(content_result.data, profile_type)
-            self.results.append(initial_result)
+            scheduler.add(speculative_stage, lambda inputs: self._detailed_analysis(content_data, placeholder))
+            scheduler.add(detailed, reconcile, deps=(initial, speculative_stage))
+        else:
+            scheduler.add(
+                detailed,
+                lambda inputs: self._detailed_analysis(content_data, inputs[initial].data),
+                deps=(initial,),
+            )
+        
+        # Этап 4: Валидация контекста
+        scheduler.add(
+            validation,
+            lambda inputs: self._context_validation(
+                content_data, [r.data for r in (inputs[initial], inputs[detailed]) if r.success]
+            ),
+            deps=(initial, detailed),
+        )
+        
+        # Этап 5: Оценка уверенности (пропущенные этапы не учитываются)
+        scheduler.add(
+            confidence,
+            lambda inputs: self._confidence_assessment(
+                [r for r in (content_result, inputs[initial], inputs[detailed], inputs[validation]) if r is not None]
+            ),
+            deps=(initial, detailed, validation),
+        )
+        
+        # Этап 6: Финальное решение
+        scheduler.add(
+            final,
+            lambda inputs: self._final_decision(
+                [content_result, inputs[initial], inputs[detailed], inputs[validation], inputs[confidence]],
+                profile_type,
+            ),
+            deps=(initial, detailed, validation, confidence),
+        )
+        
+        outputs = await scheduler.run()
+        if cascade:
+            outputs[final] = self._cascade_decision(cascade, outputs[initial].data, outputs[confidence].data, profile_type)
+            self._emit(outputs[final])
+        self.results.extend(
+            outputs[name] for name in (initial, detailed, validation, confidence, final) if outputs[name] is not None
+        )
+    
+    async def _initial_classification_multi(self, content_data: Dict[str, Any],
+                                            profile_types: List[str]) -> Dict[str, ProcessingResult]:
+        """Этап 2 для нескольких профилей одним запросом; пропавшие из ответа профили — отдельными запросами"""
+        stage = "multi_initial_classification"
+        prompt = self._page_prompt(stage, content_data, lambda text, headers: f"""
+            Analyze this website content and determine how well it matches each of these profiles: {', '.join(profile_types)}.
             
-            # Этап 3: Детальный анализ
-            detailed_result = await self._detailed_analysis(content_result.data, initial_result.data)
-            self.results.append(detailed_result)
+            Website Title: {content_data.get('title', '')}
+            URL: {content_data.get('url', '')}
+            Meta Description: {content_data.get('meta_description', '')}
+            Main Content: {text}
+            Headers: {headers}
             
-            # Этап 4: Валидация контекста
-            analysis_results = [r.data for r in self.results[1:3] if r.success]
-            validation_result = await self._context_validation(content_result.data, analysis_results)
-            self.results.append(validation_result)
+            Profile Types:
+            - software: Software companies, SaaS platforms, development tools
+            - fintech: Financial technology, payment systems, banking solutions
+            - edtech: Educational technology, online learning platforms
+            - healthtech: Healthcare technology, medical software, telemedicine
             
-            # Этап 5: Оценка уверенности
-            confidence_result = await self._confidence_assessment(self.results)
-            self.results.append(confidence_result)
+            Score every requested profile independently. Return JSON with one entry per profile:
+            {{
+                "profiles": [
+                    {{
+                        "profile_type": "profile name",
+                        "relevance_score": 0-100,
+                        "primary_category": "category name",
+                        "key_indicators": ["indicator1", "indicator2"],
+                        "confidence": 0-100,
+                        "reasoning": "explanation"
+                    }}
+                ]
+            }}
+            """, 2000, 10)
+        try:
+            raw_text = await self._generate(stage, prompt, MULTI_CLASSIFICATION_GENERATION_CONFIG)
+            found = _by_profile(json.loads(raw_text).get("profiles"), profile_types)
+        except Exception as e:
+            logger.warning(f"Multi-profile classification failed, falling back to per-profile calls: {e}")
+            found = {}
+        
+        results = {p: ProcessingResult(ProcessingStage.INITIAL_CLASSIFICATION, True, found[p]) for p in found}
+        missing = [p for p in profile_types if p not in found]
+        for p, result in zip(missing, await asyncio.gather(
+                *(self._initial_classification(content_data, p) for p in missing))):
+            results[p] = result
+        return {p: results[p] for p in profile_types}
+    
+    async def _final_decision_multi(self, profile_results: Dict[str, List[ProcessingResult]]) -> Dict[str, ProcessingResult]:
+        """Этап 6 для нескольких профилей одним запросом; пропавшие из ответа профили — отдельными запросами.
+        
+        profile_results — результаты этапов 1-5 каждого профиля (этапы 1, 3, 4 общие).
+        """
+        profile_types = list(profile_results)
+        if not profile_types:
+            return {}
+        
+        def stage_data(results: List[ProcessingResult], stage: ProcessingStage) -> Dict[str, Any]:
+            result = next((r for r in results if r.stage == stage and r.success), None)
+            return result.data if result else {}
+        
+        def per_profile(dump: Callable[[Any], str]) -> str:
+            return "\n".join(
+                f"            - {p}: Initial Classification: {dump(stage_data(results, ProcessingStage.INITIAL_CLASSIFICATION))}; "
+                f"Confidence Assessment: {dump(stage_data(results, ProcessingStage.CONFIDENCE_ASSESSMENT))}"
+                for p, results in profile_results.items()
+            )
+        
+        shared = profile_results[profile_types[0]]
+        stage = "multi_final_decision"
+        prompt = self._summary_prompt(stage, lambda dump: f"""
+            Make final decisions on website classification for each target profile based on comprehensive 6-stage analysis.
             
-            # Этап 6: Финальное решение
-            final_result = await self._final_decision(self.results, profile_type)
-            self.results.append(final_result)
+            Target Profiles: {', '.join(profile_types)}
+            Website: {stage_data(shared, ProcessingStage.CONTENT_EXTRACTION).get('title', '')}
             
-            processing_time = time.time() - start_time
+            Shared Analysis:
+            - Detailed Analysis: {dump(stage_data(shared, ProcessingStage.DETAILED_ANALYSIS))}
+            - Validation Results: {dump(stage_data(shared, ProcessingStage.CONTEXT_VALIDATION))}
             
-            # Формируем итоговый результат
-            final_data = final_result.data if final_result.success else {}
+            Per-Profile Analysis:
+{per_profile(dump)}
             
-            return {
-                "domain": domain,
-                "url": url,
-                "profile_type": profile_type,
-                "classification": final_data.get("final_classification", "Unknown"),
-                "confidence": final_data.get("confidence", 0),
-                "relevance_score": final_data.get("relevance_score", 0),
-                "decision": final_data.get("decision", "REVIEW"),
-                "comment": final_data.get("reasoning", "Analysis completed"),
-                "processing_time": round(processing_time, 2),
-                "stages_completed": len([r for r in self.results if r.success]),
-                "total_stages": 6,
-                "raw_data": {
-                    "pipeline_results": [r.data for r in self.results if r.success],
-                    "stage_errors": [{"stage": r.stage.value, "error": r.error} for r in self.results if not r.success]
-                }
-            }
+            Make a separate decision for every target profile considering:
+            1. Overall relevance to the profile
+            2. Quality and consistency of analysis
+            3. Confidence level
+            4. Any red flags or concerns
             
+            Return JSON with one entry per profile:
+            {{
+                "profiles": [
+                    {{
+                        "profile_type": "profile name",
+                        "final_classification": "specific classification",
+                        "relevance_score": 0-100,
+                        "confidence": 0-100,
+                        "decision": "ACCEPT|REJECT|REVIEW",
+                        "reasoning": "detailed explanation",
+                        "key_factors": ["factor1", "factor2"],
+                        "recommendations": ["rec1", "rec2"]
+                    }}
+                ]
+            }}
+            """)
+        try:
+            raw_text = await self._generate(stage, prompt, MULTI_DECISION_GENERATION_CONFIG)
+            found = _by_profile(json.loads(raw_text).get("profiles"), profile_types)
         except Exception as e:
-            processing_time = time.time() - start_time
-            return {
-                "domain": domain,
-                "url": url,
-                "profile_type": profile_type,
-                "classification": "Analysis Failed",
-                "confidence": 0,
+            logger.warning(f"Multi-profile decision failed, falling back to per-profile calls: {e}")
+            found = {}
+        
+        results = {p: ProcessingResult(ProcessingStage.FINAL_DECISION, True, found[p]) for p in found}
+        missing = [p for p in profile_types if p not in found]
+        for p, result in zip(missing, await asyncio.gather(
+                *(self._final_decision(profile_results[p], p) for p in missing))):
+            results[p] = result
+        return {p: results[p] for p in profile_types}
+    
+    @staticmethod
+    def _leading_profile(initial: Dict[str, ProcessingResult]) -> ProcessingResult:
+        """Результат этапа 2 профиля с наибольшей релевантностью — вход общих этапов 3 и 4"""
+        def relevance(result: ProcessingResult) -> float:
+            try:
+                return float(result.data.get("relevance_score", 0)) if result.success else -1.0
+            except (TypeError, ValueError):
+                return 0.0
+        return max(initial.values(), key=relevance)
+    
+    async def _run_multi_full_stages(self, content_result: ProcessingResult,
+                                     profile_types: List[str]) -> Dict[str, List[ProcessingResult]]:
+        """Несколько профилей в режиме full: этапы 2 и 6 — по запросу на все профили, 3 и 4 — общие.
+        
+        Этапы 3 и 4 получают классификацию самого релевантного профиля. Профили, прошедшие порог
+        CascadePolicy на этапе 2, получают решение без этапа 6; если прошли все — этапы 3, 4, 6 пропускаются.
+        Спекулятивный запуск этапа 3 в этом режиме не используется.
+        """
+        content_data = content_result.data
+        initial = ProcessingStage.INITIAL_CLASSIFICATION.value
+        detailed = ProcessingStage.DETAILED_ANALYSIS.value
+        validation = ProcessingStage.CONTEXT_VALIDATION.value
+        confidence = ProcessingStage.CONFIDENCE_ASSESSMENT.value
+        final = ProcessingStage.FINAL_DECISION.value
+        scheduler = self.scheduler
+        cascades: Dict[str, Dict[str, Any]] = {}
+        
+        def stages_of(inputs: Dict[str, Any], profile_type: str) -> List[ProcessingResult]:
+            """Результаты этапов 1-5 профиля (пропущенные этапы не учитываются)"""
+            stages = [content_result, inputs[initial][profile_type], inputs[detailed], inputs[validation]]
+            if confidence in inputs:
+                stages.append(inputs[confidence][profile_type])
+            return [r for r in stages if r is not None]
+        
+        # Этап 2: Первичная классификация всех профилей (+ проверка раннего выхода)
+        async def classify(inputs: Dict[str, Any]) -> Dict[str, ProcessingResult]:
+            results = await self._initial_classification_multi(content_data, profile_types)
+            for p, result in results.items():
+                exit_decision = self.cascade.evaluate(result.data) if result.success else None
+                if exit_decision:
+                    cascades[p] = exit_decision
+            if len(cascades) == len(profile_types):
+                scheduler.skip([detailed, validation, final], "cascade: all profiles decided after initial classification")
+            return results
+        
+        scheduler.add(initial, classify)
+        
+        # Этапы 3 и 4: общие для всех профилей
+        scheduler.add(
+            detailed,
+            lambda inputs: self._detailed_analysis(content_data, self._leading_profile(inputs[initial]).data),
+            deps=(initial,),
+        )
+        scheduler.add(
+            validation,
+            lambda inputs: self._context_validation(
+                content_data,
+                [r.data for r in (self._leading_profile(inputs[initial]), inputs[detailed]) if r.success],
+            ),
+            deps=(initial, detailed),
+        )
+        
+        # Этап 5: локально для каждого профиля
+        async def assess(inputs: Dict[str, Any]) -> Dict[str, ProcessingResult]:
+            return {p: await self._confidence_assessment(stages_of(inputs, p)) for p in profile_types}
+        
+        scheduler.add(confidence, assess, deps=(initial, detailed, validation))
+        
+        # Этап 6: профили без раннего выхода одним запросом
+        scheduler.add(
+            final,
+            lambda inputs: self._final_decision_multi(
+                {p: stages_of(inputs, p) for p in profile_types if p not in cascades}
+            ),
+            deps=(initial, detailed, validation, confidence),
+        )
+        
+        outputs = await scheduler.run()
+        decisions = dict(outputs[final] or {})
+        for p, exit_decision in cascades.items():
+            decisions[p] = self._cascade_decision(
+                exit_decision, outputs[initial][p].data, outputs[confidence][p].data, p
+            )
+        return {p: stages_of(outputs, p) + [decisions[p]] for p in profile_types}
+    
+    async def _multi_profile_fused(self, content_data: Dict[str, Any], profile_types: List[str]) -> Dict[str, Any]:
+        """Несколько профилей в режиме fast: общие этапы 3, 4 и этапы 2, 6 каждого профиля одним запросом"""
+        prompt = self._page_prompt("multi_fused", content_data, lambda text, headers: f"""
+        Analyze this website against each of these profiles in one pass: {', '.join(profile_types)}.
+        
+        Website Title: {content_data.get('title', '')}
+        URL: {content_data.get('url', '')}
+        Meta Description: {content_data.get('meta_description', '')}
+        Main Content: {text}
+        Headers: {headers}
+        Links: {len(content_data.get('links', []))} links found
+        
+        Profile Types:
+        - software: Software companies, SaaS platforms, development tools
+        - fintech: Financial technology, payment systems, banking solutions
+        - edtech: Educational technology, online learning platforms
+        - healthtech: Healthcare technology, medical software, telemedicine
+        
+        Fill every section of the response schema:
+        1. detailed_analysis (shared by all profiles): business model, target audience, technology indicators, market position, growth stage, detailed score (0-100)
+        2. context_validation (shared by all profiles): consistency of the evidence, red flags, missing information, evidence quality, validation score (0-100)
+        3. profiles: one entry per requested profile with its profile_type and
+           - initial_classification: relevance to the profile (0-100), primary category, key indicators, confidence (0-100)
+           - final_decision: final classification, relevance score, confidence, ACCEPT|REJECT|REVIEW decision with reasoning, key factors, recommendations
+        """, 3000, 15)
+        
+        raw_text = await self._generate("multi_fused", prompt, MULTI_FUSED_GENERATION_CONFIG)
+        result = json.loads(raw_text)
+        for section in ("detailed_analysis", "context_validation"):
+            if not isinstance(result.get(section), dict):
+                raise ValueError(f"Fused response missing section: {section}")
+        profiles = _by_profile(result.get("profiles"), profile_types)
+        for p in profile_types:
+            entry = profiles.get(p) or {}
+            if not all(isinstance(entry.get(s), dict) for s in ("initial_classification", "final_decision")):
+                raise ValueError(f"Fused response missing profile: {p}")
+        result["profiles"] = profiles
+        return result
+    
+    async def _run_multi_fused_stages(self, content_result: ProcessingResult,
+                                      profile_types: List[str]) -> Optional[Dict[str, List[ProcessingResult]]]:
+        """Несколько профилей в режиме fast; None — ответ не разобран"""
+        try:
+            fused = await self.scheduler.timed("fused", self._multi_profile_fused(content_result.data, profile_types))
+        except Exception:
+            return None
+        
+        detailed = ProcessingResult(ProcessingStage.DETAILED_ANALYSIS, True, fused["detailed_analysis"])
+        validation = ProcessingResult(ProcessingStage.CONTEXT_VALIDATION, True, fused["context_validation"])
+        per_profile: Dict[str, List[ProcessingResult]] = {}
+        for p in profile_types:
+            sections = fused["profiles"][p]
+            stages = [content_result,
+                      ProcessingResult(ProcessingStage.INITIAL_CLASSIFICATION, True, sections["initial_classification"]),
+                      detailed, validation]
+            stages.append(await self._confidence_assessment(stages))
+            stages.append(ProcessingResult(ProcessingStage.FINAL_DECISION, True, sections["final_decision"]))
+            per_profile[p] = stages
+        return per_profile
+    
+    def _reset_run(self, on_result: Optional[Callable[[ProcessingResult], Any]] = None):
+        """Сброс состояния перед новым анализом"""
+        self._on_result = on_result
+        self.results = []
+        self.page_cache_stats = {"hits": 0, "misses": 0, "revalidated": 0}
+        self.llm_cache_stats = {"hits": 0, "misses": 0}
+        self.speculation = None
+        self.prompt_stats = {}
+        self._prompt_saved = {}
+        self._page = None
+        self.scheduler = StageScheduler()
+    
+    def _result_payload(self, url: str, domain: str, profile_type: str, results: List[ProcessingResult],
+                        start_time: float, executed_mode: PipelineMode) -> Dict[str, Any]:
+        """Итоговый результат анализа по результатам этапов (последний — финальное решение)"""
+        final_result = results[-1]
+        final_data = final_result.data if final_result.success else {}
+        return {
+            "domain": domain,
+            "url": url,
+            "profile_type": profile_type,
+            "classification": final_data.get("final_classification", "Unknown"),
+            "confidence": final_data.get("confidence", 0),
+            "relevance_score": final_data.get("relevance_score", 0),
+            "decision": final_data.get("decision", "REVIEW"),
+            "comment": final_data.get("reasoning", "Analysis completed"),
+            "processing_time": round(time.time() - start_time, 2),
+            "stages_completed": len([r for r in results if r.success]),
+            "total_stages": 6,
+            "raw_data": {
+                "pipeline_results": [r.data for r in results if r.success],
+                "stage_errors": [{"stage": r.stage.value, "error": r.error} for r in results if not r.success],
+                "page_cache": dict(self.page_cache_stats),
+                "llm_cache": dict(self.llm_cache_stats),
+                "mode": executed_mode.value,
+                "stage_timings": self.scheduler.timings,
+                "speculation": self.speculation,
+                "skipped_stages": [{"stage": name, "reason": reason} for name, reason in self.scheduler.skipped.items()],
+                "concurrency": self._concurrency_limits(),
+                "quota": dict(self.quota_stats),
+                "prompt_tokens": self.prompt_stats
+            }
+        }
+    
+    def _error_payload(self, url: str, domain: str, profile_type: str, error: Exception,
+                       start_time: float) -> Dict[str, Any]:
+        """Результат анализа, прерванного ошибкой"""
+        return {
+            "domain": domain,
+            "url": url,
+            "profile_type": profile_type,
+            "classification": "Analysis Failed",
+            "confidence": 0,
+            "relevance_score": 0,
+            "decision": "REJECT",
+            "comment": f"Pipeline error: {str(error)}",
+            "processing_time": round(time.time() - start_time, 2),
+            "stages_completed": len([r for r in self.results if r.success]),
+            "total_stages": 6,
+            "raw_data": {
+                "error": str(error),
+                "pipeline_results": [r.data for r in self.results if r.success],
+                "page_cache": dict(self.page_cache_stats),
+                "llm_cache": dict(self.llm_cache_stats),
+                "stage_timings": self.scheduler.timings,
+                "concurrency": self._concurrency_limits()
+            }
+        }
+    
+    async def _run_extraction(self, url: str) -> ProcessingResult:
+        """Этап 1 с публикацией результата; неудача прерывает анализ"""
+        content_result = await self.scheduler.timed(
+            ProcessingStage.CONTENT_EXTRACTION.value, self._extract_content(url)
+        )
+        self.results.append(content_result)
+        self._emit(content_result)
+        
+        if not content_result.success:
+            raise Exception(f"Content extraction failed: {content_result.error}")
+        return content_result
+    
+    async def _prefilter_verdicts(self, content_data: Dict[str, Any],
+                                  profile_types: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Профили, которые локальный классификатор отсекает до этапа 2: {профиль: вердикт}"""
+        verdicts = {}
+        for p in profile_types:
+            try:
+                verdict = self.prefilter.evaluate(content_data, p)
+            except Exception as e:
+                logger.warning(f"Pre-classifier failed for {p}: {e}")
+                continue
+            if verdict:
+                verdicts[p] = verdict
+        return verdicts
+    
+    def _skip_llm_stages(self, reason: str):
+        """Этапы, обращающиеся к LLM, отмечаются пропущенными (skipped_stages результата)"""
+        self.scheduler.skip([ProcessingStage.INITIAL_CLASSIFICATION.value, ProcessingStage.DETAILED_ANALYSIS.value,
+                             ProcessingStage.CONTEXT_VALIDATION.value, ProcessingStage.FINAL_DECISION.value], reason)
+    
+    async def _prefilter_results(self, content_result: ProcessingResult, profile_type: str,
+                                 verdict: Dict[str, Any]) -> List[ProcessingResult]:
+        """Этапы 2, 5 и 6 отсеянного профиля без обращения к LLM (этапы 3 и 4 пропускаются)"""
+        reason = f"pre-classifier score {verdict['score']:g} <= threshold {verdict['threshold']:g}"
+        initial = ProcessingResult(
+            stage=ProcessingStage.INITIAL_CLASSIFICATION,
+            success=True,
+            data={
+                "relevance_score": 0,
+                "primary_category": f"Not {profile_type}",
+                "key_indicators": [],
+                "confidence": round(verdict["precision"] * 100),
+                "reasoning": f"Rejected by local pre-classifier: {reason}",
+                "prefilter": verdict,
+            }
+        )
+        self._emit(initial)
+        confidence = await self._confidence_assessment([content_result, initial])
+        self._emit(confidence)
+        final = ProcessingResult(
+            stage=ProcessingStage.FINAL_DECISION,
+            success=True,
+            data={
+                "final_classification": f"Not {profile_type}",
                 "relevance_score": 0,
+                "confidence": confidence.data.get("final_confidence", initial.data["confidence"]),
                 "decision": "REJECT",
-                "comment": f"Pipeline error: {str(e)}",
-                "processing_time": round(processing_time, 2),
-                "stages_completed": len([r for r in self.results if r.success]),
-                "total_stages": 6,
-                "raw_data": {
-                    "error": str(e),
-                    "pipeline_results": [r.data for r in self.results if r.success]
-                }
+                "reasoning": f"Rejected by local pre-classifier before LLM analysis: {reason}",
+                "key_factors": [],
+                "recommendations": [],
+                "prefilter": True,
             }
+        )
+        self._emit(final)
+        return [content_result, initial, confidence, final]
+    
+    async def analyze_website(self, url: str, domain: str, profile_type: str,
+                              mode: PipelineMode = PipelineMode.FULL,
+                              on_result: Optional[Callable[[ProcessingResult], Any]] = None) -> Dict[str, Any]:
+        """Запуск 6-этапного анализа (mode=FAST — этапы 2, 3, 4, 6 одним запросом).
+        
+        Явные несовпадения по локальному классификатору (prefilter) получают REJECT сразу после этапа 1.
+        
+        on_result вызывается с каждым ProcessingResult сразу по завершении этапа.
+        """
+        start_time = time.time()
+        mode = PipelineMode(mode)
+        self._reset_run(on_result)
+        
+        try:
+            # Этап 1: Извлечение контента
+            content_result = await self._run_extraction(url)
+            
+            # Явное несовпадение по локальному классификатору — REJECT без обращения к LLM
+            executed_mode = mode
+            verdicts = await self.scheduler.timed("prefilter", self._prefilter_verdicts(content_result.data, [profile_type]))
+            if profile_type in verdicts:
+                self.results = await self._prefilter_results(content_result, profile_type, verdicts[profile_type])
+                self._skip_llm_stages(f"pre-classifier REJECT (score {verdicts[profile_type]['score']:g})")
+                return self._result_payload(url, domain, profile_type, self.results, start_time, executed_mode)
+            
+            # Этапы 2-6: один структурированный запрос или последовательная цепочка
+            if mode == PipelineMode.FAST and not await self._run_fused_stages(content_result.data, profile_type):
+                # Ответ не разобран — откатываемся на полный режим
+                executed_mode = PipelineMode.FULL
+            if executed_mode == PipelineMode.FULL:
+                await self._run_full_stages(content_result.data, profile_type)
+            
+            # Формируем итоговый результат
+            return self._result_payload(url, domain, profile_type, self.results, start_time, executed_mode)
+            
+        except Exception as e:
+            return self._error_payload(url, domain, profile_type, e, start_time)
+    
+    async def analyze_website_stream(self, url: str, domain: str, profile_type: str,
+                                     mode: PipelineMode = PipelineMode.FULL
+                                     ) -> AsyncIterator[Union[ProcessingResult, Dict[str, Any]]]:
+        """Анализ как асинхронный поток: ProcessingResult каждого этапа, итоговый словарь последним.
+        
+        Если потребитель прекращает чтение, анализ отменяется.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        task = asyncio.create_task(self.analyze_website(url, domain, profile_type, mode, on_result=queue.put_nowait))
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                yield item
+            yield task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+    
+    async def analyze_website_profiles(self, url: str, domain: str, profile_types: List[str],
+                                       mode: PipelineMode = PipelineMode.FULL) -> Dict[str, Any]:
+        """Анализ сайта для нескольких профилей: одна загрузка и извлечение, общие этапы 3 и 4.
+        
+        Этапы 2 и 6 всех профилей выполняются одним запросом каждый (mode=FAST — все этапы одним
+        запросом); профили, пропавшие из ответа LLM, досчитываются отдельными запросами.
+        Профили, отсеянные локальным классификатором, получают REJECT без LLM.
+        Результат: {"profiles": {профиль: результат в формате analyze_website}, ...}.
+        """
+        profile_types = list(dict.fromkeys(profile_types))
+        if not profile_types:
+            raise ValueError("At least one profile type is required")
+        if len(profile_types) == 1:
+            result = await self.analyze_website(url, domain, profile_types[0], mode)
+            return {"domain": domain, "url": url, "profile_types": profile_types,
+                    "processing_time": result["processing_time"], "profiles": {profile_types[0]: result}}
+        
+        start_time = time.time()
+        mode = PipelineMode(mode)
+        self._reset_run()
+        
+        try:
+            content_result = await self._run_extraction(url)
+            
+            # Профили, отсеянные локальным классификатором, в запросы к LLM не попадают
+            verdicts = await self.scheduler.timed("prefilter", self._prefilter_verdicts(content_result.data, profile_types))
+            remaining = [p for p in profile_types if p not in verdicts]
+            
+            executed_mode = mode
+            per_profile = None
+            if len(remaining) == 1:
+                # Один профиль — обычная цепочка этапов (результаты в self.results)
+                if mode == PipelineMode.FAST and not await self._run_fused_stages(content_result.data, remaining[0]):
+                    executed_mode = PipelineMode.FULL
+                if executed_mode == PipelineMode.FULL:
+                    await self._run_full_stages(content_result.data, remaining[0])
+                per_profile = {remaining[0]: list(self.results)}
+            elif remaining and mode == PipelineMode.FAST:
+                per_profile = await self._run_multi_fused_stages(content_result, remaining)
+                if per_profile is None:
+                    # Ответ не разобран — откатываемся на полный режим
+                    executed_mode = PipelineMode.FULL
+            if per_profile is None:
+                per_profile = await self._run_multi_full_stages(content_result, remaining) if remaining else {}
+            if not remaining:
+                self._skip_llm_stages("pre-classifier REJECT for all profiles")
+            for p, verdict in verdicts.items():
+                per_profile[p] = await self._prefilter_results(content_result, p, verdict)
+            per_profile = {p: per_profile[p] for p in profile_types}
+            
+            profiles = {}
+            for p, results in per_profile.items():
+                profiles[p] = self._result_payload(url, domain, p, results, start_time, executed_mode)
+                profiles[p]["raw_data"]["multi_profile"] = {
+                    "profile_types": profile_types,
+                    "shared_stages": [ProcessingStage.CONTENT_EXTRACTION.value, ProcessingStage.DETAILED_ANALYSIS.value,
+                                      ProcessingStage.CONTEXT_VALIDATION.value],
+                    "prefiltered": sorted(verdicts),
+                }
+        except Exception as e:
+            profiles = {p: self._error_payload(url, domain, p, e, start_time) for p in profile_types}
+        
+        return {
+            "domain": domain,
+            "url": url,
+            "profile_types": profile_types,
+            "processing_time": round(time.time() - start_time, 2),
+            "profiles": profiles,
+        }
@@ -0,0 +1,237 @@
+"""
+Локальная проверка JWT Supabase
+Подпись проверяется секретом проекта (HS256) или ключами JWKS (RS256/ES256) без запроса к Auth;
+проверенные claims кэшируются до истечения токена, роли из profiles — в TTL-кэше
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+try:
+    import jwt
+except ImportError:  # PyJWT опционален: без него токены проверяются запросом к Supabase Auth
+    jwt = None
+
+logger = logging.getLogger(__name__)
+
+# Допустимые алгоритмы: подпись секретом проекта и асимметричные ключи JWKS ("none" и смешение исключены)
+SECRET_ALGORITHMS = ("HS256", "HS384", "HS512")
+JWKS_ALGORITHMS = ("RS256", "RS384", "RS512", "ES256", "ES384", "ES512", "EdDSA")
+
+
+class InvalidToken(Exception):
+    """Токен не прошел проверку подписи или срока действия"""
+
+
+class TokenVerifier:
+    """Проверка access-токенов Supabase и кэши claims/ролей процесса.
+
+    verify() возвращает None, если локальная проверка невозможна (нет секрета и JWKS, нет PyJWT) —
+    тогда вызывающий проверяет токен в Supabase Auth и кладет результат в кэш через remember().
+    Последний успешно загруженный JWKS используется и при недоступности Supabase.
+
+    ENV:
+      AUTH_LOCAL_VERIFY       — проверять токены локально (true)
+      SUPABASE_JWT_SECRET     — секрет проекта для HS256
+      SUPABASE_JWKS_URL       — адрес JWKS ({SUPABASE_URL}/auth/v1/.well-known/jwks.json)
+      AUTH_JWT_AUDIENCE       — ожидаемый aud (authenticated)
+      AUTH_JWKS_TTL           — время жизни JWKS, сек (600)
+      AUTH_JWKS_MIN_REFRESH   — минимальный интервал внеочередной загрузки JWKS при неизвестном kid, сек (30)
+      AUTH_CLAIMS_CACHE_MAX   — лимит записей кэша claims (10000)
+      AUTH_ROLE_TTL           — время жизни роли в кэше, сек (300)
+    """
+
+    def __init__(self, http_getter: Callable[[], Any]):
+        self.http_getter = http_getter
+        self.enabled = os.getenv("AUTH_LOCAL_VERIFY", "true").lower() == "true" and jwt is not None
+        self.secret = os.getenv("SUPABASE_JWT_SECRET")
+        supabase_url = (os.getenv("SUPABASE_URL") or "").rstrip("/")
+        self.jwks_url = os.getenv("SUPABASE_JWKS_URL") or (
+            f"{supabase_url}/auth/v1/.well-known/jwks.json" if supabase_url else None
+        )
+        self.audience = os.getenv("AUTH_JWT_AUDIENCE", "authenticated")
+        self.jwks_ttl = float(os.getenv("AUTH_JWKS_TTL", "600"))
+        self.jwks_min_refresh = float(os.getenv("AUTH_JWKS_MIN_REFRESH", "30"))
+        self.claims_max = int(os.getenv("AUTH_CLAIMS_CACHE_MAX", "10000"))
+        self.role_ttl = float(os.getenv("AUTH_ROLE_TTL", "300"))
+        self.stats = {"claims_hits": 0, "local_verified": 0, "remote_verified": 0, "jwks_loads": 0,
+                      "role_hits": 0, "role_loads": 0}
+        # sha256(token) -> (exp, claims)
+        self._claims: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        # user_id -> (истекает, роль)
+        self._roles: Dict[str, Tuple[float, str]] = {}
+        self._jwks: Dict[str, Any] = {}
+        self._jwks_loaded_at = 0.0
+        self._jwks_lock: Optional[asyncio.Lock] = None
+
+    # --- кэш claims ---
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def cached(self, token: str) -> Optional[Dict[str, Any]]:
+        key = self._key(token)
+        entry = self._claims.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self._claims[key]
+            return None
+        self._claims.move_to_end(key)
+        self.stats["claims_hits"] += 1
+        return entry[1]
+
+    def remember(self, token: str, claims: Dict[str, Any], expires_at: Optional[float] = None):
+        """Кэширование проверенных claims до exp (без exp — не дольше AUTH_ROLE_TTL)"""
+        exp = expires_at or claims.get("exp") or (time.time() + self.role_ttl)
+        key = self._key(token)
+        self._claims[key] = (float(exp), claims)
+        self._claims.move_to_end(key)
+        while len(self._claims) > self.claims_max:
+            self._claims.popitem(last=False)
+
+    def known_user(self, token: str) -> Tuple[Optional[str], Optional[str]]:
+        """(user_id, роль) уже проверенного токена без проверки и загрузок; (None, None) — неизвестен"""
+        entry = self._claims.get(self._key(token))
+        if entry is None or entry[0] <= time.time():
+            return None, None
+        user_id = entry[1].get("sub")
+        role = self._roles.get(user_id)
+        return user_id, (role[1] if role else None)
+
+    def unverified_exp(self, token: str) -> Optional[float]:
+        """exp из токена без проверки подписи — для кэширования ответа Supabase Auth"""
+        if jwt is None:
+            return None
+        try:
+            exp = jwt.decode(token, options={"verify_signature": False}).get("exp")
+        except jwt.PyJWTError:
+            return None
+        return float(exp) if exp else None
+
+    # --- ключи ---
+
+    async def _load_jwks(self, force: bool = False) -> bool:
+        if not self.jwks_url:
+            return False
+        if self._jwks_lock is None:
+            self._jwks_lock = asyncio.Lock()
+        async with self._jwks_lock:
+            age = time.time() - self._jwks_loaded_at
+            # Без ключей (прошлая загрузка не удалась) повтор не чаще AUTH_JWKS_MIN_REFRESH
+            if age < (self.jwks_min_refresh if force or not self._jwks else self.jwks_ttl):
+                return bool(self._jwks)
+            try:
+                res = await self.http_getter().get(self.jwks_url, timeout=5.0)
+                res.raise_for_status()
+                keys = {}
+                for jwk in jwt.PyJWKSet.from_dict(res.json()).keys:
+                    keys[jwk.key_id] = jwk.key
+                self._jwks = keys
+                self.stats["jwks_loads"] += 1
+            except Exception as e:
+                # Supabase недоступен — продолжаем со старыми ключами
+                logger.warning(f"JWKS refresh failed: {e}")
+            self._jwks_loaded_at = time.time()
+            return bool(self._jwks)
+
+    async def _signing_key(self, header: Dict[str, Any]) -> Optional[Any]:
+        alg = header.get("alg", "")
+        if alg in SECRET_ALGORITHMS:
+            return self.secret
+        if alg not in JWKS_ALGORITHMS:
+            raise InvalidToken(f"Unsupported token algorithm: {alg}")
+        if not await self._load_jwks():
+            return None
+        kid = header.get("kid")
+        key = self._jwks.get(kid)
+        if key is None and await self._load_jwks(force=True):
+            # Ротация ключей: неизвестный kid — перечитываем JWKS (не чаще AUTH_JWKS_MIN_REFRESH)
+            key = self._jwks.get(kid)
+        if key is None:
+            raise InvalidToken(f"Unknown signing key: {kid}")
+        return key
+
+    # --- проверка ---
+
+    async def verify(self, token: str) -> Optional[Dict[str, Any]]:
+        """Claims проверенного токена; None — локальная проверка недоступна"""
+        claims = self.cached(token)
+        if claims is not None:
+            return claims
+        if not self.enabled:
+            return None
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.PyJWTError as e:
+            raise InvalidToken(str(e))
+        key = await self._signing_key(header)
+        if key is None:
+            return None
+        try:
+            claims = jwt.decode(
+                token, key, algorithms=[header.get("alg")], audience=self.audience,
+                options={"require": ["exp", "sub"]},
+            )
+        except jwt.PyJWTError as e:
+            raise InvalidToken(str(e))
+        self.stats["local_verified"] += 1
+        self.remember(token, claims)
+        return claims
+
+    # --- роли ---
+
+    async def role(self, user_id: str, loader: Callable[[str], Awaitable[Optional[str]]],
+                   default: str = "user") -> str:
+        """Роль пользователя из кэша или loader; при ошибке loader — устаревшее значение, если есть"""
+        now = time.time()
+        entry = self._roles.get(user_id)
+        if entry and entry[0] > now:
+            self.stats["role_hits"] += 1
+            return entry[1]
+        try:
+            role = await loader(user_id) or default
+        except Exception as e:
+            if entry:
+                logger.warning(f"Role lookup failed for {user_id}, using cached role: {e}")
+                return entry[1]
+            raise
+        self.stats["role_loads"] += 1
+        if len(self._roles) >= self.claims_max:
+            self._roles = {u: e for u, e in self._roles.items() if e[0] > now}
+        self._roles[user_id] = (now + self.role_ttl, role)
+        return role
+
+    def invalidate_role(self, user_id: Optional[str] = None):
+        """Сброс кэша ролей (одного пользователя или всех)"""
+        if user_id is None:
+            self._roles.clear()
+        else:
+            self._roles.pop(user_id, None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "local": self.enabled,
+            "claims_cached": len(self._claims),
+            "roles_cached": len(self._roles),
+            "jwks_keys": len(self._jwks),
+            **self.stats,
+        }
+
+
+_token_verifier: Optional[TokenVerifier] = None
+
+
+def get_token_verifier() -> TokenVerifier:
+    """Глобальный verifier процесса (ENV читается при первом обращении)"""
+    global _token_verifier
+    if _token_verifier is None:
+        from http_clients import http_clients
+        _token_verifier = TokenVerifier(lambda: http_clients.supabase)
+    return _token_verifier
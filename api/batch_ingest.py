@@ -0,0 +1,208 @@
+"""
+Потоковый разбор загрузки доменов для батч-анализа
+CSV или NDJSON читается по мере поступления тела запроса и отдается пачками фиксированного размера,
+поэтому память не зависит от размера файла
+"""
+
+import codecs
+import csv
+import json
+import logging
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from fetch_scheduler import url_host
+
+logger = logging.getLogger(__name__)
+
+INGEST_FORMATS = ("csv", "ndjson")
+
+# Допустимые профили — CHECK-ограничение analyses.profile_type (supabase/schema.sql)
+PROFILE_TYPES = frozenset([
+    "software", "iso", "telemedicine", "pharma", "edtech", "marketing",
+    "fintech", "healthtech", "elearning", "software_products",
+    "salesforce_partner", "hubspot_partner", "aws", "shopify",
+    "ai_companies", "mobile_app", "recruiting", "banking", "platforms",
+])
+
+# Имена колонок CSV (без учета регистра); без заголовка — url[,domain[,profile_type]]
+_URL_COLUMNS = ("url", "website", "site")
+_DOMAIN_COLUMNS = ("domain", "host")
+_PROFILE_COLUMNS = ("profile_type", "profile")
+
+
+class IngestStats:
+    """Счетчики разбора загрузки"""
+    def __init__(self):
+        self.lines = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.errors: List[str] = []
+
+    def reject(self, line: int, reason: str):
+        self.rejected += 1
+        if len(self.errors) < 20:
+            self.errors.append(f"line {line}: {reason}")
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"lines": self.lines, "accepted": self.accepted, "rejected": self.rejected, "errors": self.errors}
+
+
+def detect_format(content_type: Optional[str], fmt: Optional[str] = None) -> str:
+    if fmt:
+        if fmt not in INGEST_FORMATS:
+            raise ValueError(f"Unsupported upload format: {fmt}")
+        return fmt
+    content_type = (content_type or "").lower()
+    if "ndjson" in content_type or "jsonl" in content_type or "json" in content_type:
+        return "ndjson"
+    return "csv"
+
+
+def normalize_record(url: Optional[str], domain: Optional[str], profile_type: Optional[str],
+                     default_profile: str) -> Optional[Dict[str, str]]:
+    """url/domain записи: недостающее поле восстанавливается из другого; None — нет url и domain.
+
+    Неизвестный profile_type — ValueError (строка не прошла бы CHECK-ограничение analyses).
+    """
+    profile_type = (profile_type or "").strip() or default_profile
+    if profile_type not in PROFILE_TYPES:
+        raise ValueError(f"unknown profile_type: {profile_type[:50]}")
+    url = (url or "").strip()
+    domain = (domain or "").strip().lower()
+    if not url and not domain:
+        return None
+    if not url:
+        url = f"https://{domain}"
+    elif "://" not in url:
+        url = f"https://{url}"
+    if not domain:
+        domain = url_host(url)
+    if not domain or " " in domain:
+        return None
+    return {"url": url, "domain": domain, "profile_type": profile_type}
+
+
+async def iter_lines(chunks: AsyncIterator[bytes], max_line: int) -> AsyncIterator[str]:
+    """Строки потока в UTF-8 (BOM отбрасывается); слишком длинная строка — ValueError"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+        if len(buffer) > max_line:
+            raise ValueError(f"Line longer than {max_line} characters")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+class RecordReader:
+    """Записи {url, domain, profile_type} из CSV/NDJSON пачками по chunk_size.
+
+    ENV:
+      BATCH_INGEST_CHUNK     — размер пачки записи в session_domains и очередь (500)
+      BATCH_INGEST_MAX_LINE  — максимальная длина строки (и записи CSV с переводами строк в кавычках), символов (8192)
+    """
+
+    def __init__(self, fmt: str, default_profile: str, chunk_size: Optional[int] = None,
+                 max_line: Optional[int] = None):
+        self.fmt = fmt
+        self.default_profile = default_profile
+        self.chunk_size = chunk_size or int(os.getenv("BATCH_INGEST_CHUNK", "500"))
+        self.max_line = max_line or int(os.getenv("BATCH_INGEST_MAX_LINE", "8192"))
+        self.stats = IngestStats()
+        self._columns: Optional[Dict[str, int]] = None
+
+    def _csv_record(self, line: str) -> Optional[Dict[str, str]]:
+        row = next(csv.reader([line]), [])
+        if not row or all(not cell.strip() for cell in row):
+            return None
+        if self._columns is None:
+            header = [cell.strip().lower() for cell in row]
+            columns = {}
+            for field, names in (("url", _URL_COLUMNS), ("domain", _DOMAIN_COLUMNS), ("profile_type", _PROFILE_COLUMNS)):
+                for i, name in enumerate(header):
+                    if name in names:
+                        columns[field] = i
+                        break
+            if columns:
+                self._columns = columns
+                return None
+            self._columns = {"url": 0, "domain": 1, "profile_type": 2}
+
+        def cell(field: str) -> Optional[str]:
+            index = self._columns.get(field)
+            return row[index] if index is not None and index < len(row) else None
+
+        return {"url": cell("url"), "domain": cell("domain"), "profile_type": cell("profile_type")}
+
+    def _ndjson_record(self, line: str) -> Optional[Dict[str, str]]:
+        if not line.strip():
+            return None
+        item = json.loads(line)
+        if isinstance(item, str):
+            return {"url": None, "domain": item, "profile_type": None}
+        if not isinstance(item, dict):
+            raise ValueError("expected object or string")
+        record = {field: item.get(field) for field in ("url", "domain", "profile_type")}
+        for field, value in record.items():
+            if value is not None and not isinstance(value, str):
+                raise ValueError(f"{field} must be a string")
+        return record
+
+    async def _csv_records(self, lines: AsyncIterator[str]) -> AsyncIterator[tuple]:
+        """Логические записи CSV (номер первой строки, текст): поле в кавычках может содержать переводы строк"""
+        pending: List[str] = []
+        start = 0
+        quotes = 0
+        async for line in lines:
+            self.stats.lines += 1
+            if not pending:
+                start = self.stats.lines
+            pending.append(line)
+            # Кавычки внутри поля удваиваются, поэтому нечетное число — поле еще не закрыто
+            quotes += line.count('"')
+            if quotes % 2:
+                if sum(len(part) + 1 for part in pending) > self.max_line:
+                    raise ValueError(f"Record longer than {self.max_line} characters")
+                continue
+            yield start, "\n".join(pending)
+            pending, quotes = [], 0
+        if pending:
+            yield start, "\n".join(pending)
+
+    async def _ndjson_records(self, lines: AsyncIterator[str]) -> AsyncIterator[tuple]:
+        async for line in lines:
+            self.stats.lines += 1
+            yield self.stats.lines, line
+
+    async def chunks(self, body: AsyncIterator[bytes]) -> AsyncIterator[List[Dict[str, str]]]:
+        lines = iter_lines(body, self.max_line)
+        if self.fmt == "csv":
+            parse, records = self._csv_record, self._csv_records(lines)
+        else:
+            parse, records = self._ndjson_record, self._ndjson_records(lines)
+        chunk: List[Dict[str, str]] = []
+        async for line_number, text in records:
+            # Ошибка одной записи отклоняет только ее, а не всю загрузку
+            try:
+                raw = parse(text)
+                if raw is None:
+                    continue
+                record = normalize_record(raw["url"], raw["domain"], raw["profile_type"], self.default_profile)
+            except (ValueError, TypeError, AttributeError, csv.Error) as e:
+                self.stats.reject(line_number, str(e))
+                continue
+            if record is None:
+                self.stats.reject(line_number, "missing url/domain")
+                continue
+            self.stats.accepted += 1
+            chunk.append(record)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
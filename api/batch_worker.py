@@ -0,0 +1,152 @@
+"""
+Воркер очереди батч-анализа
+Запускается внутри web-процесса (BATCH_WORKER_MODE=embedded) или отдельными процессами:
+
+    python batch_worker.py
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from job_queue import Job, JobQueue, get_job_queue
+
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[Any]]
+FailedHandler = Callable[[Dict[str, Any], str], Awaitable[Any]]
+SessionHandler = Callable[[str], Awaitable[Any]]
+
+
+class BatchWorker:
+    """Потребитель очереди: берет задачи в аренду, продлевает аренду, подтверждает результат.
+
+    Число одновременно выполняемых задач задает capacity() (например, по адаптивным лимитам
+    загрузки и LLM), но не больше concurrency.
+
+    ENV:
+      BATCH_WORKER_CONCURRENCY    — верхняя граница одновременно выполняемых задач (64)
+      BATCH_WORKER_POLL_INTERVAL  — пауза опроса пустой очереди, сек (1.0)
+    """
+
+    def __init__(self, handler: JobHandler, queue: Optional[JobQueue] = None,
+                 on_failed: Optional[FailedHandler] = None, on_session_done: Optional[SessionHandler] = None,
+                 concurrency: Optional[int] = None, owner: Optional[str] = None,
+                 capacity: Optional[Callable[[], int]] = None):
+        self.handler = handler
+        self.queue = queue or get_job_queue()
+        self.on_failed = on_failed
+        self.on_session_done = on_session_done
+        self.concurrency = concurrency or int(os.getenv("BATCH_WORKER_CONCURRENCY", "64"))
+        self.capacity = capacity
+        self.poll_interval = float(os.getenv("BATCH_WORKER_POLL_INTERVAL", "1.0"))
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._active: Dict[asyncio.Task, Job] = {}
+
+    def _current_concurrency(self) -> int:
+        if self.capacity is None:
+            return self.concurrency
+        return max(1, min(self.concurrency, self.capacity()))
+
+    async def _heartbeat(self):
+        """Продление аренды выполняющихся задач"""
+        while True:
+            await asyncio.sleep(max(1.0, self.queue.lease_seconds / 3))
+            try:
+                await self.queue.extend([job.id for job in self._active.values()], self.owner)
+            except Exception as e:
+                logger.warning(f"Job lease extension failed: {e}")
+
+    async def _finalize_session(self, session_id: Optional[str]):
+        if not session_id or not self.on_session_done:
+            return
+        if await self.queue.is_drained(session_id):
+            await self.on_session_done(session_id)
+
+    async def _process(self, job: Job):
+        try:
+            if job.attempts > self.queue.max_attempts:
+                # Задача повторно осталась без подтверждения (воркер падал на ней) — больше не пробуем
+                error = f"Job abandoned after {job.attempts - 1} attempts"
+                await self.queue.fail(job, error)
+                if self.on_failed:
+                    await self.on_failed(job.payload, error)
+            else:
+                try:
+                    await self.handler(job.payload)
+                except asyncio.CancelledError:
+                    await self.queue.requeue(job)
+                    raise
+                except Exception as e:
+                    logger.warning(f"Job {job.id} failed (attempt {job.attempts}): {e}")
+                    status = await self.queue.release(job, str(e))
+                    if status == "failed" and self.on_failed:
+                        await self.on_failed(job.payload, str(e))
+                else:
+                    await self.queue.ack(job)
+            await self._finalize_session(job.session_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Job {job.id} bookkeeping failed: {e}")
+
+    async def run(self, stop: asyncio.Event):
+        """Цикл опроса до установки stop; прерванные задачи возвращаются в очередь"""
+        logger.info("Batch worker %s started (max concurrency=%d)", self.owner, self.concurrency)
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            while not stop.is_set():
+                free = self._current_concurrency() - len(self._active)
+                jobs = []
+                if free > 0:
+                    try:
+                        jobs = await self.queue.lease(self.owner, free)
+                    except Exception as e:
+                        logger.warning(f"Job lease failed: {e}")
+                for job in jobs:
+                    self._active[asyncio.create_task(self._process(job))] = job
+
+                waiters = set(self._active)
+                stop_waiter = asyncio.create_task(stop.wait())
+                waiters.add(stop_waiter)
+                # Полный пул — ждем завершения задачи; иначе опрашиваем очередь с интервалом
+                timeout = None if free - len(jobs) <= 0 else (0 if jobs else self.poll_interval)
+                done, _ = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                stop_waiter.cancel()
+                for task in done:
+                    self._active.pop(task, None)
+        finally:
+            heartbeat.cancel()
+            for task in self._active:
+                task.cancel()
+            if self._active:
+                await asyncio.gather(*self._active, return_exceptions=True)
+            self._active.clear()
+            logger.info("Batch worker %s stopped", self.owner)
+
+
+async def _run_standalone():
+    # Обработчики задач и инициализация клиентов — общие с web-приложением
+    import main as api
+
+    await api.init_runtime()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    try:
+        await api.resume_pending_sessions()
+        await api.build_batch_worker().run(stop)
+    finally:
+        await api.shutdown_runtime()
+
+
+if __name__ == "__main__":
+    asyncio.run(_run_standalone())
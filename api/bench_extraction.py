@@ -0,0 +1,98 @@
+"""
+Бенчмарк этапа 1: прежнее извлечение на BeautifulSoup против однопроходного движка
+Корпус — каталог с *.html или SQLite-файл кэша страниц (page_cache)
+
+Примеры:
+    python bench_extraction.py --corpus ./corpus
+    python bench_extraction.py --page-cache .cache/pages.sqlite --repeat 3
+"""
+
+import argparse
+import glob
+import os
+import sqlite3
+import statistics
+import sys
+import time
+import zlib
+from typing import Callable, Dict, List, Tuple
+
+from html_extraction import etree, extract_content_data, extract_content_data_legacy
+
+
+def load_directory(path: str, limit: int) -> List[Tuple[str, str]]:
+    corpus = []
+    for file_path in sorted(glob.glob(os.path.join(path, "**", "*.htm*"), recursive=True))[:limit or None]:
+        with open(file_path, "rb") as f:
+            corpus.append((file_path, f.read().decode("utf-8", errors="replace")))
+    return corpus
+
+
+def load_page_cache(path: str, limit: int) -> List[Tuple[str, str]]:
+    conn = sqlite3.connect(path)
+    query = "SELECT key, body, encoding FROM pages ORDER BY key"
+    if limit:
+        query += f" LIMIT {int(limit)}"
+    corpus = [
+        (key, zlib.decompress(body).decode(encoding or "utf-8", errors="replace"))
+        for key, body, encoding in conn.execute(query)
+    ]
+    conn.close()
+    return corpus
+
+
+def run(name: str, func: Callable[[str], Dict], corpus: List[Tuple[str, str]], repeat: int):
+    timings = []
+    outputs = []
+    for _, html in corpus:
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = func(html)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        timings.append(best)
+        outputs.append(result)
+    return name, timings, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--corpus", help="Каталог с HTML-файлами")
+    source.add_argument("--page-cache", help="SQLite-файл кэша страниц")
+    parser.add_argument("--repeat", type=int, default=1, help="Повторов на страницу (берется лучшее время)")
+    parser.add_argument("--limit", type=int, default=0, help="Максимум страниц")
+    args = parser.parse_args()
+
+    corpus = load_directory(args.corpus, args.limit) if args.corpus else load_page_cache(args.page_cache, args.limit)
+    if not corpus:
+        print("Corpus is empty")
+        sys.exit(1)
+    total_bytes = sum(len(html) for _, html in corpus)
+    print(f"Corpus: {len(corpus)} pages, {total_bytes / 1024 / 1024:.1f} MB")
+
+    runs = [run("legacy (bs4 html.parser)", lambda html: extract_content_data_legacy(html, "", 200), corpus, args.repeat)]
+    runs.append(run("single-pass html.parser", lambda html: extract_content_data(html, "", 200, backend="html.parser"), corpus, args.repeat))
+    if etree is not None:
+        runs.append(run("single-pass lxml", lambda html: extract_content_data(html, "", 200, backend="lxml"), corpus, args.repeat))
+
+    baseline_total = sum(runs[0][1])
+    reference = runs[0][2]
+    print(f"{'implementation':<28}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}{'speedup':>10}{'identical':>12}")
+    for name, timings, outputs in runs:
+        ordered = sorted(timings)
+        p50 = statistics.median(ordered) * 1000
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000
+        identical = sum(1 for a, b in zip(reference, outputs) if a == b)
+        print(f"{name:<28}{sum(timings):>10.2f}{p50:>10.2f}{p95:>10.2f}{baseline_total / sum(timings):>9.1f}x{identical:>7}/{len(corpus)}")
+
+    for name, _, outputs in runs[1:]:
+        mismatches = [(key, [field for field in ref if ref[field] != out[field]])
+                      for (key, _), ref, out in zip(corpus, reference, outputs) if ref != out]
+        for key, fields in mismatches[:10]:
+            print(f"  {name}: {key} differs in {', '.join(fields)}")
+
+
+if __name__ == "__main__":
+    main()
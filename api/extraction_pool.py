@@ -0,0 +1,91 @@
+"""
+Пул исполнителей для CPU-емкого разбора HTML
+Разбор страниц выносится из event loop в процессы (или потоки), чтобы не блокировать остальные запросы
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from html_extraction import extract_from_bytes
+
+logger = logging.getLogger(__name__)
+
+EXECUTOR_KINDS = ("process", "thread", "inline")
+
+
+def _warmup():
+    """Импорт парсеров и прогрев кода разбора в рабочем процессе"""
+    extract_from_bytes(b"<html><head><title>warmup</title></head><body><p>ok</p></body></html>", "utf-8", "", 200)
+
+
+class ExtractionPool:
+    """Исполнитель для extract_from_bytes и других picklable-функций разбора.
+
+    ENV:
+      EXTRACTION_EXECUTOR  — process | thread | inline (process)
+      EXTRACTION_WORKERS   — размер пула (по числу CPU)
+    """
+
+    def __init__(self, kind: Optional[str] = None, workers: Optional[int] = None):
+        self.kind = (kind or os.getenv("EXTRACTION_EXECUTOR", "process")).lower()
+        if self.kind not in EXECUTOR_KINDS:
+            raise ValueError(f"EXTRACTION_EXECUTOR must be one of {', '.join(EXECUTOR_KINDS)}")
+        cpu_count = os.cpu_count() or 1
+        default_workers = cpu_count if self.kind == "process" else min(32, cpu_count + 4)
+        self.workers = workers or int(os.getenv("EXTRACTION_WORKERS", "0")) or default_workers
+        self._executor: Optional[Executor] = None
+
+    def _build_executor(self) -> Optional[Executor]:
+        if self.kind == "process":
+            # forkserver: рабочие процессы не наследуют потоки и сокеты web-процесса
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["html_extraction"])
+            else:
+                context = multiprocessing.get_context("spawn")
+            return ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        if self.kind == "thread":
+            return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="extract")
+        return None
+
+    @property
+    def executor(self) -> Optional[Executor]:
+        if self._executor is None and self.kind != "inline":
+            self._executor = self._build_executor()
+        return self._executor
+
+    async def start(self):
+        """Создание пула и прогрев рабочих (вызывается на startup).
+
+        Одновременная отправка workers задач заставляет пул поднять все процессы сразу,
+        а не на первых запросах.
+        """
+        executor = self.executor
+        if executor is None:
+            return
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(executor, _warmup) for _ in range(self.workers)))
+        logger.info("Extraction pool started (%s, %d workers)", self.kind, self.workers)
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Выполнение func(*args) в пуле; func и аргументы должны быть picklable для kind=process"""
+        executor = self.executor
+        if executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    async def extract(self, body: bytes, encoding: Optional[str], url: str, status_code: int) -> Dict[str, Any]:
+        return await self.run(extract_from_bytes, body, encoding, url, status_code)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# Глобальный пул процесса
+extraction_pool = ExtractionPool()
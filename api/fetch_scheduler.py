@@ -0,0 +1,227 @@
+"""
+Вежливая загрузка сайтов
+Лимиты на хост и IP, минимальный интервал между запросами к хосту и общий DNS-кэш с TTL
+"""
+
+import asyncio
+import ipaddress
+import logging
+import os
+import socket
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpcore
+
+logger = logging.getLogger(__name__)
+
+
+def url_host(url: str) -> str:
+    if "://" not in url:
+        url = f"https://{url}"
+    return (urlsplit(url).hostname or "").lower()
+
+
+def _is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+class DNSCache:
+    """Асинхронный DNS-кэш процесса с TTL; одновременные запросы одного имени объединяются.
+
+    ENV:
+      DNS_CACHE_TTL           — время жизни записи, сек (300)
+      DNS_CACHE_NEGATIVE_TTL  — время жизни ошибки резолвинга, сек (30)
+      DNS_CACHE_MAX_ENTRIES   — лимит записей (50000)
+    """
+
+    def __init__(self, ttl: Optional[float] = None, negative_ttl: Optional[float] = None,
+                 max_entries: Optional[int] = None):
+        self.ttl = ttl if ttl is not None else float(os.getenv("DNS_CACHE_TTL", "300"))
+        self.negative_ttl = negative_ttl if negative_ttl is not None else float(os.getenv("DNS_CACHE_NEGATIVE_TTL", "30"))
+        self.max_entries = max_entries or int(os.getenv("DNS_CACHE_MAX_ENTRIES", "50000"))
+        self.stats = {"hits": 0, "misses": 0}
+        # host -> (истекает, адреса или None, ошибка)
+        self._entries: Dict[str, Tuple[float, Optional[List[str]], Optional[OSError]]] = {}
+        self._inflight: Dict[str, Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = {}
+
+    async def resolve(self, host: str, port: int = 443) -> List[str]:
+        """IP-адреса хоста (в порядке, предложенном резолвером)"""
+        if _is_ip(host):
+            return [host]
+        now = time.time()
+        entry = self._entries.get(host)
+        if entry and entry[0] > now:
+            self.stats["hits"] += 1
+            if entry[2] is not None:
+                raise entry[2]
+            return entry[1]
+
+        loop = asyncio.get_running_loop()
+        inflight = self._inflight.get(host)
+        if inflight and inflight[0] is loop:
+            try:
+                return await asyncio.shield(inflight[1])
+            except asyncio.CancelledError:
+                if not inflight[1].cancelled():
+                    raise
+                # Отменен запрос-лидер, а не ожидающий — резолвим заново
+                return await self.resolve(host, port)
+
+        self.stats["misses"] += 1
+        future = loop.create_future()
+        self._inflight[host] = (loop, future)
+        try:
+            infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            addresses = list(dict.fromkeys(info[4][0] for info in infos))
+            self._store(host, now + self.ttl, addresses, None)
+            future.set_result(addresses)
+            return addresses
+        except OSError as e:
+            self._store(host, now + self.negative_ttl, None, e)
+            future.set_exception(e)
+            future.exception()  # исключение получено — без предупреждения о неполученном
+            raise
+        except BaseException as e:
+            # Отмена или не сетевая ошибка (например, UnicodeError IDNA): ожидающие не должны зависнуть,
+            # в негативный кэш такие ошибки не попадают
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()
+            raise
+        finally:
+            if self._inflight.get(host, (None,))[0] is loop:
+                del self._inflight[host]
+
+    def _store(self, host: str, expires: float, addresses: Optional[List[str]], error: Optional[OSError]):
+        if len(self._entries) >= self.max_entries:
+            now = time.time()
+            self._entries = {h: e for h, e in self._entries.items() if e[0] > now}
+            if len(self._entries) >= self.max_entries:
+                # Все записи свежие — вытесняем самые старые
+                for stale in sorted(self._entries, key=lambda h: self._entries[h][0])[: self.max_entries // 10 or 1]:
+                    del self._entries[stale]
+        self._entries[host] = (expires, addresses, error)
+
+
+class CachingNetworkBackend(httpcore.AsyncNetworkBackend):
+    """Сетевой backend httpcore, подключающийся по адресам из DNSCache.
+
+    TLS SNI и проверка сертификата по-прежнему используют имя хоста из URL.
+    """
+
+    def __init__(self, inner: httpcore.AsyncNetworkBackend, dns: DNSCache):
+        self.inner = inner
+        self.dns = dns
+
+    async def connect_tcp(self, host: str, port: int, timeout: Optional[float] = None,
+                          local_address: Optional[str] = None, socket_options: Any = None):
+        try:
+            addresses = await self.dns.resolve(host, port)
+        except OSError as e:
+            raise httpcore.ConnectError(str(e)) from e
+        last_error: Optional[Exception] = None
+        for address in addresses:
+            try:
+                return await self.inner.connect_tcp(
+                    address, port, timeout=timeout, local_address=local_address, socket_options=socket_options
+                )
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                last_error = e
+        raise last_error or httpcore.ConnectError(f"No addresses for {host}")
+
+    async def connect_unix_socket(self, path: str, timeout: Optional[float] = None, socket_options: Any = None):
+        return await self.inner.connect_unix_socket(path, timeout=timeout, socket_options=socket_options)
+
+    async def sleep(self, seconds: float):
+        await self.inner.sleep(seconds)
+
+
+class _Slot:
+    """Семафор с числом пользователей (запись удаляется, когда хост простаивает)"""
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.users = 0
+
+
+class PolitenessScheduler:
+    """Лимиты одновременных запросов на хост и на IP, минимальный интервал между запросами к хосту.
+
+    ENV:
+      FETCH_PER_HOST_LIMIT      — одновременных запросов на хост (4)
+      FETCH_PER_IP_LIMIT        — одновременных запросов на IP, 0 — без лимита (8)
+      FETCH_HOST_MIN_DELAY      — минимальный интервал между началом запросов к хосту, сек (0.5)
+    """
+
+    def __init__(self, dns: DNSCache, per_host_limit: Optional[int] = None, per_ip_limit: Optional[int] = None,
+                 min_delay: Optional[float] = None):
+        self.dns = dns
+        self.per_host_limit = per_host_limit or int(os.getenv("FETCH_PER_HOST_LIMIT", "4"))
+        self.per_ip_limit = per_ip_limit if per_ip_limit is not None else int(os.getenv("FETCH_PER_IP_LIMIT", "8"))
+        self.min_delay = min_delay if min_delay is not None else float(os.getenv("FETCH_HOST_MIN_DELAY", "0.5"))
+        self._host_slots: Dict[str, _Slot] = {}
+        self._ip_slots: Dict[str, _Slot] = {}
+        self._next_start: Dict[str, float] = {}
+        self.stats = {"delayed": 0, "delay_seconds": 0.0}
+
+    @asynccontextmanager
+    async def _hold(self, slots: Dict[str, _Slot], key: str, limit: int):
+        slot = slots.get(key)
+        if slot is None:
+            slot = slots[key] = _Slot(limit)
+        slot.users += 1
+        try:
+            async with slot.semaphore:
+                yield
+        finally:
+            slot.users -= 1
+            if slot.users == 0 and slots.get(key) is slot:
+                del slots[key]
+
+    async def _wait_turn(self, host: str):
+        """Резервирование времени старта: конкурентные запросы к хосту разносятся на min_delay"""
+        if self.min_delay <= 0:
+            return
+        now = time.monotonic()
+        start_at = max(now, self._next_start.get(host, 0.0))
+        self._next_start[host] = start_at + self.min_delay
+        if len(self._next_start) > 10000:
+            self._next_start = {h: t for h, t in self._next_start.items() if t > now}
+        delay = start_at - now
+        if delay > 0:
+            self.stats["delayed"] += 1
+            self.stats["delay_seconds"] += delay
+            await asyncio.sleep(delay)
+
+    async def _primary_ip(self, host: str) -> Optional[str]:
+        try:
+            addresses = await self.dns.resolve(host)
+        except OSError:
+            return None  # ошибку покажет сам запрос
+        return addresses[0] if addresses else None
+
+    @asynccontextmanager
+    async def slot(self, url: str):
+        host = url_host(url)
+        async with self._hold(self._host_slots, host, self.per_host_limit):
+            ip = await self._primary_ip(host) if self.per_ip_limit > 0 else None
+            if ip is None:
+                await self._wait_turn(host)
+                yield
+                return
+            async with self._hold(self._ip_slots, ip, self.per_ip_limit):
+                await self._wait_turn(host)
+                yield
+
+    def clear(self):
+        self._host_slots.clear()
+        self._ip_slots.clear()
+        self._next_start.clear()
@@ -0,0 +1,316 @@
+"""
+Однопроходное извлечение контента из HTML (этап 1)
+Заголовок, meta description, заголовки h1-h3, ссылки, видимый текст и fallback-и за один обход
+"""
+
+import os
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Optional
+
+from bs4 import BeautifulSoup
+
+try:
+    from lxml import etree
+except ImportError:  # lxml опционален: EXTRACTION_BACKEND=lxml без него откатывается на html.parser
+    etree = None
+
+# Элементы, которые удаляются вместе с содержимым
+SKIP_TAGS = frozenset(["script", "style", "nav", "footer", "header"])
+HEADER_TAGS = ("h1", "h2", "h3")
+BLOCK_TAGS = frozenset(["p", "div", "span", "h1", "h2", "h3", "h4", "h5", "h6"])
+# Строки внутри этих элементов BeautifulSoup не включает в get_text()
+NON_TEXT_CONTAINERS = frozenset(["template", "rt", "rp"])
+# Внутри этих элементов BeautifulSoup не схлопывает пробельные строки
+PRESERVE_WHITESPACE_TAGS = frozenset(["pre", "textarea"])
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+# Void-элементы в терминах BeautifulSoup (закрываются сразу)
+VOID_TAGS = frozenset([
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "menuitem",
+    "meta", "param", "source", "track", "wbr", "basefont", "bgsound", "command", "frame",
+    "image", "isindex", "nextid", "spacer",
+])
+
+
+def _collapse_whitespace(text: str) -> str:
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    return ' '.join(chunk for chunk in chunks if chunk)
+
+
+class _ContentCollector:
+    """Потребитель событий start/end/text, собирающий content_data за один проход.
+
+    Текст элементов хранится как диапазоны индексов в общем списке фрагментов,
+    поэтому вложенность не приводит к повторным обходам.
+    """
+
+    def __init__(self):
+        self.pieces: List[str] = []
+        self.skip_depth = 0
+        self.non_text_depth = 0
+        self.preserve_depth = 0
+        self.title: Optional[List[str]] = None
+        self.title_depth = 0
+        self.title_done = False
+        self.meta_description: Optional[str] = None
+        self.body: Optional[List[int]] = None
+        self.headers: Dict[str, List[List[int]]] = {tag: [] for tag in HEADER_TAGS}
+        self.links: List[Any] = []
+        self.blocks: List[List[int]] = []
+        # Стек открытых элементов: (tag, пропущен ли, запись диапазона или None)
+        self.stack: List[Any] = []
+
+    def start(self, tag: str, attrs: Dict[str, Optional[str]]):
+        if tag == "title" and not self.title_done and self.title is None:
+            self.title = []
+        if self.title is not None and not self.title_done:
+            self.title_depth += 1
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve_depth += 1
+
+        skipped = self.skip_depth > 0 or tag in SKIP_TAGS
+        if skipped:
+            self.skip_depth += 1
+            self.stack.append((tag, True, None))
+            return
+        if tag in NON_TEXT_CONTAINERS:
+            self.non_text_depth += 1
+
+        position = len(self.pieces)
+        record = None
+        if tag in BLOCK_TAGS:
+            record = [position, None]
+            self.blocks.append(record)
+            if tag in self.headers:
+                self.headers[tag].append(record)
+        if tag == "a" and attrs.get("href") is not None:
+            link_record = [position, None]
+            self.links.append((attrs["href"], link_record))
+            record = (record, link_record) if record else link_record
+        elif tag == "body" and self.body is None:
+            self.body = record = [position, None]
+        elif tag == "meta" and self.meta_description is None and attrs.get("name") == "description":
+            self.meta_description = attrs.get("content") or ""
+        self.stack.append((tag, False, record))
+
+    def end(self):
+        tag, skipped, record = self.stack.pop()
+        if self.title is not None and not self.title_done:
+            self.title_depth -= 1
+            if self.title_depth == 0:
+                self.title_done = True
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve_depth -= 1
+        if skipped:
+            self.skip_depth -= 1
+            return
+        if tag in NON_TEXT_CONTAINERS:
+            self.non_text_depth -= 1
+        position = len(self.pieces)
+        if isinstance(record, tuple):
+            for item in record:
+                item[1] = position
+        elif record is not None:
+            record[1] = position
+
+    def text(self, data: str):
+        if not data:
+            return
+        # Как BeautifulSoup: строка только из пробелов заменяется одним переводом строки или пробелом
+        if self.preserve_depth == 0 and not data.strip(ASCII_SPACES):
+            data = "\n" if "\n" in data else " "
+        if self.title is not None and not self.title_done and self.title_depth > 0 and self.non_text_depth == 0:
+            self.title.append(data)
+        if self.skip_depth == 0 and self.non_text_depth == 0:
+            self.pieces.append(data)
+
+    def _range_text(self, record: List[int]) -> str:
+        end = record[1] if record[1] is not None else len(self.pieces)
+        return ''.join(self.pieces[record[0]:end])
+
+    def finalize(self, html: str, url: str, status_code: int) -> Dict[str, Any]:
+        while self.stack:
+            self.end()
+
+        title_text = ''.join(self.title).strip() if self.title is not None else ""
+
+        text = _collapse_whitespace(''.join(self.pieces))
+        if len(text) < 100 and self.body is not None:
+            text = _collapse_whitespace(self._range_text(self.body))
+        if len(text) < 100:
+            text = html[:5000]  # Первые 5000 символов HTML
+        if len(text) < 200:
+            block_texts = (self._range_text(record).strip() for record in self.blocks)
+            additional_text = ' '.join(t for t in block_texts if t)
+            if additional_text:
+                text = additional_text[:3000]
+
+        headers = [self._range_text(record).strip() for tag in HEADER_TAGS for record in self.headers[tag]]
+
+        links = []
+        for href, record in self.links:
+            link_text = self._range_text(record).strip()
+            if href and link_text:
+                links.append({'url': href, 'text': link_text})
+                if len(links) == 50:
+                    break
+
+        return {
+            'url': url,
+            'title': title_text,
+            'meta_description': self.meta_description or "",
+            'main_text': text[:5000],
+            'headers': headers[:20],
+            'links': links,
+            'content_length': len(text),
+            'status_code': status_code,
+        }
+
+
+class _StreamingParser(HTMLParser):
+    """Источник событий на stdlib html.parser с правилами вложенности BeautifulSoup"""
+
+    def __init__(self, collector: _ContentCollector):
+        super().__init__(convert_charrefs=True)
+        self.collector = collector
+        self.open_tags: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        self.collector.start(tag, {name: value or "" for name, value in attrs})
+        if tag in VOID_TAGS:
+            self.collector.end()
+        else:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.collector.start(tag, {name: value or "" for name, value in attrs})
+        self.collector.end()
+
+    def handle_endtag(self, tag):
+        # Как BeautifulSoup: закрываем до ближайшего открытого тега с этим именем, иначе игнорируем
+        if tag not in self.open_tags:
+            return
+        while self.open_tags:
+            closed = self.open_tags.pop()
+            self.collector.end()
+            if closed == tag:
+                break
+
+    def handle_data(self, data):
+        self.collector.text(data)
+
+    def unknown_decl(self, data):
+        if data.upper().startswith("CDATA["):
+            self.collector.text(data[len("CDATA["):])
+
+
+def _walk_lxml(html: str, collector: _ContentCollector):
+    parser = etree.HTMLParser(encoding="utf-8", remove_comments=False)
+    root = etree.fromstring(html.encode("utf-8", errors="replace"), parser)
+    if root is None:
+        return
+    for event, element in etree.iterwalk(root, events=("start", "end", "comment", "pi")):
+        if event == "start":
+            collector.start(element.tag, element.attrib)
+            if element.text:
+                collector.text(element.text)
+            continue
+        # end / comment / pi: текст комментария не учитывается, хвост после узла — да
+        if event == "end":
+            collector.end()
+        if element.tail and element is not root:
+            collector.text(element.tail)
+
+
+def extract_content_data(html: str, url: str, status_code: int, backend: Optional[str] = None) -> Dict[str, Any]:
+    """Извлечение content_data за один проход.
+
+    backend (или ENV EXTRACTION_BACKEND):
+      "html.parser" — по умолчанию; потоковый разбор с правилами вложенности BeautifulSoup,
+                      результат совпадает с extract_content_data_legacy
+      "lxml"        — быстрее, но на неверно вложенной разметке (<div> внутри <p>, незакрытые
+                      <h2>/<li>/<p>) main_text, headers и content_length отличаются от прежних
+    """
+    backend = backend or os.getenv("EXTRACTION_BACKEND") or "html.parser"
+    if backend == "lxml" and etree is None:
+        backend = "html.parser"
+    collector = _ContentCollector()
+    if backend == "lxml":
+        _walk_lxml(html, collector)
+    else:
+        parser = _StreamingParser(collector)
+        parser.feed(html)
+        parser.close()
+    return collector.finalize(html, url, status_code)
+
+
+def extract_from_bytes(body: bytes, encoding: Optional[str], url: str, status_code: int,
+                       backend: Optional[str] = None) -> Dict[str, Any]:
+    """Декодирование и извлечение; точка входа для пула процессов (аргументы и результат picklable)"""
+    html = body.decode(encoding or "utf-8", errors="replace")
+    return extract_content_data(html, url, status_code, backend)
+
+
+def extract_plain_text(html: str, limit: int = 6000) -> str:
+    """Видимый текст страницы для упрощенного fallback-анализа"""
+    soup = BeautifulSoup(html, "lxml" if etree is not None else "html.parser")
+    for tag in soup(["script", "style", "noscript", "iframe"]):
+        tag.decompose()
+    text = soup.get_text(" ", strip=True)
+    return text[:limit]
+
+
+def extract_content_data_legacy(html: str, url: str, status_code: int) -> Dict[str, Any]:
+    """Прежняя реализация на BeautifulSoup (эталон для сравнения и бенчмарка).
+
+    Отличие от исходного кода: цикл по ссылкам больше не перезаписывает text, поэтому main_text
+    и content_length — текст страницы, а не текст последней ссылки.
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+
+    title = soup.find('title')
+    title_text = title.get_text().strip() if title else ""
+
+    for script in soup(["script", "style", "nav", "footer", "header"]):
+        script.decompose()
+
+    text = _collapse_whitespace(soup.get_text())
+    if len(text) < 100:
+        body = soup.find('body')
+        if body:
+            text = _collapse_whitespace(body.get_text())
+    if len(text) < 100:
+        text = html[:5000]
+    if len(text) < 200:
+        all_text_elements = soup.find_all(['p', 'div', 'span', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+        additional_text = ' '.join([elem.get_text().strip() for elem in all_text_elements if elem.get_text().strip()])
+        if additional_text:
+            text = additional_text[:3000]
+
+    meta_description = ""
+    meta_desc = soup.find('meta', attrs={'name': 'description'})
+    if meta_desc:
+        meta_description = meta_desc.get('content', '')
+
+    headers = []
+    for tag in ['h1', 'h2', 'h3']:
+        for header in soup.find_all(tag):
+            headers.append(header.get_text().strip())
+
+    links = []
+    for link in soup.find_all('a', href=True):
+        href = link.get('href')
+        link_text = link.get_text().strip()
+        if href and link_text:
+            links.append({'url': href, 'text': link_text})
+
+    return {
+        'url': url,
+        'title': title_text,
+        'meta_description': meta_description,
+        'main_text': text[:5000],
+        'headers': headers[:20],
+        'links': links[:50],
+        'content_length': len(text),
+        'status_code': status_code,
+    }
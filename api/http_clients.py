@@ -0,0 +1,400 @@
+"""
+Общий реестр HTTP-клиентов приложения
+Долгоживущие пулы соединений с keep-alive: отдельно для целевых сайтов и для Supabase
+"""
+
+import codecs
+import logging
+import os
+import re
+import urllib.request
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from typing import Any, Dict, List, Optional
+
+import httpcore
+import httpx
+
+from fetch_scheduler import CachingNetworkBackend, DNSCache, PolitenessScheduler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120 Safari/537.36"
+)
+
+
+_META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([A-Za-z0-9._:-]+)""", re.IGNORECASE)
+_BOMS = ((codecs.BOM_UTF8, "utf-8"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"))
+# Начало документа, в котором ищется <meta charset>
+SNIFF_BYTES = 4096
+
+
+class UnsupportedContentType(Exception):
+    """Ответ не является HTML/текстом — тело не читается"""
+
+
+class FetchedPage:
+    """Результат потоковой загрузки страницы: байты (для кэша и пула извлечения) и декодированный текст"""
+    def __init__(self, url: str, status_code: int, headers: httpx.Headers, body: bytes,
+                 encoding: Optional[str], truncated: bool = False, text: Optional[str] = None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.encoding = encoding
+        self.truncated = truncated
+        self._text = text
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.body.decode(self.encoding or "utf-8", errors="replace")
+        return self._text
+
+
+def _valid_codec(name: Optional[str]) -> Optional[str]:
+    if not name:
+        return None
+    try:
+        return codecs.lookup(name.strip().strip("'\"")).name
+    except LookupError:
+        return None
+
+
+def sniff_encoding(content_type: Optional[str], body: bytes) -> str:
+    """Кодировка страницы: charset из заголовка, BOM, <meta charset> в начале документа, иначе utf-8"""
+    if content_type and "charset=" in content_type.lower():
+        declared = _valid_codec(content_type.lower().split("charset=", 1)[1].split(";")[0])
+        if declared:
+            return declared
+    for bom, name in _BOMS:
+        if body.startswith(bom):
+            return name
+    match = _META_CHARSET_RE.search(body[:SNIFF_BYTES])
+    if match:
+        declared = _valid_codec(match.group(1).decode("ascii", errors="ignore"))
+        if declared:
+            return declared
+    return "utf-8"
+
+
+# Исключения httpcore -> httpx (порядок: от частных к общим)
+_HTTPCORE_ERRORS = (
+    (httpcore.ConnectTimeout, httpx.ConnectTimeout),
+    (httpcore.ReadTimeout, httpx.ReadTimeout),
+    (httpcore.WriteTimeout, httpx.WriteTimeout),
+    (httpcore.PoolTimeout, httpx.PoolTimeout),
+    (httpcore.TimeoutException, httpx.TimeoutException),
+    (httpcore.ConnectError, httpx.ConnectError),
+    (httpcore.ReadError, httpx.ReadError),
+    (httpcore.WriteError, httpx.WriteError),
+    (httpcore.NetworkError, httpx.NetworkError),
+    (httpcore.ProxyError, httpx.ProxyError),
+    (httpcore.UnsupportedProtocol, httpx.UnsupportedProtocol),
+    (httpcore.LocalProtocolError, httpx.LocalProtocolError),
+    (httpcore.RemoteProtocolError, httpx.RemoteProtocolError),
+    (httpcore.ProtocolError, httpx.ProtocolError),
+)
+
+
+@contextmanager
+def _map_httpcore_errors(request: httpx.Request):
+    try:
+        yield
+    except Exception as e:
+        for source, target in _HTTPCORE_ERRORS:
+            if isinstance(e, source):
+                raise target(str(e), request=request) from e
+        raise
+
+
+class _ResponseStream(httpx.AsyncByteStream):
+    def __init__(self, stream: Any, request: httpx.Request):
+        self._stream = stream
+        self._request = request
+
+    async def __aiter__(self):
+        with _map_httpcore_errors(self._request):
+            async for chunk in self._stream:
+                yield chunk
+
+    async def aclose(self):
+        if hasattr(self._stream, "aclose"):
+            await self._stream.aclose()
+
+
+class DNSCachingTransport(httpx.AsyncBaseTransport):
+    """Транспорт httpx поверх пула httpcore, подключающегося по адресам из DNSCache.
+
+    Собран только из публичных API httpx/httpcore (network_backend пула), без правки внутренностей
+    httpx.AsyncHTTPTransport. httpx не применяет HTTP(S)_PROXY / ALL_PROXY / NO_PROXY к клиенту
+    с собственным транспортом, поэтому прокси из окружения учитываются здесь: запросы через прокси
+    идут обычным httpx.AsyncHTTPTransport (адрес сайта разрешает прокси), остальные — через DNSCache.
+    """
+
+    def __init__(self, dns: DNSCache, limits: httpx.Limits, http2: bool = False,
+                 trust_env: bool = True):
+        self._proxies = urllib.request.getproxies_environment() if trust_env else {}
+        self._proxy_transports: Dict[str, httpx.AsyncHTTPTransport] = {}
+        for scheme in ("http", "https", "all"):
+            proxy = self._proxies.get(scheme)
+            if proxy and proxy not in self._proxy_transports:
+                self._proxy_transports[proxy] = httpx.AsyncHTTPTransport(
+                    proxy=proxy if "://" in proxy else f"http://{proxy}", limits=limits, http2=http2,
+                )
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            http1=True,
+            http2=http2,
+            network_backend=CachingNetworkBackend(httpcore.AnyIOBackend(), dns),
+        )
+
+    def _proxy_for(self, url: httpx.URL) -> Optional[httpx.AsyncHTTPTransport]:
+        proxy = self._proxies.get(url.scheme) or self._proxies.get("all")
+        if not proxy or urllib.request.proxy_bypass_environment(url.host, self._proxies):
+            return None
+        return self._proxy_transports[proxy]
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        proxy_transport = self._proxy_for(request.url) if self._proxy_transports else None
+        if proxy_transport is not None:
+            return await proxy_transport.handle_async_request(request)
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(
+                scheme=request.url.raw_scheme,
+                host=request.url.raw_host,
+                port=request.url.port,
+                target=request.url.raw_path,
+            ),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        with _map_httpcore_errors(request):
+            response = await self._pool.handle_async_request(core_request)
+        return httpx.Response(
+            status_code=response.status,
+            headers=response.headers,
+            stream=_ResponseStream(response.stream, request),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self._pool.aclose()
+        for transport in self._proxy_transports.values():
+            await transport.aclose()
+
+
+def _http2_available() -> bool:
+    """HTTP/2 в httpx требует пакет h2"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class HTTPClientRegistry:
+    """Реестр пулов httpx.AsyncClient, создается на старте и закрывается на shutdown.
+
+    ENV:
+      FETCH_MAX_CONNECTIONS        — общий лимит соединений пула сайтов (100)
+      FETCH_MAX_KEEPALIVE          — лимит keep-alive соединений пула сайтов (20)
+      FETCH_PER_HOST_LIMIT         — одновременных запросов на один хост (4); см. также PolitenessScheduler
+      FETCH_TIMEOUT                — таймаут запроса к сайту, сек (30)
+      FETCH_MAX_BYTES              — лимит тела страницы, байт (2 МБ); остальное не скачивается
+      FETCH_MAX_REDIRECTS          — переходов по редиректам на одну загрузку (20)
+      FETCH_ALLOWED_CONTENT_TYPES  — допустимые Content-Type (text/html,application/xhtml+xml,text/plain)
+      SUPABASE_MAX_CONNECTIONS     — лимит соединений пула Supabase (20)
+      SUPABASE_EDGE_TIMEOUT        — таймаут запросов к Supabase, сек (10)
+      HTTP2_ENABLED                — включить HTTP/2 (false, нужен пакет h2)
+    """
+
+    def __init__(self):
+        self.fetch_max_connections = int(os.getenv("FETCH_MAX_CONNECTIONS", "100"))
+        self.fetch_max_keepalive = int(os.getenv("FETCH_MAX_KEEPALIVE", "20"))
+        self.fetch_timeout = float(os.getenv("FETCH_TIMEOUT", "30"))
+        self.max_bytes = int(os.getenv("FETCH_MAX_BYTES", str(2 * 1024 * 1024)))
+        self.max_redirects = int(os.getenv("FETCH_MAX_REDIRECTS", "20"))
+        self.allowed_content_types: List[str] = [
+            t.strip().lower()
+            for t in os.getenv("FETCH_ALLOWED_CONTENT_TYPES", "text/html,application/xhtml+xml,text/plain").split(",")
+            if t.strip()
+        ]
+        self.supabase_max_connections = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "20"))
+        self.supabase_timeout = float(os.getenv("SUPABASE_EDGE_TIMEOUT", "10"))
+        self.http2 = os.getenv("HTTP2_ENABLED", "false").lower() == "true"
+
+        self._fetch: Optional[httpx.AsyncClient] = None
+        self._supabase: Optional[httpx.AsyncClient] = None
+        # DNS-кэш и вежливость по хостам/IP — общие для всех загрузок процесса
+        self.dns = DNSCache()
+        self.politeness = PolitenessScheduler(self.dns)
+
+    def _build_fetch_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(
+            max_connections=self.fetch_max_connections,
+            max_keepalive_connections=self.fetch_max_keepalive,
+            keepalive_expiry=30.0,
+        )
+        # Подключение по адресам из общего DNS-кэша (httpx не дает задать резолвер напрямую)
+        transport = DNSCachingTransport(self.dns, limits, http2=self.http2)
+        # Редиректы обрабатывает fetch_page: каждый переход — под слотом вежливости своего хоста
+        return httpx.AsyncClient(
+            timeout=self.fetch_timeout,
+            follow_redirects=False,
+            headers={"User-Agent": DEFAULT_USER_AGENT},
+            transport=transport,
+        )
+
+    def _build_supabase_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            timeout=self.supabase_timeout,
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=self.supabase_max_connections,
+                max_keepalive_connections=self.supabase_max_connections,
+                keepalive_expiry=60.0,
+            ),
+        )
+
+    async def start(self):
+        """Создание пулов (вызывается на startup)"""
+        if self.http2 and not _http2_available():
+            logger.warning("HTTP2_ENABLED=true, but package 'h2' is not installed; using HTTP/1.1")
+            self.http2 = False
+        if self._fetch is None:
+            self._fetch = self._build_fetch_client()
+        if self._supabase is None:
+            self._supabase = self._build_supabase_client()
+        logger.info(
+            "HTTP clients initialized (fetch max=%d, per-host=%d, per-ip=%d, host delay=%.2fs, http2=%s)",
+            self.fetch_max_connections, self.politeness.per_host_limit, self.politeness.per_ip_limit,
+            self.politeness.min_delay, self.http2,
+        )
+
+    async def close(self):
+        """Закрытие пулов (вызывается на shutdown)"""
+        for client in (self._fetch, self._supabase):
+            if client is not None:
+                try:
+                    await client.aclose()
+                except Exception as e:
+                    logger.warning(f"HTTP client close failed: {e}")
+        self._fetch = None
+        self._supabase = None
+        self.politeness.clear()
+
+    @property
+    def fetch(self) -> httpx.AsyncClient:
+        """Пул для загрузки целевых сайтов (создается лениво вне FastAPI)"""
+        if self._fetch is None or self._fetch.is_closed:
+            self._fetch = self._build_fetch_client()
+        return self._fetch
+
+    @property
+    def supabase(self) -> httpx.AsyncClient:
+        """Пул для Supabase Auth / Edge Functions"""
+        if self._supabase is None or self._supabase.is_closed:
+            self._supabase = self._build_supabase_client()
+        return self._supabase
+
+    @asynccontextmanager
+    async def host_slot(self, url: str):
+        """Лимиты на хост/IP и минимальный интервал между запросами к хосту"""
+        async with self.politeness.slot(url):
+            yield
+
+    async def fetch_page(self, url: str, headers: Optional[Dict[str, str]] = None,
+                         timeout: Optional[float] = None, max_bytes: Optional[int] = None,
+                         limiter: Any = None, decode: bool = True) -> FetchedPage:
+        """Потоковая загрузка страницы с лимитом по байтам.
+
+        Content-Type проверяется до чтения тела, чтение прекращается по достижении лимита.
+        304 Not Modified возвращается как есть (с пустым телом).
+        Редиректы (до FETCH_MAX_REDIRECTS) проходятся вручную: каждый запрос, в том числе на другой
+        хост (apex -> www, CDN), ждет своего слота вежливости.
+        limiter (AdaptiveLimiter) захватывается после ожидания очереди хоста, чтобы
+        паузы вежливости не учитывались как задержка загрузки.
+        decode=False — только байты и кодировка (текст декодирует пул извлечения, а не event loop).
+        """
+        max_bytes = max_bytes or self.max_bytes
+        request_kwargs = {"headers": headers}
+        if timeout is not None:
+            request_kwargs["timeout"] = timeout
+        request = self.fetch.build_request("GET", url, **request_kwargs)
+        for _ in range(self.max_redirects + 1):
+            async with self.host_slot(str(request.url)), (limiter.slot() if limiter is not None else nullcontext()):
+                response = await self.fetch.send(request, stream=True)
+                try:
+                    if response.is_redirect and response.next_request is not None:
+                        request = response.next_request
+                        continue
+                    page = await self._read_page(response, max_bytes, decode)
+                finally:
+                    await response.aclose()
+            return page
+        raise httpx.TooManyRedirects(f"Exceeded {self.max_redirects} redirects", request=request)
+
+    async def _read_page(self, response: httpx.Response, max_bytes: int, decode: bool = True) -> FetchedPage:
+        """Проверка статуса и Content-Type, чтение тела открытого потокового ответа до max_bytes"""
+        if response.status_code == 304:
+            return FetchedPage(str(response.url), 304, response.headers, b"", None)
+        response.raise_for_status()
+
+        content_type = response.headers.get("content-type")
+        mime = (content_type or "").split(";")[0].strip().lower()
+        if mime and mime not in self.allowed_content_types:
+            raise UnsupportedContentType(f"Unsupported content type: {mime}")
+
+        # Кодировка определяется по заголовку и первым SNIFF_BYTES, дальше тело декодируется по мере чтения
+        chunks: List[bytes] = []
+        pieces: List[str] = []
+        size = 0
+        truncated = False
+        encoding: Optional[str] = None
+        decoder = None
+        async for chunk in response.aiter_bytes():
+            if size + len(chunk) >= max_bytes:
+                chunk = chunk[:max_bytes - size]
+                truncated = True
+            chunks.append(chunk)
+            size += len(chunk)
+            if encoding is None and (size >= SNIFF_BYTES or truncated):
+                head = b"".join(chunks)
+                encoding = sniff_encoding(content_type, head)
+                if decode:
+                    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+                    pieces.append(decoder.decode(head))
+            elif decoder is not None:
+                pieces.append(decoder.decode(chunk))
+            if truncated:
+                break
+        body = b"".join(chunks)
+        if encoding is None:
+            encoding = sniff_encoding(content_type, body)
+            if decode:
+                decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+                pieces.append(decoder.decode(body))
+        # Обрезанное тело может кончаться неполным символом — он отбрасывается, а не заменяется
+        if decoder is not None and not truncated:
+            pieces.append(decoder.decode(b"", final=True))
+
+        return FetchedPage(
+            url=str(response.url),
+            status_code=response.status_code,
+            headers=response.headers,
+            body=body,
+            encoding=encoding,
+            truncated=truncated,
+            text="".join(pieces) if decoder is not None else None,
+        )
+
+
+# Глобальный реестр процесса
+http_clients = HTTPClientRegistry()
@@ -0,0 +1,292 @@
+"""
+Персистентная очередь задач батч-анализа
+SQLite-хранилище с семантикой lease/ack: задача, взятая упавшим воркером, возвращается в очередь по истечении аренды
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+JOB_STATUSES = ("pending", "leased", "done", "failed")
+
+
+class Job:
+    """Задача очереди"""
+    def __init__(self, id: int, payload: Dict[str, Any], session_id: Optional[str],
+                 attempts: int, lease_until: Optional[float] = None):
+        self.id = id
+        self.payload = payload
+        self.session_id = session_id
+        self.attempts = attempts
+        self.lease_until = lease_until
+
+
+class JobQueue:
+    """Очередь задач на SQLite, общая для web-процесса и отдельных воркеров (один файл на хосте/томе).
+
+    ENV:
+      JOB_QUEUE_PATH        — путь к SQLite-файлу (.cache/jobs.sqlite)
+      JOB_LEASE_SECONDS     — срок аренды задачи воркером, сек (300); продлевается, пока задача выполняется
+      JOB_MAX_ATTEMPTS      — попыток до перевода задачи в failed (3)
+    """
+
+    def __init__(self, path: Optional[str] = None, lease_seconds: Optional[float] = None,
+                 max_attempts: Optional[int] = None):
+        self.path = path or os.getenv("JOB_QUEUE_PATH", os.path.join(".cache", "jobs.sqlite"))
+        self.lease_seconds = lease_seconds if lease_seconds is not None else float(os.getenv("JOB_LEASE_SECONDS", "300"))
+        self.max_attempts = max_attempts if max_attempts is not None else int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    dedup_key TEXT UNIQUE,
+                    session_id TEXT,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_owner TEXT,
+                    lease_until REAL,
+                    last_error TEXT,
+                    fair_rank INTEGER NOT NULL DEFAULT 0,
+                    fair_key TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "fair_rank" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN fair_rank INTEGER NOT NULL DEFAULT 0")
+            if "fair_key" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN fair_key TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, lease_until)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_session ON jobs(session_id, status)")
+            # Выдача pending по индексу без сортировки всей очереди (сотни тысяч задач)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_fair ON jobs(status, fair_rank, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_fair_key ON jobs(fair_key, status, fair_rank)")
+            self._conn = conn
+        return self._conn
+
+    # --- синхронные операции (выполняются в отдельном потоке) ---
+
+    @staticmethod
+    def _fair_ranks(conn: sqlite3.Connection, items: List[Dict[str, Any]]) -> List[int]:
+        """Ранги чередования с учетом уже ожидающих задач: новые ключи начинают с текущего круга
+        (минимальный ранг pending), известные — продолжают свою последовательность"""
+        base = conn.execute("SELECT MIN(fair_rank) FROM jobs WHERE status = 'pending'").fetchone()[0] or 0
+        next_rank: Dict[str, int] = {}
+        ranks = []
+        for item in items:
+            fair_key = item.get("fair_key")
+            if fair_key is None:
+                ranks.append(base)
+                continue
+            if fair_key not in next_rank:
+                last = conn.execute(
+                    "SELECT MAX(fair_rank) FROM jobs WHERE fair_key = ? AND status IN ('pending', 'leased')",
+                    (fair_key,),
+                ).fetchone()[0]
+                next_rank[fair_key] = base if last is None else max(base, last + 1)
+            ranks.append(next_rank[fair_key])
+            next_rank[fair_key] += 1
+        return ranks
+
+    def _enqueue_sync(self, items: List[Dict[str, Any]]) -> int:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            # BEGIN IMMEDIATE: ранги считаются и записываются атомарно между процессами
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                ranks = self._fair_ranks(conn, items)
+                rows = [
+                    (item.get("dedup_key"), item.get("session_id"), json.dumps(item["payload"], ensure_ascii=False),
+                     rank, item.get("fair_key"), now, now)
+                    for item, rank in zip(items, ranks)
+                ]
+                before = conn.total_changes
+                # Завершенная задача с тем же dedup_key возвращается в pending; счетчик попыток
+                # сохраняется, поэтому исчерпавшая попытки задача сразу уходит в on_failed воркера
+                conn.executemany(
+                    "INSERT INTO jobs (dedup_key, session_id, payload, fair_rank, fair_key, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(dedup_key) DO UPDATE SET status = 'pending', session_id = excluded.session_id, "
+                    "payload = excluded.payload, fair_rank = excluded.fair_rank, fair_key = excluded.fair_key, "
+                    "last_error = NULL, updated_at = excluded.updated_at "
+                    "WHERE jobs.status IN ('done', 'failed')",
+                    rows,
+                )
+                added = conn.total_changes - before
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return added
+
+    def _lease_sync(self, owner: str, limit: int) -> List[Job]:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            # BEGIN IMMEDIATE: выборка и захват атомарны между процессами
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Сначала задачи с истекшей арендой, затем pending в порядке чередования
+                rows = conn.execute(
+                    "SELECT id, payload, session_id, attempts FROM jobs "
+                    "WHERE status = 'leased' AND lease_until < ? ORDER BY lease_until LIMIT ?",
+                    (now, limit),
+                ).fetchall()
+                if len(rows) < limit:
+                    rows += conn.execute(
+                        "SELECT id, payload, session_id, attempts FROM jobs "
+                        "WHERE status = 'pending' ORDER BY fair_rank, id LIMIT ?",
+                        (limit - len(rows),),
+                    ).fetchall()
+                lease_until = now + self.lease_seconds
+                conn.executemany(
+                    "UPDATE jobs SET status = 'leased', lease_owner = ?, lease_until = ?, "
+                    "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    [(owner, lease_until, now, row[0]) for row in rows],
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return [Job(row[0], json.loads(row[1]), row[2], row[3] + 1, lease_until) for row in rows]
+
+    def _extend_sync(self, job_ids: List[int], owner: str):
+        now = time.time()
+        with self._lock:
+            self._connect().executemany(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+                [(now + self.lease_seconds, now, job_id, owner) for job_id in job_ids],
+            )
+
+    def _finish_sync(self, job_id: int, status: str, error: Optional[str]):
+        with self._lock:
+            self._connect().execute(
+                "UPDATE jobs SET status = ?, last_error = ?, lease_owner = NULL, lease_until = NULL, updated_at = ? "
+                "WHERE id = ?",
+                (status, error, time.time(), job_id),
+            )
+
+    def _requeue_sync(self, job_id: int):
+        with self._lock:
+            self._connect().execute(
+                "UPDATE jobs SET status = 'pending', attempts = MAX(attempts - 1, 0), lease_owner = NULL, "
+                "lease_until = NULL, updated_at = ? WHERE id = ? AND status = 'leased'",
+                (time.time(), job_id),
+            )
+
+    def _remaining_sync(self, session_id: str) -> int:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM jobs WHERE session_id = ? AND status IN ('pending', 'leased')", (session_id,)
+            ).fetchone()[0]
+
+    def _is_drained_sync(self, session_id: str) -> bool:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT 1 FROM jobs WHERE session_id = ? AND status IN ('pending', 'leased') LIMIT 1", (session_id,)
+            ).fetchone() is None
+
+    def _stats_sync(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        stats = {status: 0 for status in JOB_STATUSES}
+        stats.update(dict(rows))
+        return stats
+
+    # --- асинхронный интерфейс ---
+
+    async def enqueue(self, payloads: Iterable[Dict[str, Any]], session_id: Optional[str] = None,
+                      dedup_keys: Optional[Iterable[Optional[str]]] = None,
+                      fair_keys: Optional[Iterable[str]] = None) -> int:
+        """Добавление задач. Возвращает число добавленных.
+
+        Задача с dedup_key ожидающей или выполняемой задачи пропускается; завершенная (done/failed)
+        задача с тем же ключом ставится заново — например, когда ее результат не дошел до session_domains.
+
+        fair_keys (например, хост) чередуют задачи при выдаче: сначала первые задачи каждого ключа,
+        затем вторые и т.д., чтобы один хост не занимал всех воркеров. Чередование сквозное для всех
+        вызовов enqueue (частей загрузки и сессий), а не только внутри одного вызова.
+        """
+        payloads = list(payloads)
+        keys = list(dedup_keys) if dedup_keys is not None else [None] * len(payloads)
+        fair = list(fair_keys) if fair_keys is not None else [None] * len(payloads)
+        items = [
+            {"payload": p, "session_id": session_id, "dedup_key": k, "fair_key": f}
+            for p, k, f in zip(payloads, keys, fair)
+        ]
+        return await asyncio.to_thread(self._enqueue_sync, items)
+
+    async def lease(self, owner: str, limit: int = 1) -> List[Job]:
+        """Захват до limit задач: ожидающих или с истекшей арендой"""
+        return await asyncio.to_thread(self._lease_sync, owner, limit)
+
+    async def extend(self, job_ids: List[int], owner: str):
+        """Продление аренды выполняющихся задач"""
+        if job_ids:
+            await asyncio.to_thread(self._extend_sync, job_ids, owner)
+
+    async def ack(self, job: Job):
+        await asyncio.to_thread(self._finish_sync, job.id, "done", None)
+
+    async def fail(self, job: Job, error: str):
+        await asyncio.to_thread(self._finish_sync, job.id, "failed", error)
+
+    async def release(self, job: Job, error: str):
+        """Возврат задачи в очередь после ошибки (или failed, если попытки исчерпаны)"""
+        status = "failed" if job.attempts >= self.max_attempts else "pending"
+        await asyncio.to_thread(self._finish_sync, job.id, status, error)
+        return status
+
+    async def requeue(self, job: Job):
+        """Возврат прерванной задачи (остановка воркера) без расхода попытки"""
+        await asyncio.to_thread(self._requeue_sync, job.id)
+
+    async def remaining(self, session_id: str) -> int:
+        """Незавершенных задач сессии"""
+        return await asyncio.to_thread(self._remaining_sync, session_id)
+
+    async def is_drained(self, session_id: str) -> bool:
+        """Все задачи сессии завершены (без подсчета — проверяется после каждой задачи)"""
+        return await asyncio.to_thread(self._is_drained_sync, session_id)
+
+    async def stats(self) -> Dict[str, int]:
+        return await asyncio.to_thread(self._stats_sync)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_job_queue: Optional[JobQueue] = None
+
+
+def get_job_queue() -> JobQueue:
+    """Глобальная очередь процесса"""
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = JobQueue()
+    return _job_queue
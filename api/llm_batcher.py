@@ -0,0 +1,119 @@
+"""
+Микро-батчинг запросов к LLM
+Одновременные однотипные запросы разных анализов собираются в течение короткого окна
+и отправляются одним запросом; ответ раскладывается обратно по ожидающим
+"""
+
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Отправка пачки: элементы -> результат для каждого элемента (None — элемент обрабатывается отдельно)
+BatchSender = Callable[[List[Any]], Awaitable[List[Optional[Any]]]]
+
+
+class _Batch:
+    """Открытая пачка: элементы, ожидающие их futures и функция отправки первого участника"""
+    def __init__(self, send: BatchSender):
+        self.send = send
+        self.items: List[Any] = []
+        self.futures: List[asyncio.Future] = []
+        self.tokens = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class MicroBatcher:
+    """Сбор запросов в пачки по ключу: окно LLM_BATCH_WINDOW_MS с момента первого запроса,
+    не больше LLM_BATCH_MAX_SITES элементов и LLM_BATCH_MAX_TOKENS оценочных токенов.
+
+    submit() возвращает None, если элемент нужно обработать обычным одиночным запросом:
+    пачка из одного элемента, ошибка отправки или элемент пропал из ответа.
+
+    ENV:
+      LLM_BATCH_ENABLED      — включить объединение запросов batch-анализов (true)
+      LLM_BATCH_WINDOW_MS    — окно сбора пачки, мс (50)
+      LLM_BATCH_MAX_SITES    — максимум элементов в пачке (8)
+      LLM_BATCH_MAX_TOKENS   — предел суммы оценок токенов элементов пачки (6000)
+    """
+
+    def __init__(self, window: Optional[float] = None, max_items: Optional[int] = None,
+                 max_tokens: Optional[int] = None):
+        self.enabled = os.getenv("LLM_BATCH_ENABLED", "true").lower() == "true"
+        self.window = window if window is not None else float(os.getenv("LLM_BATCH_WINDOW_MS", "50")) / 1000
+        self.max_items = max_items or int(os.getenv("LLM_BATCH_MAX_SITES", "8"))
+        self.max_tokens = max_tokens or int(os.getenv("LLM_BATCH_MAX_TOKENS", "6000"))
+        self.stats = {"batches": 0, "batched_items": 0, "single": 0, "failed": 0, "missing": 0}
+        self._open: Dict[str, _Batch] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, key: str, item: Any, tokens: int, send: BatchSender) -> Optional[Any]:
+        """Результат элемента из общей пачки или None"""
+        if not self.enabled or self.max_items < 2:
+            return None
+        batch = self._open.get(key)
+        if batch is not None and batch.tokens + tokens > self.max_tokens:
+            self._flush(key)
+            batch = None
+        if batch is None:
+            batch = self._open[key] = _Batch(send)
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+        future = asyncio.get_running_loop().create_future()
+        batch.items.append(item)
+        batch.futures.append(future)
+        batch.tokens += tokens
+        if len(batch.items) >= self.max_items:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key: str):
+        batch = self._open.pop(key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: _Batch):
+        # Отмененные ожидающие (анализ прерван) в запрос не попадают
+        live = [(item, future) for item, future in zip(batch.items, batch.futures) if not future.done()]
+        results: List[Optional[Any]] = [None] * len(live)
+        if len(live) < 2:
+            self.stats["single"] += len(live)
+        else:
+            try:
+                results = list(await batch.send([item for item, _ in live]))
+                self.stats["batches"] += 1
+                self.stats["batched_items"] += len(live)
+                self.stats["missing"] += sum(1 for result in results if result is None)
+            except Exception as e:
+                logger.warning(f"Batched LLM request failed, falling back to per-item calls: {e}")
+                self.stats["failed"] += 1
+                results = [None] * len(live)
+        for (_, future), result in zip(live, results):
+            if not future.done():
+                future.set_result(result)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "window_ms": round(self.window * 1000),
+            "max_items": self.max_items,
+            "max_tokens": self.max_tokens,
+            "open_batches": len(self._open),
+            **self.stats,
+        }
+
+
+_llm_batcher: Optional[MicroBatcher] = None
+
+
+def get_llm_batcher() -> MicroBatcher:
+    """Глобальный batcher процесса (ENV читается при первом обращении)"""
+    global _llm_batcher
+    if _llm_batcher is None:
+        _llm_batcher = MicroBatcher()
+    return _llm_batcher
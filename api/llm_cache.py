@@ -0,0 +1,149 @@
+"""
+Кэш ответов LLM с адресацией по содержимому
+Ключ: (модель, generation config, этап, хэш промпта). Два уровня: LRU в памяти и SQLite на диске
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(model_name: str, generation_config: Optional[Dict[str, Any]], stage: str, prompt: str) -> str:
+    """Детерминированный ключ кэша"""
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    material = json.dumps(
+        [model_name, generation_config or {}, stage, prompt_hash],
+        sort_keys=True, ensure_ascii=False, default=str,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """Двухуровневый кэш ответов LLM.
+
+    ENV:
+      LLM_CACHE_ENABLED       — включить кэш (true)
+      LLM_CACHE_PATH          — путь к SQLite-файлу (.cache/llm.sqlite)
+      LLM_CACHE_TTL           — время жизни записи, сек (604800)
+      LLM_CACHE_MEMORY_ITEMS  — размер LRU в памяти (1024)
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl_seconds: Optional[float] = None,
+                 memory_items: Optional[int] = None):
+        self.path = path or os.getenv("LLM_CACHE_PATH", os.path.join(".cache", "llm.sqlite"))
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else float(os.getenv("LLM_CACHE_TTL", "604800"))
+        self.memory_items = memory_items if memory_items is not None else int(os.getenv("LLM_CACHE_MEMORY_ITEMS", "1024"))
+        self.stats = {"hits": 0, "misses": 0}
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    stage TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_created_at ON responses(created_at)")
+            self._conn = conn
+        return self._conn
+
+    def _remember(self, key: str, response: str, created_at: float):
+        self._memory[key] = (response, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _get_memory(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._memory.get(key)
+            if item is None:
+                return None
+            response, created_at = item
+            if time.time() - created_at >= self.ttl_seconds:
+                self._memory.pop(key, None)
+                return None
+            self._memory.move_to_end(key)
+            return response
+
+    def _get_disk_sync(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if not row:
+                return None
+            response, created_at = row
+            if time.time() - created_at >= self.ttl_seconds:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._remember(key, response, created_at)
+            return response
+
+    def _put_sync(self, key: str, stage: str, response: str):
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, stage, response, created_at) VALUES (?, ?, ?, ?)",
+                (key, stage, response, now),
+            )
+            conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+
+    async def get(self, key: str) -> Optional[str]:
+        response = self._get_memory(key)
+        if response is None:
+            try:
+                response = await asyncio.to_thread(self._get_disk_sync, key)
+            except Exception as e:
+                logger.warning(f"LLM cache read failed: {e}")
+                response = None
+        self.stats["hits" if response is not None else "misses"] += 1
+        return response
+
+    async def put(self, key: str, stage: str, response: str):
+        try:
+            await asyncio.to_thread(self._put_sync, key, stage, response)
+        except Exception as e:
+            logger.warning(f"LLM cache write failed: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_llm_cache: Optional[LLMResponseCache] = None
+
+
+def get_llm_cache() -> Optional[LLMResponseCache]:
+    """Глобальный кэш процесса (None если отключен через LLM_CACHE_ENABLED=false)"""
+    global _llm_cache
+    if os.getenv("LLM_CACHE_ENABLED", "true").lower() != "true":
+        return None
+    if _llm_cache is None:
+        _llm_cache = LLMResponseCache()
+    return _llm_cache
@@ -7,18 +7,15 @@ import asyncio
 import logging
 import os
 import sys
-from datetime import datetime
-from typing import Dict, Any, Optional
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional
 import time
 import json
-import httpx
-from bs4 import BeautifulSoup
-import google.generativeai as genai
-from supabase import create_client, Client
-from collections import defaultdict, deque
-from fastapi.responses import PlainTextResponse
+from collections import defaultdict
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import uvicorn
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Response
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
+from starlette.requests import ClientDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, Field
@@ -39,7 +36,25 @@ sys.path.insert(0, '/app')
 # sys.path.insert(0, '/app/src')  # Удалено - папка src не используется
 
 # Импорты для 6-этапного анализа
-from analysis_pipeline import EnhancedPipeline
+from analysis_pipeline import EnhancedPipeline, PipelineMode, ProcessingResult, generate_governed
+from http_clients import http_clients
+from fetch_scheduler import url_host
+from extraction_pool import extraction_pool
+from html_extraction import extract_plain_text
+from model_registry import DEFAULT_MODEL_NAME, model_registry
+from job_queue import get_job_queue
+from batch_worker import BatchWorker
+from adaptive_limiter import fetch_limiter, llm_limiter
+from quota_governor import get_quota_governor
+from llm_batcher import get_llm_batcher
+from page_cache import get_page_cache
+from prefilter import get_pre_classifier, load_training_examples
+from result_writer import BatchResultWriter, update_session_progress
+from persistence import Store, create_store
+from auth_cache import InvalidToken, get_token_verifier
+from rate_limiter import rate_limiter
+from batch_ingest import PROFILE_TYPES, RecordReader, detect_format
+from result_reuse import ResultReuseCache, analyzed_at, normalize_domain
 
 # Настройка логирования
 logging.basicConfig(
@@ -71,26 +86,26 @@ app.add_middleware(
 async def options_preflight(path: str):
     return Response(status_code=204)
 
-# Rate limiting (per IP + path)
-_rate_buckets: Dict[str, deque] = defaultdict(deque)
-RATE_LIMIT_MAX = int(os.getenv("RATE_LIMIT_MAX", "60"))
-RATE_LIMIT_WINDOW_SEC = int(os.getenv("RATE_LIMIT_WINDOW_SEC", "60"))
-
+# Rate limiting (GCRA по пользователю или IP + маршрут, см. rate_limiter.RateLimiter)
 @app.middleware("http")
 async def rate_limit(request, call_next):
-    now = time.time()
     try:
-        ip = request.client.host if request.client else "unknown"
-        key = f"{ip}:{request.url.path}"
-        bucket = _rate_buckets[key]
-        # prune old
-        while bucket and now - bucket[0] > RATE_LIMIT_WINDOW_SEC:
-            bucket.popleft()
-        if len(bucket) >= RATE_LIMIT_MAX:
-            return PlainTextResponse("Too Many Requests", status_code=429)
-        bucket.append(now)
-    except Exception:
-        pass
+        client = f"ip:{request.client.host if request.client else 'unknown'}"
+        tier = "anonymous"
+        auth = request.headers.get("authorization", "")
+        if auth.lower().startswith("bearer "):
+            # Только уже проверенные токены: лимит пользователя и уровень по его роли
+            user_id, role = get_token_verifier().known_user(auth[7:].strip())
+            if user_id:
+                client, tier = f"user:{user_id}", role or "user"
+        allowed, retry_after = rate_limiter.check(request.url.path, client, tier)
+        if not allowed:
+            return PlainTextResponse(
+                "Too Many Requests", status_code=429,
+                headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+            )
+    except Exception as e:
+        logger.warning(f"Rate limit check failed: {e}")
     return await call_next(request)
 
 # Простое логирование запросов/ответов
@@ -122,14 +137,29 @@ async def log_requests(request, call_next):
 # Безопасность
 security = HTTPBearer(auto_error=False)
 
-# Supabase client (optional)
-supabase_client: Optional[Client] = None
+# Хранилище (Supabase или локальная замена; optional) — вызовы не блокируют event loop
+store: Optional[Store] = None
+
+# Пачечная запись результатов батчей (хранилище берется на момент сброса)
+result_writer = BatchResultWriter(lambda: store)
+
+# Переиспользование свежих результатов по (domain, profile_type)
+result_reuse = ResultReuseCache(lambda: store)
 
 # Модели данных
 class AnalysisRequest(BaseModel):
     domain: str = Field(..., description="Домен для анализа")
     url: str = Field(..., description="URL для анализа")
     profile_type: str = Field(..., description="Тип профиля для анализа")
+    bypass_llm_cache: bool = Field(False, description="Не использовать закэшированные ответы LLM")
+    mode: PipelineMode = Field(PipelineMode.FULL, description="full — 4 запроса к LLM, fast — один структурированный запрос")
+    max_age: Optional[int] = Field(None, ge=0, description="Вернуть сохраненный результат не старше max_age сек (по умолчанию RESULT_REUSE_MAX_AGE; 0 — не переиспользовать)")
+    force: bool = Field(False, description="Всегда выполнять новый анализ")
+    profile_types: Optional[List[str]] = Field(None, description="Дополнительные профили: одна загрузка и общие этапы, результат по каждому профилю в profiles")
+
+    def all_profiles(self) -> List[str]:
+        """profile_type и profile_types без повторов, profile_type первым"""
+        return list(dict.fromkeys([self.profile_type, *(self.profile_types or [])]))
 
 class AnalysisResponse(BaseModel):
     domain: str
@@ -138,6 +168,8 @@ class AnalysisResponse(BaseModel):
     comment: str
     processing_time: float
     raw_data: Dict[str, Any]
+    reused: bool = False
+    profiles: Optional[Dict[str, "AnalysisResponse"]] = None
 
 class HealthResponse(BaseModel):
     status: str
@@ -192,10 +224,17 @@ class HealthResponse(BaseModel):
 #         raise HTTPException(status_code=400, detail=f"Unsupported profile type: {profile_type}")
 #     return pipelines[profile_type]
 
+async def _load_profile_role(user_id: str) -> Optional[str]:
+    if not store:
+        return None
+    prof = await store.select("profiles", "role", {"id": user_id}, limit=1)
+    return (prof[0] or {}).get("role") if prof else None
+
 async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict[str, Any]:
-    """Верификация JWT токена через Supabase Auth.
+    """Верификация JWT токена: локально (секрет/JWKS) или через Supabase Auth.
 
-    Требует ENV: SUPABASE_URL, SUPABASE_ANON_KEY (или SERVICE_KEY)
+    Требует ENV: SUPABASE_URL, SUPABASE_ANON_KEY (или SERVICE_KEY); для локальной проверки —
+    SUPABASE_JWT_SECRET или доступный JWKS проекта (см. auth_cache.TokenVerifier)
     В non-production режиме при отсутствии ENV — допускает заглушку.
     """
     # Testing/ops bypass
@@ -222,31 +261,39 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         logger.warning("Supabase auth env not set, using stub auth (non-production)")
         return {"user_id": "dev-user", "role": "admin"}
 
+    verifier = get_token_verifier()
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            res = await client.get(
+        # Кэш claims или локальная проверка подписи; None — нужен запрос к Supabase Auth
+        claims = await verifier.verify(token)
+        if claims is None:
+            res = await http_clients.supabase.get(
                 f"{supabase_url.rstrip('/')}/auth/v1/user",
                 headers={
                     "apikey": supabase_api_key,
                     "Authorization": f"Bearer {token}",
                 },
+                timeout=10.0,
             )
             if res.status_code != 200:
                 raise HTTPException(status_code=401, detail="Invalid or expired token")
             user = res.json() or {}
-            user_id = user.get("id")
-            role = "user"
-
-            # Пытаемся получить роль из profiles
-            try:
-                if supabase_client and user_id:
-                    prof = supabase_client.table("profiles").select("role").eq("id", user_id).limit(1).execute()
-                    if getattr(prof, "data", None):
-                        role = (prof.data[0] or {}).get("role", role)
-            except Exception as e:
-                logger.warning(f"Fetch profile role failed: {e}")
-
-            return {"user_id": user_id, "role": role}
+            claims = {"sub": user.get("id")}
+            verifier.stats["remote_verified"] += 1
+            verifier.remember(token, claims, verifier.unverified_exp(token))
+        user_id = claims.get("sub")
+        role = "user"
+
+        # Пытаемся получить роль из profiles (TTL-кэш)
+        try:
+            if user_id:
+                role = await verifier.role(user_id, _load_profile_role, default=role)
+        except Exception as e:
+            logger.warning(f"Fetch profile role failed: {e}")
+
+        return {"user_id": user_id, "role": role}
+    except InvalidToken as e:
+        logger.info(f"Token rejected: {e}")
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
     except HTTPException:
         raise
     except Exception as e:
@@ -254,30 +301,16 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         raise HTTPException(status_code=500, detail="Auth service error")
 
 
-def _get_page_text(url: str, timeout_seconds: float = 10.0) -> str:
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120 Safari/537.36"
-    }
-    with httpx.Client(follow_redirects=True, timeout=timeout_seconds) as client:
-        r = client.get(url, headers=headers)
-        r.raise_for_status()
-        html = r.text
-    soup = BeautifulSoup(html, "lxml")
-    for tag in soup(["script", "style", "noscript", "iframe"]):
-        tag.decompose()
-    text = soup.get_text(" ", strip=True)
-    return text[:6000]
+async def _get_page_text(url: str, timeout_seconds: float = 10.0) -> str:
+    page = await http_clients.fetch_page(url, timeout=timeout_seconds)
+    return await extraction_pool.run(extract_plain_text, page.text)
+
+
+FALLBACK_GENERATION_CONFIG = {"temperature": 0.1, "response_mime_type": "application/json"}
 
 
 def _get_gemini_model():
-    api_key = os.getenv("GOOGLE_API_KEY")
-    if not api_key:
-        raise RuntimeError("GOOGLE_API_KEY is not set")
-    genai.configure(api_key=api_key)
-    return genai.GenerativeModel(
-        model_name="gemini-1.5-flash-latest",
-        generation_config={"temperature": 0.1, "response_mime_type": "application/json"},
-    )
+    return model_registry.get(DEFAULT_MODEL_NAME, FALLBACK_GENERATION_CONFIG)
 
 # API endpoints
 @app.get("/health", response_model=HealthResponse)
@@ -308,33 +341,65 @@ async def health_check():
             version="1.0.0"
         )
 
-async def _run_enhanced_analysis(url: str, domain: str, profile_type: str) -> Dict[str, Any]:
+async def _run_enhanced_analysis(
+    url: str,
+    domain: str,
+    profile_type: str,
+    bypass_llm_cache: bool = False,
+    mode: PipelineMode = PipelineMode.FULL,
+    priority: str = "interactive",
+) -> Dict[str, Any]:
     """6-этапный анализ сайта с использованием EnhancedPipeline."""
     try:
-        pipeline = EnhancedPipeline()
-        result = await pipeline.analyze_website(url, domain, profile_type)
-        
-        # Адаптируем результат к ожидаемому формату
-        return {
-            "domain": result["domain"],
-            "classification": result["classification"],
-            "confidence": result["confidence"],
-            "comment": result["comment"],
-            "processing_time": result["processing_time"],
-            "raw_data": result["raw_data"],
-            "_url": result["url"],
-            "_match": result["decision"] == "ACCEPT",
-            "_relevance_score": result["relevance_score"],
-            "_stages_completed": result["stages_completed"],
-            "_total_stages": result["total_stages"]
-        }
+        pipeline = EnhancedPipeline(bypass_llm_cache=bypass_llm_cache, priority=priority)
+        result = await pipeline.analyze_website(url, domain, profile_type, mode=mode)
+        return _adapt_pipeline_result(result)
     except Exception as e:
         logger.error(f"Enhanced analysis failed for {url}: {e}")
         # Fallback к простому анализу
-        return await _run_minimal_analysis_fallback(url, domain, profile_type)
+        return await _run_minimal_analysis_fallback(url, domain, profile_type, priority)
+
+
+async def _run_enhanced_profiles(
+    url: str,
+    domain: str,
+    profile_types: List[str],
+    bypass_llm_cache: bool = False,
+    mode: PipelineMode = PipelineMode.FULL,
+    priority: str = "interactive",
+) -> Dict[str, Dict[str, Any]]:
+    """Анализ сайта для нескольких профилей одним проходом EnhancedPipeline: {профиль: результат}."""
+    try:
+        pipeline = EnhancedPipeline(bypass_llm_cache=bypass_llm_cache, priority=priority)
+        result = await pipeline.analyze_website_profiles(url, domain, profile_types, mode=mode)
+        return {p: _adapt_pipeline_result(r) for p, r in result["profiles"].items()}
+    except Exception as e:
+        logger.error(f"Enhanced multi-profile analysis failed for {url}: {e}")
+        results = await asyncio.gather(
+            *(_run_minimal_analysis_fallback(url, domain, p, priority) for p in profile_types)
+        )
+        return dict(zip(profile_types, results))
+
+
+def _adapt_pipeline_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Адаптация результата EnhancedPipeline к ожидаемому формату"""
+    return {
+        "domain": result["domain"],
+        "classification": result["classification"],
+        "confidence": result["confidence"],
+        "comment": result["comment"],
+        "processing_time": result["processing_time"],
+        "raw_data": result["raw_data"],
+        "_url": result["url"],
+        "_match": result["decision"] == "ACCEPT",
+        "_relevance_score": result["relevance_score"],
+        "_stages_completed": result["stages_completed"],
+        "_total_stages": result["total_stages"]
+    }
 
 
-async def _run_minimal_analysis_fallback(url: str, domain: str, profile_type: str) -> Dict[str, Any]:
+async def _run_minimal_analysis_fallback(url: str, domain: str, profile_type: str,
+                                         priority: str = "interactive") -> Dict[str, Any]:
     """Fallback к простому анализу если 6-этапный не работает."""
     started = time.time()
 
@@ -343,19 +408,20 @@ async def _run_minimal_analysis_fallback(url: str, domain: str, profile_type: st
 
     try:
         # Простое получение контента
-        page_text = await asyncio.to_thread(_get_page_text, url)
+        page_text = await _get_page_text(url)
         if not page_text or len(page_text) < 50:
             raise HTTPException(status_code=422, detail="Insufficient page content")
 
         # Простая классификация
-        model = await asyncio.to_thread(_get_gemini_model)
+        model = _get_gemini_model()
         prompt = (
             f"Analyze this website for {profile_type} profile. "
             f"Content: {page_text[:2000]}\n\n"
             f"Return JSON: {{'classification': 'category', 'confidence': 0-100, 'reasoning': 'explanation'}}"
         )
 
-        resp = await model.generate_content_async(prompt)
+        # Fallback работает как раз при перегрузке Gemini: те же квота, лимит и штраф за 429
+        resp = await generate_governed(model, prompt, priority, get_quota_governor(), llm_limiter)
         raw_text = (resp.text or "").strip()
         
         try:
@@ -399,43 +465,136 @@ async def _run_minimal_analysis_fallback(url: str, domain: str, profile_type: st
         }
 
 
+def _reused_result(row: Dict[str, Any], started: float) -> Dict[str, Any]:
+    """Строка analyses в формате _run_enhanced_analysis; raw_data.reused — ссылка на исходный анализ"""
+    raw_data = dict(row.get("raw_data") or {})
+    origin = raw_data.pop("reused", None) or {"analysis_id": row.get("id"), "analyzed_at": analyzed_at(row)}
+    raw_data["reused"] = {**origin, "age_seconds": round(time.time() - (origin.get("analyzed_at") or started))}
+    return {
+        "domain": row["domain"],
+        "classification": row.get("result_classification") or "Unknown",
+        "confidence": row.get("result_confidence") or 0,
+        "comment": row.get("result_comment") or "",
+        "processing_time": time.time() - started,
+        "raw_data": raw_data,
+        "_url": row.get("url"),
+    }
+
+
+async def _analyze_with_reuse(
+    url: str,
+    domain: str,
+    profile_type: str,
+    bypass_llm_cache: bool = False,
+    mode: PipelineMode = PipelineMode.FULL,
+    priority: str = "interactive",
+    max_age: Optional[int] = None,
+    force: bool = False,
+) -> Dict[str, Any]:
+    """Свежий сохраненный результат или новый анализ; одновременные анализы одного домена объединяются."""
+    started = time.time()
+    run = lambda: _run_enhanced_analysis(url, domain, profile_type, bypass_llm_cache, mode, priority)
+    if force or max_age == 0 or not result_reuse.enabled:
+        return await run()
+    row = await result_reuse.lookup(domain, profile_type, max_age)
+    if row:
+        return _reused_result(row, started)
+    r, coalesced = await result_reuse.run_once(domain, profile_type, run)
+    if coalesced:
+        r = {**r, "raw_data": {**r["raw_data"], "reused": {"analysis_id": None, "analyzed_at": started, "coalesced": True}}}
+    return r
+
+
+async def _analyze_profiles_with_reuse(
+    url: str,
+    domain: str,
+    profile_types: List[str],
+    bypass_llm_cache: bool = False,
+    mode: PipelineMode = PipelineMode.FULL,
+    priority: str = "interactive",
+    max_age: Optional[int] = None,
+    force: bool = False,
+) -> Dict[str, Dict[str, Any]]:
+    """Несколько профилей: свежие сохраненные результаты переиспользуются, остальные — одним анализом."""
+    started = time.time()
+    results: Dict[str, Dict[str, Any]] = {}
+    if not (force or max_age == 0 or not result_reuse.enabled):
+        rows = await asyncio.gather(*(result_reuse.lookup(domain, p, max_age) for p in profile_types))
+        results = {p: _reused_result(row, started) for p, row in zip(profile_types, rows) if row}
+    missing = [p for p in profile_types if p not in results]
+    if missing:
+        results.update(await _run_enhanced_profiles(url, domain, missing, bypass_llm_cache, mode, priority))
+    return {p: results[p] for p in profile_types}
+
+
+def _analysis_response(r: Dict[str, Any]) -> AnalysisResponse:
+    return AnalysisResponse(
+        domain=r["domain"],
+        classification=r["classification"],
+        confidence=r["confidence"],
+        comment=r["comment"],
+        processing_time=r["processing_time"],
+        raw_data=r["raw_data"],
+        reused="reused" in r["raw_data"],
+    )
+
+
+async def _save_analysis(token_data: Dict[str, Any], request: AnalysisRequest, url: str,
+                         response_obj: AnalysisResponse, profile_type: Optional[str] = None):
+    """Save to Supabase if configured (best-effort); результат доступен для переиспользования"""
+    profile_type = profile_type or request.profile_type
+    payload = {
+        "user_id": token_data.get("user_id"),
+        "domain": normalize_domain(request.domain),
+        "url": url,
+        "profile_type": profile_type,
+        "status": "completed",
+        "result_classification": response_obj.classification,
+        "result_confidence": response_obj.confidence,
+        "result_comment": response_obj.comment,
+        "processing_time_seconds": round(response_obj.processing_time, 2),
+        "raw_data": response_obj.raw_data,
+    }
+    row = {**payload, "created_at": datetime.now(timezone.utc).isoformat()}
+    try:
+        if store:
+            row.update((await store.insert("analyses", [payload]) or [{}])[0])
+    except Exception as e:
+        logger.warning(f"Supabase save failed: {e}")
+    result_reuse.remember(request.domain, profile_type, row)
+
+
 @app.post("/analyze", response_model=AnalysisResponse)
 async def analyze_website(
     request: AnalysisRequest,
     token_data: Dict[str, Any] = Depends(verify_token),
 ):
-    """6-этапный анализ сайта: EnhancedPipeline с fallback к простому анализу."""
+    """6-этапный анализ сайта: EnhancedPipeline с fallback к простому анализу.
+
+    С profile_types сайт загружается и разбирается один раз для всех профилей; ответ — результат
+    profile_type, результаты всех профилей — в profiles (каждый сохраняется отдельно).
+    """
 
     try:
-        r = await _run_enhanced_analysis(request.url, request.domain, request.profile_type)
-        response_obj = AnalysisResponse(
-            domain=r["domain"],
-            classification=r["classification"],
-            confidence=r["confidence"],
-            comment=r["comment"],
-            processing_time=r["processing_time"],
-            raw_data=r["raw_data"],
+        profile_types = request.all_profiles()
+        if len(profile_types) > 1:
+            results = await _analyze_profiles_with_reuse(
+                request.url, request.domain, profile_types, request.bypass_llm_cache, request.mode,
+                max_age=request.max_age, force=request.force,
+            )
+            profiles = {}
+            for p, r in results.items():
+                profiles[p] = _analysis_response(r)
+                await _save_analysis(token_data, request, r["_url"], profiles[p], p)
+            return profiles[request.profile_type].model_copy(update={"profiles": profiles})
+
+        r = await _analyze_with_reuse(
+            request.url, request.domain, request.profile_type, request.bypass_llm_cache, request.mode,
+            max_age=request.max_age, force=request.force,
         )
+        response_obj = _analysis_response(r)
 
-        # Save to Supabase if configured (best-effort)
-        try:
-            if supabase_client:
-                payload = {
-                    "user_id": token_data.get("user_id"),
-                    "domain": request.domain,
-                    "url": r["_url"],
-                    "profile_type": request.profile_type,
-                    "status": "completed",
-                    "result_classification": response_obj.classification,
-                    "result_confidence": response_obj.confidence,
-                    "result_comment": response_obj.comment,
-                    "processing_time_seconds": round(response_obj.processing_time, 2),
-                    "raw_data": response_obj.raw_data,
-                }
-                supabase_client.table("analyses").insert(payload).execute()
-        except Exception as e:
-            logger.warning(f"Supabase save failed: {e}")
-
+        await _save_analysis(token_data, request, r["_url"], response_obj)
         return response_obj
 
     except HTTPException:
@@ -454,7 +613,7 @@ async def analyze_website(
 
         # Attempt to store failed analysis too
         try:
-            if supabase_client:
+            if store:
                 payload = {
                     "user_id": token_data.get("user_id"),
                     "domain": request.domain,
@@ -464,38 +623,107 @@ async def analyze_website(
                     "error_message": str(e),
                     "raw_data": response_obj.raw_data,
                 }
-                supabase_client.table("analyses").insert(payload).execute()
+                await store.insert("analyses", [payload])
         except Exception as se:
             logger.warning(f"Supabase save (failed case) error: {se}")
 
         return response_obj
 
+STREAM_FORMATS = {"sse": "text/event-stream", "ndjson": "application/x-ndjson"}
+
+def _stream_line(fmt: str, event: str, data: Dict[str, Any]) -> str:
+    body = json.dumps(data, ensure_ascii=False, default=str)
+    if fmt == "sse":
+        return f"event: {event}\ndata: {body}\n\n"
+    return json.dumps({"event": event, **data}, ensure_ascii=False, default=str) + "\n"
+
+@app.post("/analyze/stream")
+async def analyze_website_stream(
+    request: AnalysisRequest,
+    format: str = "sse",
+    token_data: Dict[str, Any] = Depends(verify_token),
+):
+    """Потоковый вариант /analyze: событие stage на каждый завершенный этап, result — последним.
+
+    format=sse (text/event-stream) или ndjson (application/x-ndjson). Клиент может закрыть
+    соединение в любой момент — анализ отменяется и не сохраняется. Свежий сохраненный результат
+    (см. max_age/force) возвращается сразу одним событием result.
+    """
+    if format not in STREAM_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported stream format: {format}")
+
+    async def events():
+        started = time.time()
+        row = None
+        if not request.force and request.max_age != 0:
+            row = await result_reuse.lookup(request.domain, request.profile_type, request.max_age)
+        if row:
+            final = _reused_result(row, started)
+            response_obj = _analysis_response(final)
+            await _save_analysis(token_data, request, final["_url"], response_obj)
+            yield _stream_line(format, "result", response_obj.model_dump())
+            return
+
+        pipeline = EnhancedPipeline(bypass_llm_cache=request.bypass_llm_cache, priority="interactive")
+        final: Optional[Dict[str, Any]] = None
+        try:
+            async for item in pipeline.analyze_website_stream(
+                request.url, request.domain, request.profile_type, mode=request.mode
+            ):
+                if isinstance(item, ProcessingResult):
+                    yield _stream_line(format, "stage", {
+                        "stage": item.stage.value,
+                        "success": item.success,
+                        "duration": item.duration,
+                        "data": item.data,
+                        "error": item.error,
+                    })
+                else:
+                    final = _adapt_pipeline_result(item)
+        except Exception as e:
+            logger.error(f"Analyze stream error for {request.url}: {e}")
+            yield _stream_line(format, "error", {"error": str(e)})
+            return
+        if final is None:
+            logger.error(f"Analyze stream for {request.url} ended without a result")
+            yield _stream_line(format, "error", {"error": "Analysis finished without a result"})
+            return
+        response_obj = _analysis_response(final)
+        await _save_analysis(token_data, request, final["_url"], response_obj)
+        yield _stream_line(format, "result", response_obj.model_dump())
+
+    # X-Accel-Buffering: события не копятся в буфере nginx
+    return StreamingResponse(
+        events(), media_type=STREAM_FORMATS[format],
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.post("/analyze-batch")
 async def analyze_batch(
     requests: list[AnalysisRequest],
-    background_tasks: BackgroundTasks,
     token_data: Dict[str, Any] = Depends(verify_token),
 ):
-    """Анализ батча сайтов: создает сессию (Supabase) и запускает фоновой процесс."""
+    """Анализ батча сайтов: создает сессию (Supabase) и ставит домены в персистентную очередь."""
 
     if len(requests) > 100:
         raise HTTPException(status_code=400, detail="Batch size too large (max 100)")
 
     session_id = None
+    domain_rows = []
     try:
-        if supabase_client:
+        if store:
             # Создаем сессию
             name = f"session-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
             profile_type = requests[0].profile_type if requests else "software"
-            insert_res = supabase_client.table("analysis_sessions").insert({
+            sessions = await store.insert("analysis_sessions", [{
                 "user_id": token_data.get("user_id"),
                 "name": name,
                 "profile_type": profile_type,
                 "total_domains": len(requests),
                 "status": "processing",
                 "started_at": datetime.now().isoformat(),
-            }).execute()
-            session_id = (insert_res.data or [{}])[0].get("id")
+            }])
+            session_id = (sessions or [{}])[0].get("id")
 
             # Добавляем домены
             rows = [{
@@ -503,91 +731,373 @@ async def analyze_batch(
                 "domain": r.domain,
                 "url": r.url,
                 "status": "pending",
+                "job_options": _job_options(r),
             } for r in requests]
-            supabase_client.table("session_domains").insert(rows).execute()
+            domain_rows = await store.insert("session_domains", rows)
     except Exception as e:
         logger.warning(f"Supabase session init failed: {e}")
 
-    # Запуск фона
-    background_tasks.add_task(process_batch_analysis, requests, token_data, session_id)
+    # Постановка в очередь: задачи переживают рестарт и подхватываются воркерами
+    domain_ids = [domain_rows[i].get("id") if i < len(domain_rows) else None for i in range(len(requests))]
+    payloads = [
+        _batch_job_payload(r, token_data.get("user_id"), session_id, domain_id)
+        for r, domain_id in zip(requests, domain_ids)
+    ]
+    dedup_keys = [f"session_domain:{domain_id}" if domain_id else None for domain_id in domain_ids]
+    queued = await get_job_queue().enqueue(
+        payloads, session_id=session_id, dedup_keys=dedup_keys, fair_keys=[url_host(r.url) for r in requests]
+    )
 
     return {
         "message": f"Batch analysis started for {len(requests)} websites",
         "session_id": session_id,
+        "queued": queued,
+        "concurrency": {"fetch": fetch_limiter.limit, "llm": llm_limiter.limit},
     }
 
-async def process_batch_analysis(
-    requests: list[AnalysisRequest],
-    token_data: Dict[str, Any],
-    session_id: Optional[str] = None,
+@app.post("/analyze-batch/upload")
+async def analyze_batch_upload(
+    request: Request,
+    profile_type: str = "software",
+    mode: PipelineMode = PipelineMode.FULL,
+    format: Optional[str] = None,
+    max_age: Optional[int] = None,
+    force: bool = False,
+    token_data: Dict[str, Any] = Depends(verify_token),
 ):
-    """Обработка батча: параллельный минимальный анализ + сохранение в Supabase."""
-
-    logger.info(f"Batch analysis started: {len(requests)} websites, session={session_id}")
-    semaphore = asyncio.Semaphore(5)
-    results = []
-    errors = []
-
-    async def worker(req: AnalysisRequest):
-        async with semaphore:
-            try:
-                r = await _run_enhanced_analysis(req.url, req.domain, req.profile_type)
-
-                # Save to analyses
-                analysis_id = None
-                try:
-                    if supabase_client:
-                        payload = {
-                            "user_id": token_data.get("user_id"),
-                            "domain": req.domain,
-                            "url": r["_url"],
-                            "profile_type": req.profile_type,
-                            "status": "completed",
-                            "result_classification": r["classification"],
-                            "result_confidence": r["confidence"],
-                            "result_comment": r["comment"],
-                            "processing_time_seconds": round(r["processing_time"], 2),
-                            "raw_data": r["raw_data"],
-                        }
-                        ins = supabase_client.table("analyses").insert(payload).execute()
-                        analysis_id = (ins.data or [{}])[0].get("id")
-                        if session_id:
-                            # update session_domains
-                            supabase_client.table("session_domains").update({
-                                "status": "completed",
-                                "analysis_id": analysis_id,
-                            }).eq("session_id", session_id).eq("domain", req.domain).execute()
-                except Exception as se:
-                    logger.warning(f"Supabase save in batch failed: {se}")
-
-                results.append({"domain": req.domain, "analysis_id": analysis_id, "result": r})
-            except Exception as e:
-                errors.append({"domain": req.domain, "error": str(e)})
-                try:
-                    if supabase_client and session_id:
-                        supabase_client.table("session_domains").update({
-                            "status": "failed",
-                        }).eq("session_id", session_id).eq("domain", req.domain).execute()
-                except Exception:
-                    pass
-
-    await asyncio.gather(*(worker(r) for r in requests))
-
-    # finalize session
+    """Батч любого размера: тело — CSV (url,domain[,profile_type]) или NDJSON, читается потоком.
+
+    Домены пачками пишутся в session_domains и ставятся в очередь по мере чтения, поэтому обработка
+    начинается до окончания загрузки. Пока идет загрузка, сессия в статусе pending (не закрывается
+    воркерами); прогресс — GET /analyze-batch/{session_id}/progress. Формат — по format=csv|ndjson
+    или Content-Type. Если чтение прервалось, когда часть доменов уже в очереди, ответ — 207 с error
+    и числом поставленных доменов (они будут обработаны; повторять загрузку целиком не нужно).
+    """
+    try:
+        fmt = detect_format(request.headers.get("content-type"), format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if profile_type not in PROFILE_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported profile type: {profile_type}")
+
+    user_id = token_data.get("user_id")
+    reader = RecordReader(fmt, profile_type)
+    session_id = None
+    if store:
+        try:
+            sessions = await store.insert("analysis_sessions", [{
+                "user_id": user_id,
+                "name": f"upload-{datetime.now().strftime('%Y%m%d-%H%M%S')}",
+                "profile_type": profile_type,
+                "total_domains": 0,
+                "status": "pending",
+                "started_at": datetime.now().isoformat(),
+            }])
+            session_id = (sessions or [{}])[0].get("id")
+        except Exception as e:
+            logger.warning(f"Supabase session init failed: {e}")
+
+    queue = get_job_queue()
+    queued = 0
+    # Домены, записанные в сессию; при обрыве посреди пачки ее прочитанная часть не учитывается
+    registered = 0
+    error = None
+    try:
+        async for chunk in reader.chunks(request.stream()):
+            analysis_requests = [
+                AnalysisRequest(domain=record["domain"], url=record["url"],
+                                profile_type=record["profile_type"], mode=mode, max_age=max_age, force=force)
+                for record in chunk
+            ]
+            domain_rows = []
+            if session_id:
+                domain_rows = await store.insert("session_domains", [{
+                    "session_id": session_id,
+                    "domain": r.domain,
+                    "url": r.url,
+                    "status": "pending",
+                    "job_options": _job_options(r),
+                } for r in analysis_requests])
+            domain_ids = [domain_rows[i].get("id") if i < len(domain_rows) else None for i in range(len(chunk))]
+            payloads = [
+                _batch_job_payload(r, user_id, session_id, domain_id)
+                for r, domain_id in zip(analysis_requests, domain_ids)
+            ]
+            queued += await queue.enqueue(
+                payloads, session_id=session_id,
+                dedup_keys=[f"session_domain:{domain_id}" if domain_id else None for domain_id in domain_ids],
+                fair_keys=[url_host(record["url"]) for record in chunk],
+            )
+            registered += len(chunk)
+            if session_id:
+                await store.update("analysis_sessions", {"total_domains": registered}, {"id": session_id})
+    except (ValueError, ClientDisconnect) as e:
+        # Уже поставленные домены обрабатываются; сессия закрывается с тем, что успели прочитать
+        error = str(e) or "Client disconnected"
+        logger.warning(f"Batch upload interrupted after {registered} domains: {error}")
+    except Exception as e:
+        error = f"Ingestion failed: {e}"
+        logger.error(f"Batch upload failed after {registered} domains: {e}")
+
+    if session_id:
+        try:
+            await store.update(
+                "analysis_sessions", {"total_domains": registered, "status": "processing"}, {"id": session_id}
+            )
+            # Воркеры могли обработать все задачи раньше, чем закончилась загрузка
+            if await queue.is_drained(session_id):
+                await finalize_batch_session(session_id)
+        except Exception as e:
+            logger.warning(f"Supabase session close failed: {e}")
+
+    result = {
+        "message": f"Batch upload accepted {registered} websites",
+        "session_id": session_id,
+        "queued": queued,
+        "ingest": reader.stats.as_dict(),
+    }
+    if error:
+        if not queued:
+            raise HTTPException(status_code=400, detail={**result, "error": error})
+        # Часть доменов уже в очереди и будет обработана: не 4xx, чтобы клиент не повторял загрузку целиком
+        return JSONResponse(status_code=207, content={**result, "error": error})
+    return result
+
+@app.get("/analyze-batch/{session_id}/progress")
+async def get_batch_progress(session_id: str, token_data: Dict[str, Any] = Depends(verify_token)):
+    """Прогресс сессии: счетчики analysis_sessions и задачи, еще не взятые/не завершенные воркерами"""
+    if not store:
+        raise HTTPException(status_code=503, detail="Persistence not configured")
+    sessions = await store.select(
+        "analysis_sessions",
+        "id, user_id, status, total_domains, processed_domains, successful_analyses, failed_analyses, "
+        "started_at, completed_at",
+        {"id": session_id}, limit=1,
+    )
+    if not sessions:
+        raise HTTPException(status_code=404, detail="Session not found")
+    session = sessions[0]
+    if token_data.get("role") != "admin" and session.get("user_id") != token_data.get("user_id"):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {**session, "queued": await get_job_queue().remaining(session_id)}
+
+@app.get("/analyze-batch/concurrency")
+async def get_batch_concurrency(token_data: Dict[str, Any] = Depends(verify_token)):
+    """Текущие лимиты параллелизма батч-обработки и история их подстройки"""
+    return concurrency_snapshot()
+
+def _job_options(req: AnalysisRequest) -> Dict[str, Any]:
+    """Параметры анализа домена; сохраняются в session_domains.job_options для повторной постановки"""
+    return {
+        "profile_type": req.profile_type,
+        "bypass_llm_cache": req.bypass_llm_cache,
+        "mode": req.mode.value,
+        "max_age": req.max_age,
+        "force": req.force,
+    }
+
+def _batch_job_payload(req: AnalysisRequest, user_id: Optional[str], session_id: Optional[str],
+                       session_domain_id: Optional[str] = None) -> Dict[str, Any]:
+    return {
+        "url": req.url,
+        "domain": req.domain,
+        **_job_options(req),
+        "user_id": user_id,
+        "session_id": session_id,
+        "session_domain_id": session_domain_id,
+    }
+
+async def process_batch_job(payload: Dict[str, Any]):
+    """Обработка одной задачи батча: анализ + сохранение в Supabase.
+
+    Исключение возвращает задачу в очередь (до JOB_MAX_ATTEMPTS попыток).
+    """
+    session_id = payload.get("session_id")
+    r = await _analyze_with_reuse(
+        payload["url"], payload["domain"], payload["profile_type"],
+        payload.get("bypass_llm_cache", False), PipelineMode(payload.get("mode", PipelineMode.FULL.value)),
+        priority="batch", max_age=payload.get("max_age"), force=payload.get("force", False),
+    )
+
+    row = {
+        "user_id": payload.get("user_id"),
+        "domain": normalize_domain(payload["domain"]),
+        "url": r["_url"],
+        "profile_type": payload["profile_type"],
+        "status": "completed",
+        "result_classification": r["classification"],
+        "result_confidence": r["confidence"],
+        "result_comment": r["comment"],
+        "processing_time_seconds": round(r["processing_time"], 2),
+        "raw_data": r["raw_data"],
+    }
+    # Пачечная запись; ошибка после всех повторов возвращает задачу в очередь
+    analysis_id = await result_writer.write(row, session_id, _session_domain_ref(payload), "completed")
+    result_reuse.remember(
+        payload["domain"], payload["profile_type"],
+        {**row, "id": analysis_id, "created_at": datetime.now(timezone.utc).isoformat()},
+    )
+
+def _session_domain_ref(payload: Dict[str, Any]) -> Dict[str, Any]:
+    return {"id": payload.get("session_domain_id"), "domain": payload["domain"], "url": payload["url"]}
+
+async def mark_batch_job_failed(payload: Dict[str, Any], error: str):
+    """Задача исчерпала попытки"""
+    logger.warning(f"Batch job for {payload.get('domain')} failed: {error}")
+    if not payload.get("session_id"):
+        return
     try:
-        if supabase_client and session_id:
-            supabase_client.table("analysis_sessions").update({
-                "processed_domains": len(results) + len(errors),
-                "successful_analyses": len(results),
-                "failed_analyses": len(errors),
-                "status": "completed",
-                "completed_at": datetime.now().isoformat(),
-            }).eq("id", session_id).execute()
+        await result_writer.write(None, payload["session_id"], _session_domain_ref(payload), "failed")
+    except Exception as e:
+        logger.warning(f"Supabase failed-status save error: {e}")
+
+async def _enqueue_session_domains(session: Dict[str, Any], rows: List[Dict[str, Any]]) -> int:
+    """Постановка в очередь строк session_domains (id, domain, url, job_options) сессии"""
+    payloads = [{
+        "url": row["url"],
+        "domain": row["domain"],
+        "profile_type": session["profile_type"],
+        "bypass_llm_cache": False,
+        "mode": PipelineMode.FULL.value,
+        **(row.get("job_options") or {}),
+        "user_id": session["user_id"],
+        "session_id": session["id"],
+        "session_domain_id": row["id"],
+    } for row in rows]
+    return await get_job_queue().enqueue(
+        payloads, session_id=session["id"], dedup_keys=[f"session_domain:{row['id']}" for row in rows],
+        fair_keys=[url_host(row["url"]) for row in rows],
+    )
+
+async def finalize_batch_session(session_id: str):
+    """Закрытие сессии после обработки всех ее задач (счетчики — по session_domains).
+
+    Домены, оставшиеся pending при пустой очереди (статус не удалось записать), ставятся
+    в очередь заново; сессию закроет последняя из этих задач.
+    """
+    try:
+        if store:
+            # pending — загрузка еще идет, сессию закроет analyze_batch_upload
+            sessions = await store.select(
+                "analysis_sessions", "id, user_id, profile_type, status", {"id": session_id}, limit=1,
+            )
+            if sessions and sessions[0].get("status") == "pending":
+                return
+            stale = await store.select(
+                "session_domains", "id, domain, url, job_options",
+                {"session_id": session_id, "status": ["pending", "processing"]},
+            )
+            if sessions and stale:
+                requeued = await _enqueue_session_domains(sessions[0], stale)
+                logger.warning(f"Batch session {session_id}: {len(stale)} unfinished domains, {requeued} re-enqueued")
+                return
+            counts = await update_session_progress(store, session_id, final=True)
+            logger.info(
+                f"Batch session {session_id} finished: {counts['completed']} ok, {counts['failed']} failed; "
+                f"concurrency fetch={fetch_limiter.limit} llm={llm_limiter.limit}"
+            )
     except Exception as e:
         logger.warning(f"Supabase finalize session failed: {e}")
 
-    logger.info(f"Batch analysis finished: {len(results)} ok, {len(errors)} failed")
-    return {"results": results, "errors": errors}
+async def resume_pending_sessions() -> int:
+    """Повторная постановка в очередь незавершенных доменов сессий (после рестарта/деплоя).
+
+    Кроме сессий processing подхватываются загрузки, прерванные падением процесса: сессии pending
+    старше BATCH_UPLOAD_RESUME_AFTER сек (600) переводятся в processing и закрываются обычным путем.
+    Параметры анализа домена берутся из session_domains.job_options (для старых строк — из сессии).
+    Сессии, все задачи которых уже завершены, закрываются сразу.
+    """
+    if not store:
+        return 0
+    resume_after = float(os.getenv("BATCH_UPLOAD_RESUME_AFTER", "600"))
+    try:
+        sessions = {
+            row["id"]: row
+            for row in await store.select("analysis_sessions", "id, user_id, profile_type", {"status": "processing"})
+        }
+        cutoff = (datetime.now() - timedelta(seconds=resume_after)).isoformat()
+        interrupted = await store.select(
+            "analysis_sessions", "id, user_id, profile_type", {"status": "pending", "started_at<=": cutoff},
+        )
+        for row in interrupted:
+            await store.update("analysis_sessions", {"status": "processing"}, {"id": row["id"]})
+            sessions[row["id"]] = row
+        if interrupted:
+            logger.warning(f"Resuming {len(interrupted)} interrupted batch uploads")
+        rows = await store.select(
+            "session_domains", "id, session_id, domain, url, job_options",
+            {"session_id": list(sessions), "status": ["pending", "processing"]},
+        ) if sessions else []
+    except Exception as e:
+        logger.warning(f"Supabase resume query failed: {e}")
+        return 0
+
+    queue = get_job_queue()
+    by_session: Dict[str, list] = defaultdict(list)
+    for row in rows:
+        by_session[row["session_id"]].append(row)
+    resumed = 0
+    for session_id, rows in by_session.items():
+        resumed += await _enqueue_session_domains(sessions[session_id], rows)
+    # Сессии без незавершенных задач закрываются сразу: процесс мог упасть между ack последней
+    # задачи и закрытием сессии, или прерванная загрузка уже обработана целиком
+    for session_id in sessions:
+        if await queue.is_drained(session_id):
+            await finalize_batch_session(session_id)
+    if resumed:
+        logger.info(f"Resumed {resumed} pending batch jobs from {len(by_session)} sessions")
+    return resumed
+
+def concurrency_snapshot() -> Dict[str, Any]:
+    """Текущие адаптивные лимиты и история их изменений"""
+    quota = get_quota_governor()
+    return {
+        "fetch": fetch_limiter.snapshot(),
+        "llm": llm_limiter.snapshot(),
+        "gemini_quota": quota.snapshot() if quota else None,
+        "llm_batching": get_llm_batcher().snapshot(),
+    }
+
+def build_batch_worker() -> BatchWorker:
+    # Задача большую часть времени либо загружает страницу, либо ждет LLM
+    return BatchWorker(
+        process_batch_job,
+        on_failed=mark_batch_job_failed,
+        on_session_done=finalize_batch_session,
+        capacity=lambda: fetch_limiter.limit + llm_limiter.limit,
+    )
+
+@app.post("/auth/invalidate-role")
+async def invalidate_role(user_id: Optional[str] = None, token_data: Dict[str, Any] = Depends(verify_token)):
+    """Сброс кэша ролей после изменения profiles.role (одного пользователя или всех). Требуется admin."""
+    if os.getenv("SKIP_AUTH", "false").lower() != "true" and token_data.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    verifier = get_token_verifier()
+    verifier.invalidate_role(user_id)
+    return {"invalidated": user_id or "all", "auth": verifier.snapshot()}
+
+@app.get("/prefilter")
+async def get_prefilter(token_data: Dict[str, Any] = Depends(verify_token)):
+    """Состояние локального предварительного классификатора: пороги профилей и число отсеянных сайтов"""
+    return get_pre_classifier().snapshot()
+
+@app.post("/prefilter/train")
+async def train_prefilter(limit: Optional[int] = None, token_data: Dict[str, Any] = Depends(verify_token)):
+    """Обучение предварительного классификатора на истории analyses. Требуется admin."""
+    if os.getenv("SKIP_AUTH", "false").lower() != "true" and token_data.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+    if not store:
+        raise HTTPException(status_code=503, detail="Persistence not configured")
+    classifier = get_pre_classifier()
+    try:
+        examples = await load_training_examples(store, limit or classifier.train_limit)
+        # Обучение — CPU-работа, event loop не блокируется
+        report = await asyncio.to_thread(classifier.fit, examples)
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    logger.info(f"Pre-classifier trained on {report['examples']} analyses")
+    return {**report, "prefilter": classifier.snapshot()}
 
 @app.get("/profiles")
 async def get_available_profiles():
@@ -629,11 +1139,10 @@ async def get_prompts(
     if prompt_type:
         params["prompt_type"] = prompt_type
 
-    async with httpx.AsyncClient(timeout=float(os.getenv("SUPABASE_EDGE_TIMEOUT", "10"))) as client:
-        resp = await client.get(f"{supabase_url.rstrip('/')}/functions/v1/manage-prompts", headers=headers, params=params)
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
-        return resp.json()
+    resp = await http_clients.supabase.get(f"{supabase_url.rstrip('/')}/functions/v1/manage-prompts", headers=headers, params=params)
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    return resp.json()
 
 @app.post("/prompts")
 async def create_prompt(
@@ -652,11 +1161,10 @@ async def create_prompt(
         "Authorization": f"Bearer {os.getenv('SUPABASE_SERVICE_KEY')}",
         "apikey": os.getenv("SUPABASE_SERVICE_KEY") or "",
     }
-    async with httpx.AsyncClient(timeout=float(os.getenv("SUPABASE_EDGE_TIMEOUT", "10"))) as client:
-        resp = await client.post(f"{supabase_url.rstrip('/')}/functions/v1/manage-prompts/create", headers=headers, json=prompt_data)
-        if resp.status_code not in (200, 201):
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
-        return resp.json()
+    resp = await http_clients.supabase.post(f"{supabase_url.rstrip('/')}/functions/v1/manage-prompts/create", headers=headers, json=prompt_data)
+    if resp.status_code not in (200, 201):
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    return resp.json()
 
 @app.put("/prompts/{prompt_id}")
 async def update_prompt(
@@ -676,11 +1184,10 @@ async def update_prompt(
         "apikey": os.getenv("SUPABASE_SERVICE_KEY") or "",
     }
     payload = {"id": prompt_id, **update_data}
-    async with httpx.AsyncClient(timeout=float(os.getenv("SUPABASE_EDGE_TIMEOUT", "10"))) as client:
-        resp = await client.post(f"{supabase_url.rstrip('/')}/functions/v1/manage-prompts/update", headers=headers, json=payload)
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
-        return resp.json()
+    resp = await http_clients.supabase.post(f"{supabase_url.rstrip('/')}/functions/v1/manage-prompts/update", headers=headers, json=payload)
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    return resp.json()
 
 @app.post("/prompts/{prompt_id}/set-default")
 async def set_default_prompt(
@@ -698,11 +1205,52 @@ async def set_default_prompt(
         "Authorization": f"Bearer {os.getenv('SUPABASE_SERVICE_KEY')}",
         "apikey": os.getenv("SUPABASE_SERVICE_KEY") or "",
     }
-    async with httpx.AsyncClient(timeout=float(os.getenv("SUPABASE_EDGE_TIMEOUT", "10"))) as client:
-        resp = await client.post(f"{supabase_url.rstrip('/')}/functions/v1/manage-prompts/set-default", headers=headers, json={"id": prompt_id})
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
-        return resp.json()
+    resp = await http_clients.supabase.post(f"{supabase_url.rstrip('/')}/functions/v1/manage-prompts/set-default", headers=headers, json={"id": prompt_id})
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    return resp.json()
+
+# Режим воркера очереди батчей: embedded | external
+BATCH_WORKER_MODE = os.getenv("BATCH_WORKER_MODE", "embedded").lower()
+_batch_worker_stop = asyncio.Event()
+_batch_worker_task: Optional[asyncio.Task] = None
+
+async def init_runtime():
+    """Клиенты и пулы процесса (web-приложение и отдельный batch_worker.py)"""
+    # Хранилище: Supabase при наличии ENV или локальная замена (PERSISTENCE_BACKEND=sqlite)
+    global store
+    store = create_store()
+    if store:
+        logger.info("Persistence initialized: %s", type(store).__name__)
+    else:
+        logger.info("Supabase env not set, skipping client init")
+
+    # Общие пулы HTTP-соединений
+    await http_clients.start()
+
+    # Пул разбора HTML (прогрев рабочих процессов)
+    await extraction_pool.start()
+
+    # Однократная настройка Gemini (без ключа модели недоступны, но API стартует)
+    try:
+        model_registry.configure()
+    except ValueError as e:
+        logger.warning(f"Gemini is not configured: {e}")
+
+async def shutdown_runtime():
+    await result_writer.close()
+    if store:
+        await store.close()
+    await http_clients.close()
+    extraction_pool.shutdown()
+    get_job_queue().close()
+    rate_limiter.close()
+    quota = get_quota_governor()
+    if quota:
+        quota.close()
+    page_cache = get_page_cache()
+    if page_cache:
+        page_cache.close()
 
 # События приложения
 @app.on_event("startup")
@@ -727,15 +1275,13 @@ async def startup_event():
         supabase_key_present = bool(os.getenv("SUPABASE_SERVICE_KEY") or os.getenv("SUPABASE_ANON_KEY"))
         logger.info("Supabase URL: %s, key: %s", "set" if supabase_url_present else "missing", "set" if supabase_key_present else "missing")
         
-        # Инициализация Supabase при наличии ENV
-        supabase_url = os.getenv("SUPABASE_URL")
-        supabase_key = os.getenv("SUPABASE_SERVICE_KEY") or os.getenv("SUPABASE_ANON_KEY")
-        if supabase_url and supabase_key:
-            global supabase_client
-            supabase_client = create_client(supabase_url, supabase_key)
-            logger.info("Supabase client initialized")
-        else:
-            logger.info("Supabase env not set, skipping client init")
+        await init_runtime()
+
+        # Воркер очереди батчей внутри web-процесса (external — только отдельные процессы batch_worker.py)
+        if BATCH_WORKER_MODE == "embedded":
+            global _batch_worker_task
+            await resume_pending_sessions()
+            _batch_worker_task = asyncio.create_task(build_batch_worker().run(_batch_worker_stop))
 
         logger.info("API initialized successfully (minimal mode)")
         print("✅ API startup completed successfully")
@@ -749,6 +1295,11 @@ async def startup_event():
 async def shutdown_event():
     """Очистка при завершении"""
     logger.info("Shutting down AI Researcher Console API...")
+    if _batch_worker_task is not None:
+        # Прерванные задачи возвращаются в очередь и будут подхвачены после рестарта
+        _batch_worker_stop.set()
+        await _batch_worker_task
+    await shutdown_runtime()
 
 # Запуск сервера
 if __name__ == "__main__":
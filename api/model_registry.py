@@ -0,0 +1,94 @@
+"""
+Реестр моделей Gemini на процесс
+genai.configure выполняется один раз, модели кэшируются по (имя модели, generation_config)
+"""
+
+import importlib
+import json
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import google.generativeai as genai
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+
+# Фабрика модели: (model_name, generation_config) -> объект с generate_content_async
+ModelFactory = Callable[[str, Dict[str, Any]], Any]
+
+
+def _config_key(generation_config: Optional[Dict[str, Any]]) -> str:
+    return json.dumps(generation_config or {}, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def _load_factory(path: str) -> ModelFactory:
+    """Загрузка фабрики по строке вида 'module:callable'"""
+    module_name, _, attr = path.partition(":")
+    if not module_name or not attr:
+        raise ValueError("GEMINI_MODEL_FACTORY must look like 'module:callable'")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+class ModelRegistry:
+    """Общий для всех запросов кэш объектов GenerativeModel.
+
+    ENV:
+      GEMINI_API_KEY / GOOGLE_API_KEY — ключ API
+      GEMINI_MODEL                    — модель по умолчанию (gemini-1.5-flash)
+      GEMINI_MODEL_FACTORY            — 'module:callable' для подмены модели (например, заглушка в тестах)
+    """
+
+    def __init__(self):
+        self._models: Dict[Tuple[str, str], Any] = {}
+        self._lock = threading.Lock()
+        self._configured = False
+        self._factory: Optional[ModelFactory] = None
+
+    def configure(self, api_key: Optional[str] = None):
+        """Однократная настройка клиента (вызывается на startup, повторно — лениво)"""
+        factory_path = os.getenv("GEMINI_MODEL_FACTORY")
+        if factory_path and self._factory is None:
+            self._factory = _load_factory(factory_path)
+            logger.info("Gemini model factory: %s", factory_path)
+        if self._factory is not None or self._configured:
+            return
+        api_key = api_key or os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+        if not api_key:
+            raise ValueError("GEMINI_API_KEY or GOOGLE_API_KEY not set")
+        genai.configure(api_key=api_key)
+        self._configured = True
+
+    def set_factory(self, factory: Optional[ModelFactory]):
+        """Подмена фабрики моделей (None — вернуть Gemini); кэш моделей сбрасывается"""
+        with self._lock:
+            self._factory = factory
+            self._models.clear()
+
+    def get(self, model_name: Optional[str] = None, generation_config: Optional[Dict[str, Any]] = None) -> Any:
+        """Модель для пары (имя, generation_config); создается при первом обращении"""
+        model_name = model_name or DEFAULT_MODEL_NAME
+        key = (model_name, _config_key(generation_config))
+        model = self._models.get(key)
+        if model is not None:
+            return model
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                self.configure()
+                if self._factory is not None:
+                    model = self._factory(model_name, generation_config or {})
+                else:
+                    model = genai.GenerativeModel(model_name, generation_config=generation_config or None)
+                self._models[key] = model
+        return model
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+
+# Глобальный реестр процесса
+model_registry = ModelRegistry()
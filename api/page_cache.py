@@ -0,0 +1,242 @@
+"""
+Дисковый кэш загруженных страниц
+SQLite-хранилище с TTL, LRU-вытеснением по размеру и условной ревалидацией (ETag / Last-Modified)
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Optional
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_url(url: str) -> str:
+    """Нормализация URL для ключа кэша"""
+    if not url.startswith("http"):
+        url = f"https://{url}"
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    port = parts.port
+    if port and not ((scheme == "http" and port == 80) or (scheme == "https" and port == 443)):
+        host = f"{host}:{port}"
+    path = parts.path or "/"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, path, query, ""))
+
+
+class CachedPage:
+    """Запись кэша страницы"""
+    def __init__(self, url: str, final_url: str, status_code: int, body: bytes,
+                 encoding: Optional[str] = None, etag: Optional[str] = None,
+                 last_modified: Optional[str] = None, fetched_at: Optional[float] = None):
+        self.url = url
+        self.final_url = final_url
+        self.status_code = status_code
+        self.body = body
+        self.encoding = encoding
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+
+    @property
+    def text(self) -> str:
+        return self.body.decode(self.encoding or "utf-8", errors="replace")
+
+    def is_fresh(self, ttl_seconds: float) -> bool:
+        return time.time() - self.fetched_at < ttl_seconds
+
+    def conditional_headers(self) -> Dict[str, str]:
+        """Заголовки для условного запроса"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class PageCache:
+    """Дисковый кэш страниц.
+
+    ENV:
+      PAGE_CACHE_ENABLED    — включить кэш (true)
+      PAGE_CACHE_PATH       — путь к SQLite-файлу (.cache/pages.sqlite)
+      PAGE_CACHE_TTL        — время свежести записи без ревалидации, сек (86400)
+      PAGE_CACHE_MAX_BYTES  — лимит суммарного размера тел, байт (256 МБ)
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl_seconds: Optional[float] = None,
+                 max_bytes: Optional[int] = None):
+        self.path = path or os.getenv("PAGE_CACHE_PATH", os.path.join(".cache", "pages.sqlite"))
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else float(os.getenv("PAGE_CACHE_TTL", "86400"))
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("PAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0}
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pages (
+                    key TEXT PRIMARY KEY,
+                    final_url TEXT NOT NULL,
+                    status_code INTEGER NOT NULL,
+                    body BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    encoding TEXT,
+                    etag TEXT,
+                    last_modified TEXT,
+                    fetched_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_pages_accessed_at ON pages(accessed_at)")
+            self._init_size_total(conn)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _init_size_total(conn: sqlite3.Connection):
+        """Суммарный размер тел в строке meta, поддерживаемой триггерами (общий для всех процессов).
+
+        Полный подсчет выполняется один раз — при первом открытии файла без meta.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute(
+                "INSERT OR IGNORE INTO meta (key, value) "
+                "SELECT 'total_size', COALESCE(SUM(size), 0) FROM pages"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS pages_size_insert AFTER INSERT ON pages BEGIN "
+                "UPDATE meta SET value = value + NEW.size WHERE key = 'total_size'; END"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS pages_size_update AFTER UPDATE OF size ON pages BEGIN "
+                "UPDATE meta SET value = value + NEW.size - OLD.size WHERE key = 'total_size'; END"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS pages_size_delete AFTER DELETE ON pages BEGIN "
+                "UPDATE meta SET value = value - OLD.size WHERE key = 'total_size'; END"
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    # --- синхронные операции (выполняются в отдельном потоке) ---
+
+    def _get_sync(self, key: str) -> Optional[CachedPage]:
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT final_url, status_code, body, encoding, etag, last_modified, fetched_at "
+                "FROM pages WHERE key = ?", (key,)
+            ).fetchone()
+            if not row:
+                return None
+            conn.execute("UPDATE pages SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        final_url, status_code, body, encoding, etag, last_modified, fetched_at = row
+        return CachedPage(key, final_url, status_code, zlib.decompress(body), encoding, etag, last_modified, fetched_at)
+
+    def _put_sync(self, key: str, page: CachedPage):
+        body = zlib.compress(page.body, 6)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            # UPSERT, а не INSERT OR REPLACE: при REPLACE триггер удаления не срабатывает
+            conn.execute(
+                "INSERT INTO pages "
+                "(key, final_url, status_code, body, size, encoding, etag, last_modified, fetched_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET final_url = excluded.final_url, "
+                "status_code = excluded.status_code, body = excluded.body, size = excluded.size, "
+                "encoding = excluded.encoding, etag = excluded.etag, last_modified = excluded.last_modified, "
+                "fetched_at = excluded.fetched_at, accessed_at = excluded.accessed_at",
+                (key, page.final_url, page.status_code, body, len(body), page.encoding,
+                 page.etag, page.last_modified, page.fetched_at, now),
+            )
+            self._evict_locked(conn)
+
+    def _touch_sync(self, key: str, fetched_at: float):
+        with self._lock:
+            self._connect().execute(
+                "UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE key = ?", (fetched_at, time.time(), key)
+            )
+
+    def _evict_locked(self, conn: sqlite3.Connection):
+        """LRU-вытеснение до лимита по размеру"""
+        total = conn.execute("SELECT value FROM meta WHERE key = 'total_size'").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        victims = []
+        for key, size in conn.execute("SELECT key, size FROM pages ORDER BY accessed_at ASC"):
+            victims.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany("DELETE FROM pages WHERE key = ?", victims)
+
+    # --- асинхронный интерфейс ---
+
+    async def get(self, url: str) -> Optional[CachedPage]:
+        try:
+            return await asyncio.to_thread(self._get_sync, normalize_url(url))
+        except Exception as e:
+            logger.warning(f"Page cache read failed for {url}: {e}")
+            return None
+
+    async def put(self, url: str, page: CachedPage):
+        try:
+            await asyncio.to_thread(self._put_sync, normalize_url(url), page)
+        except Exception as e:
+            logger.warning(f"Page cache write failed for {url}: {e}")
+
+    async def touch(self, url: str, page: CachedPage):
+        """Продление свежести после 304 Not Modified"""
+        page.fetched_at = time.time()
+        try:
+            await asyncio.to_thread(self._touch_sync, normalize_url(url), page.fetched_at)
+        except Exception as e:
+            logger.warning(f"Page cache touch failed for {url}: {e}")
+
+    def record(self, outcome: str):
+        """Учет попадания/промаха/ревалидации: outcome in hits|misses|revalidated"""
+        self.stats[outcome] = self.stats.get(outcome, 0) + 1
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_page_cache: Optional[PageCache] = None
+
+
+def get_page_cache() -> Optional[PageCache]:
+    """Глобальный кэш процесса (None если отключен через PAGE_CACHE_ENABLED=false)"""
+    global _page_cache
+    if os.getenv("PAGE_CACHE_ENABLED", "true").lower() != "true":
+        return None
+    if _page_cache is None:
+        _page_cache = PageCache()
+    return _page_cache
@@ -0,0 +1,262 @@
+"""
+Асинхронный слой хранения
+Синхронный клиент Supabase выполняется в отдельном ограниченном пуле потоков с таймаутом,
+чтобы не блокировать event loop; SQLite-реализация того же интерфейса — для локального запуска и тестов
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Фильтры — {колонка: значение}; список или кортеж означает IN,
+# суффикс ">=" или "<=" в имени колонки — сравнение ({"created_at>=": "2025-01-01T00:00:00+00:00"})
+Filters = Dict[str, Any]
+
+_RANGE_OPERATORS = (">=", "<=")
+
+
+def _split_column(key: str):
+    for operator in _RANGE_OPERATORS:
+        if key.endswith(operator):
+            return key[:-len(operator)], operator
+    return key, None
+
+
+class PersistenceError(Exception):
+    """Ошибка или таймаут операции хранилища"""
+
+
+class Store:
+    """Интерфейс хранилища: операции над таблицами схемы supabase/schema.sql"""
+
+    async def insert(self, table: str, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def update(self, table: str, values: Dict[str, Any], filters: Filters) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def upsert(self, table: str, rows: List[Dict[str, Any]], on_conflict: str = "id") -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def select(self, table: str, columns: str = "*", filters: Optional[Filters] = None,
+                     limit: Optional[int] = None, order: Optional[str] = None) -> List[Dict[str, Any]]:
+        """order — 'колонка' или 'колонка.desc' (по убыванию)"""
+        raise NotImplementedError
+
+    async def count(self, table: str, filters: Optional[Filters] = None) -> int:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class SupabaseStore(Store):
+    """Supabase через синхронный клиент в выделенном пуле потоков.
+
+    ENV:
+      PERSISTENCE_THREADS  — размер пула (8); ограничивает одновременные запросы к Supabase
+      PERSISTENCE_TIMEOUT  — таймаут операции, сек (10)
+    """
+
+    def __init__(self, client: Any, threads: Optional[int] = None, timeout: Optional[float] = None):
+        self.client = client
+        self.threads = threads or int(os.getenv("PERSISTENCE_THREADS", "8"))
+        self.timeout = timeout if timeout is not None else float(os.getenv("PERSISTENCE_TIMEOUT", "10"))
+        self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="supabase")
+
+    async def _run(self, operation: str, build: Callable[[], Any]) -> Any:
+        loop = asyncio.get_running_loop()
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(self._executor, build), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            # Поток дорабатывает запрос в фоне, вызывающий не ждет дольше таймаута
+            raise PersistenceError(f"Supabase {operation} timed out after {self.timeout}s")
+
+    def _filtered(self, query: Any, filters: Optional[Filters]) -> Any:
+        for key, value in (filters or {}).items():
+            column, operator = _split_column(key)
+            if operator == ">=":
+                query = query.gte(column, value)
+            elif operator == "<=":
+                query = query.lte(column, value)
+            elif isinstance(value, (list, tuple)):
+                query = query.in_(column, list(value))
+            else:
+                query = query.eq(column, value)
+        return query
+
+    async def insert(self, table, rows):
+        return await self._run(
+            f"insert {table}", lambda: self.client.table(table).insert(rows).execute().data or []
+        )
+
+    async def update(self, table, values, filters):
+        return await self._run(
+            f"update {table}",
+            lambda: self._filtered(self.client.table(table).update(values), filters).execute().data or [],
+        )
+
+    async def upsert(self, table, rows, on_conflict="id"):
+        return await self._run(
+            f"upsert {table}",
+            lambda: self.client.table(table).upsert(rows, on_conflict=on_conflict).execute().data or [],
+        )
+
+    async def select(self, table, columns="*", filters=None, limit=None, order=None):
+        def build():
+            query = self._filtered(self.client.table(table).select(columns), filters)
+            if order:
+                column, _, direction = order.partition(".")
+                query = query.order(column, desc=direction == "desc")
+            if limit:
+                query = query.limit(limit)
+            return query.execute().data or []
+        return await self._run(f"select {table}", build)
+
+    async def count(self, table, filters=None):
+        def build():
+            query = self._filtered(self.client.table(table).select("id", count="exact"), filters)
+            return query.limit(1).execute().count or 0
+        return await self._run(f"count {table}", build)
+
+    async def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SQLiteStore(Store):
+    """Локальная замена Supabase: строки таблиц хранятся как JSON-документы.
+
+    ENV:
+      PERSISTENCE_SQLITE_PATH  — путь к файлу (.cache/store.sqlite); ":memory:" — в памяти
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.getenv("PERSISTENCE_SQLITE_PATH", os.path.join(".cache", "store.sqlite"))
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory and self.path != ":memory:":
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rows (tbl TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL, "
+                "PRIMARY KEY (tbl, id))"
+            )
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _matches(row: Dict[str, Any], filters: Optional[Filters]) -> bool:
+        for key, value in (filters or {}).items():
+            column, operator = _split_column(key)
+            if operator is not None:
+                current = row.get(column)
+                if current is None or (current < value if operator == ">=" else current > value):
+                    return False
+            elif isinstance(value, (list, tuple)):
+                if row.get(column) not in value:
+                    return False
+            elif row.get(column) != value:
+                return False
+        return True
+
+    def _rows(self, conn: sqlite3.Connection, table: str, filters: Optional[Filters]) -> List[Dict[str, Any]]:
+        rows = (json.loads(data) for (data,) in conn.execute("SELECT data FROM rows WHERE tbl = ? ORDER BY rowid", (table,)))
+        return [row for row in rows if self._matches(row, filters)]
+
+    def _save(self, conn: sqlite3.Connection, table: str, row: Dict[str, Any]):
+        conn.execute(
+            "INSERT OR REPLACE INTO rows (tbl, id, data) VALUES (?, ?, ?)",
+            (table, str(row["id"]), json.dumps(row, ensure_ascii=False, default=str)),
+        )
+
+    def _insert_sync(self, table, rows):
+        now = datetime.now(timezone.utc).isoformat()
+        inserted = []
+        with self._lock:
+            conn = self._connect()
+            for row in rows:
+                row = {"id": str(uuid.uuid4()), "created_at": now, **row}
+                self._save(conn, table, row)
+                inserted.append(row)
+        return inserted
+
+    def _update_sync(self, table, values, filters):
+        with self._lock:
+            conn = self._connect()
+            updated = []
+            for row in self._rows(conn, table, filters):
+                row.update(values)
+                self._save(conn, table, row)
+                updated.append(row)
+        return updated
+
+    def _upsert_sync(self, table, rows, on_conflict):
+        with self._lock:
+            conn = self._connect()
+            existing = {row.get(on_conflict): row for row in self._rows(conn, table, None)}
+            result = []
+            for row in rows:
+                merged = {**existing.get(row.get(on_conflict), {}), **row}
+                merged.setdefault("id", str(uuid.uuid4()))
+                self._save(conn, table, merged)
+                result.append(merged)
+        return result
+
+    def _select_sync(self, table, columns, filters, limit, order):
+        with self._lock:
+            rows = self._rows(self._connect(), table, filters)
+        if order:
+            column, _, direction = order.partition(".")
+            rows.sort(key=lambda row: (row.get(column) is not None, row.get(column) or ""), reverse=direction == "desc")
+        if columns != "*":
+            names = [name.strip() for name in columns.split(",")]
+            rows = [{name: row.get(name) for name in names} for row in rows]
+        return rows[:limit] if limit else rows
+
+    async def insert(self, table, rows):
+        return await asyncio.to_thread(self._insert_sync, table, rows)
+
+    async def update(self, table, values, filters):
+        return await asyncio.to_thread(self._update_sync, table, values, filters)
+
+    async def upsert(self, table, rows, on_conflict="id"):
+        return await asyncio.to_thread(self._upsert_sync, table, rows, on_conflict)
+
+    async def select(self, table, columns="*", filters=None, limit=None, order=None):
+        return await asyncio.to_thread(self._select_sync, table, columns, filters, limit, order)
+
+    async def count(self, table, filters=None):
+        return len(await self.select(table, "id", filters))
+
+    async def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def create_store() -> Optional[Store]:
+    """Хранилище по ENV: Supabase при наличии SUPABASE_URL и ключа, SQLite при PERSISTENCE_BACKEND=sqlite"""
+    backend = os.getenv("PERSISTENCE_BACKEND", "supabase").lower()
+    if backend == "sqlite":
+        logger.info("Persistence: SQLite stand-in")
+        return SQLiteStore()
+    supabase_url = os.getenv("SUPABASE_URL")
+    supabase_key = os.getenv("SUPABASE_SERVICE_KEY") or os.getenv("SUPABASE_ANON_KEY")
+    if not (supabase_url and supabase_key):
+        return None
+    from supabase import create_client
+    return SupabaseStore(create_client(supabase_url, supabase_key))
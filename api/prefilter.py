@@ -0,0 +1,354 @@
+"""
+Локальный предварительный классификатор сайтов
+TF-IDF по данным этапа 1 и веса терминов для каждого профиля (лог-отношение частот в ACCEPT и REJECT),
+обученные на истории analyses. Явные несовпадения получают REJECT без обращения к LLM
+"""
+
+import hashlib
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # NumPy опционален: без него предварительная классификация отключена
+    np = None
+
+from persistence import Store
+
+logger = logging.getLogger(__name__)
+
+_TOKEN = re.compile(r"[a-zа-яё][a-zа-яё0-9]{2,}")
+
+# (content_data этапа 1, профиль, ACCEPT ли)
+Example = Tuple[Dict[str, Any], str, bool]
+
+
+def site_tokens(content_data: Dict[str, Any]) -> List[str]:
+    """Термины сайта: заголовок, description и заголовки страницы учитываются дважды"""
+    lead = " ".join([
+        str(content_data.get("title", "")),
+        str(content_data.get("meta_description", "")),
+        " ".join(str(h) for h in content_data.get("headers", []) or []),
+    ]).lower()
+    body = str(content_data.get("main_text", "")).lower()
+    lead_tokens = _TOKEN.findall(lead)
+    return lead_tokens + lead_tokens + _TOKEN.findall(body)
+
+
+def training_example(row: Dict[str, Any]) -> Optional[Example]:
+    """Пример обучения из строки analyses: решение LLM ACCEPT/REJECT и content_data этапа 1"""
+    raw_data = row.get("raw_data") or {}
+    if raw_data.get("reused") or "error" in raw_data:
+        return None
+    results = raw_data.get("pipeline_results") or []
+    if len(results) < 2 or not isinstance(results[0], dict) or "main_text" not in results[0]:
+        return None
+    final = results[-1] if isinstance(results[-1], dict) else {}
+    # Решения самого классификатора не обучают его повторно
+    if final.get("prefilter") or final.get("decision") not in ("ACCEPT", "REJECT"):
+        return None
+    return results[0], row.get("profile_type"), final["decision"] == "ACCEPT"
+
+
+async def load_training_examples(store: Store, limit: int, page_size: int = 1000) -> List[Example]:
+    """Последние завершенные анализы (не больше limit), по одному на (domain, profile_type)"""
+    examples: List[Example] = []
+    seen_ids = set()
+    seen_keys = set()
+    filters: Dict[str, Any] = {"status": "completed"}
+    fetched = 0
+    while fetched < limit:
+        rows = await store.select(
+            "analyses", "id, domain, profile_type, raw_data, created_at", filters,
+            limit=min(page_size, limit - fetched), order="created_at.desc",
+        )
+        fresh = [row for row in rows if row.get("id") not in seen_ids]
+        if not fresh:
+            break
+        for row in fresh:
+            seen_ids.add(row.get("id"))
+            key = (str(row.get("domain", "")).lower(), row.get("profile_type"))
+            example = training_example(row)
+            if example and key not in seen_keys:
+                seen_keys.add(key)
+                examples.append(example)
+        fetched += len(fresh)
+        if len(rows) < page_size:
+            break
+        # Курсор по created_at: граничные строки повторяются и отбрасываются по id
+        filters = {"status": "completed", "created_at<=": rows[-1].get("created_at")}
+    return examples
+
+
+def _holdout(content_data: Dict[str, Any]) -> bool:
+    """Детерминированная отложенная выборка (~20%) для калибровки порога"""
+    url = str(content_data.get("url", ""))
+    return int(hashlib.blake2b(url.encode(), digest_size=4).hexdigest(), 16) % 5 == 0
+
+
+class PreClassifierModel:
+    """Словарь, IDF и линейная модель каждого профиля: score = tfidf · weights + bias.
+
+    REJECT, если score <= threshold (порог подобран на отложенной выборке).
+    """
+
+    def __init__(self, terms: List[str], idf: "np.ndarray", profiles: Dict[str, Dict[str, Any]],
+                 trained_at: float):
+        self.terms = terms
+        self.index = {term: i for i, term in enumerate(terms)}
+        self.idf = idf
+        self.profiles = profiles
+        self.trained_at = trained_at
+
+    def vectorize(self, contents: List[Dict[str, Any]]) -> Tuple["np.ndarray", "np.ndarray", "np.ndarray"]:
+        """Разреженная матрица TF-IDF (строки L2-нормированы) в виде (rows, cols, values)"""
+        rows: List[int] = []
+        cols: List[int] = []
+        counts: List[int] = []
+        index = self.index
+        for row, content_data in enumerate(contents):
+            ids = Counter(i for i in (index.get(t) for t in site_tokens(content_data)) if i is not None)
+            rows.extend([row] * len(ids))
+            cols.extend(ids.keys())
+            counts.extend(ids.values())
+        rows_arr = np.asarray(rows, dtype=np.int64)
+        cols_arr = np.asarray(cols, dtype=np.int64)
+        values = (1.0 + np.log(np.asarray(counts, dtype=np.float32))) * self.idf[cols_arr]
+        norms = np.sqrt(np.bincount(rows_arr, weights=values * values, minlength=len(contents)))
+        values = values / np.maximum(norms[rows_arr], 1e-9)
+        return rows_arr, cols_arr, values.astype(np.float32)
+
+    def score(self, contents: List[Dict[str, Any]], profile_type: str) -> Optional["np.ndarray"]:
+        """Оценки сайтов для профиля одной векторной операцией; None — профиль не обучен"""
+        scored = self.score_terms(contents, profile_type)
+        return scored[0] if scored else None
+
+    def score_terms(self, contents: List[Dict[str, Any]],
+                    profile_type: str) -> Optional[Tuple["np.ndarray", "np.ndarray"]]:
+        """Оценки сайтов и число различных терминов словаря на каждом сайте.
+
+        Сайт без терминов словаря получает оценку bias — решение по нему ничего не говорит о сайте.
+        """
+        profile = self.profiles.get(profile_type)
+        if profile is None:
+            return None
+        rows, cols, values = self.vectorize(contents)
+        scores = np.bincount(rows, weights=values * profile["weights"][cols], minlength=len(contents)) + profile["bias"]
+        return scores, np.bincount(rows, minlength=len(contents))
+
+    def save(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        names = sorted(self.profiles)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            terms=np.asarray(self.terms, dtype=str),
+            idf=self.idf,
+            profiles=np.asarray(names, dtype=str),
+            weights=np.stack([self.profiles[p]["weights"] for p in names]) if names else np.zeros((0, len(self.terms))),
+            meta=np.asarray([[self.profiles[p][k] for k in ("bias", "threshold", "precision", "examples")] for p in names],
+                            dtype=np.float64).reshape(len(names), 4),
+            trained_at=np.asarray(self.trained_at),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "PreClassifierModel":
+        with np.load(path, allow_pickle=False) as data:
+            profiles = {}
+            for name, weights, (bias, threshold, precision, examples) in zip(
+                    data["profiles"].tolist(), data["weights"], data["meta"]):
+                profiles[name] = {"weights": weights.astype(np.float32), "bias": float(bias),
+                                  "threshold": float(threshold), "precision": float(precision),
+                                  "examples": int(examples)}
+            return cls(data["terms"].tolist(), data["idf"].astype(np.float32), profiles, float(data["trained_at"]))
+
+
+class PreClassifier:
+    """Отсев явных несовпадений до этапа 2.
+
+    Модель обучается на истории analyses (POST /prefilter/train) и хранится в файле, общем для
+    процессов хоста: воркеры подхватывают новую модель по времени изменения файла.
+    Без обученной модели (или без NumPy) evaluate() всегда возвращает None.
+
+    ENV:
+      PREFILTER_ENABLED            — отсекать явные несовпадения до этапа 2 (true)
+      PREFILTER_MODEL_PATH         — файл модели (.cache/prefilter.npz)
+      PREFILTER_TARGET_PRECISION   — доля верных REJECT на отложенной выборке для порога (0.97)
+      PREFILTER_MIN_EXAMPLES       — минимум ACCEPT и REJECT профиля для обучения (20)
+      PREFILTER_MIN_TERMS          — минимум различных терминов словаря на сайте для решения (8);
+                                     сайты с меньшим числом (пустые SPA, короткие страницы) идут в LLM
+      PREFILTER_VOCAB_SIZE         — размер словаря (20000)
+      PREFILTER_TRAIN_LIMIT        — сколько последних анализов читать для обучения (5000)
+      PREFILTER_RELOAD_INTERVAL    — проверка обновления файла модели, сек (60)
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.enabled = os.getenv("PREFILTER_ENABLED", "true").lower() == "true" and np is not None
+        self.path = path or os.getenv("PREFILTER_MODEL_PATH", os.path.join(".cache", "prefilter.npz"))
+        self.target_precision = float(os.getenv("PREFILTER_TARGET_PRECISION", "0.97"))
+        self.min_examples = int(os.getenv("PREFILTER_MIN_EXAMPLES", "20"))
+        self.min_terms = int(os.getenv("PREFILTER_MIN_TERMS", "8"))
+        self.vocab_size = int(os.getenv("PREFILTER_VOCAB_SIZE", "20000"))
+        self.train_limit = int(os.getenv("PREFILTER_TRAIN_LIMIT", "5000"))
+        self.reload_interval = float(os.getenv("PREFILTER_RELOAD_INTERVAL", "60"))
+        self.stats = {"evaluated": 0, "rejected": 0, "too_few_terms": 0}
+        self.model: Optional[PreClassifierModel] = None
+        self._model_mtime = 0.0
+        self._checked_at = 0.0
+
+    def _maybe_reload(self):
+        now = time.time()
+        if now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime <= self._model_mtime:
+            return
+        try:
+            self.model = PreClassifierModel.load(self.path)
+            self._model_mtime = mtime
+            logger.info(f"Pre-classifier loaded: {len(self.model.profiles)} profiles, {len(self.model.terms)} terms")
+        except Exception as e:
+            logger.warning(f"Pre-classifier load failed: {e}")
+            self._model_mtime = mtime
+
+    def evaluate(self, content_data: Dict[str, Any], profile_type: str) -> Optional[Dict[str, Any]]:
+        """Решение REJECT с оценкой и порогом или None — сайт идет в LLM"""
+        if not self.enabled:
+            return None
+        self._maybe_reload()
+        model = self.model
+        if model is None or profile_type not in model.profiles:
+            return None
+        profile = model.profiles[profile_type]
+        scores, terms = model.score_terms([content_data], profile_type)
+        self.stats["evaluated"] += 1
+        if int(terms[0]) < self.min_terms:
+            # Оценка определяется в основном bias, а не содержимым — решение оставляется LLM
+            self.stats["too_few_terms"] += 1
+            return None
+        score = float(scores[0])
+        if score > profile["threshold"]:
+            return None
+        self.stats["rejected"] += 1
+        return {
+            "decision": "REJECT",
+            "score": round(score, 4),
+            "threshold": round(profile["threshold"], 4),
+            "precision": round(profile["precision"], 3),
+        }
+
+    def score_batch(self, contents: List[Dict[str, Any]], profile_type: str) -> Optional["np.ndarray"]:
+        """Оценки множества сайтов одной векторной операцией (None — модели для профиля нет)"""
+        if np is None:
+            return None
+        self._maybe_reload()
+        return self.model.score(contents, profile_type) if self.model else None
+
+    def _threshold(self, scores: "np.ndarray", labels: "np.ndarray") -> Tuple[float, float]:
+        """Наибольший порог, ниже которого доля ACCEPT не выше 1 - target_precision: (порог, точность)"""
+        if len(scores) == 0:
+            return -math.inf, 0.0
+        order = np.argsort(scores, kind="stable")
+        sorted_scores = scores[order]
+        negatives = np.cumsum(~labels[order])
+        counts = np.arange(1, len(order) + 1)
+        precision = negatives / counts
+        # Порог ставится только между разными значениями оценки и при достаточном числе отсеянных
+        valid = (precision >= self.target_precision) & (negatives >= max(5, self.min_examples // 4))
+        valid &= np.append(sorted_scores[1:] > sorted_scores[:-1], True)
+        if not valid.any():
+            return -math.inf, 0.0
+        best = int(np.flatnonzero(valid)[-1])
+        return float(sorted_scores[best]), float(precision[best])
+
+    def fit(self, examples: Iterable[Example]) -> Dict[str, Any]:
+        """Обучение на примерах (синхронно, CPU); новая модель заменяет текущую и сохраняется в файл"""
+        if np is None:
+            raise RuntimeError("NumPy is required for the pre-classifier")
+        examples = [e for e in examples if e[1]]
+        document_frequency: Counter = Counter()
+        for content_data, _, _ in examples:
+            document_frequency.update(set(site_tokens(content_data)))
+        terms = [t for t, df in document_frequency.most_common(self.vocab_size) if df >= 2]
+        n_docs = max(len(examples), 1)
+        idf = np.asarray([math.log((1 + n_docs) / (1 + document_frequency[t])) + 1.0 for t in terms], dtype=np.float32)
+        model = PreClassifierModel(terms, idf, {}, time.time())
+
+        by_profile: Dict[str, List[Example]] = {}
+        for example in examples:
+            by_profile.setdefault(example[1], []).append(example)
+
+        report: Dict[str, Any] = {}
+        for profile_type, items in sorted(by_profile.items()):
+            labels = np.asarray([accepted for _, _, accepted in items], dtype=bool)
+            n_pos, n_neg = int(labels.sum()), int((~labels).sum())
+            if n_pos < self.min_examples or n_neg < self.min_examples:
+                report[profile_type] = {"trained": False, "accept": n_pos, "reject": n_neg}
+                continue
+            holdout = np.asarray([_holdout(content_data) for content_data, _, _ in items], dtype=bool)
+            train = ~holdout if holdout.any() and (~holdout).any() else np.ones(len(items), dtype=bool)
+            rows, cols, values = model.vectorize([content_data for content_data, _, _ in items])
+            row_train = train[rows]
+            # Суммы TF-IDF по классам — без плотной матрицы документов
+            pos = np.bincount(cols[row_train & labels[rows]], weights=values[row_train & labels[rows]], minlength=len(terms)) + 1.0
+            neg = np.bincount(cols[row_train & ~labels[rows]], weights=values[row_train & ~labels[rows]], minlength=len(terms)) + 1.0
+            weights = (np.log(pos / pos.sum()) - np.log(neg / neg.sum())).astype(np.float32)
+            bias = math.log(max(int((labels & train).sum()), 1) / max(int((~labels & train).sum()), 1))
+            scores = np.bincount(rows, weights=values * weights[cols], minlength=len(items)) + bias
+            # Порог подбирается только на сайтах, по которым evaluate() принимает решение
+            decidable = np.bincount(rows, minlength=len(items)) >= self.min_terms
+            calibration = holdout & decidable
+            if calibration.sum() < self.min_examples:
+                calibration = decidable
+            threshold, precision = self._threshold(scores[calibration], labels[calibration])
+            model.profiles[profile_type] = {"weights": weights, "bias": bias, "threshold": threshold,
+                                            "precision": precision, "examples": len(items)}
+            rejected = scores[calibration] <= threshold
+            report[profile_type] = {
+                "trained": True, "accept": n_pos, "reject": n_neg,
+                "threshold": round(threshold, 4) if math.isfinite(threshold) else None,
+                "holdout_precision": round(precision, 3),
+                "holdout_reject_share": round(float(rejected.mean()), 3),
+            }
+
+        model.save(self.path)
+        self.model = model
+        self._model_mtime = os.path.getmtime(self.path)
+        return {"examples": len(examples), "terms": len(terms), "profiles": report}
+
+    def snapshot(self) -> Dict[str, Any]:
+        model = self.model
+        return {
+            "enabled": self.enabled,
+            "trained_at": model.trained_at if model else None,
+            "terms": len(model.terms) if model else 0,
+            "profiles": {
+                p: {"threshold": v["threshold"] if math.isfinite(v["threshold"]) else None,
+                    "precision": v["precision"], "examples": v["examples"]}
+                for p, v in (model.profiles.items() if model else [])
+            },
+            **self.stats,
+        }
+
+
+_pre_classifier: Optional[PreClassifier] = None
+
+
+def get_pre_classifier() -> PreClassifier:
+    """Глобальный классификатор процесса (модель читается из PREFILTER_MODEL_PATH)"""
+    global _pre_classifier
+    if _pre_classifier is None:
+        _pre_classifier = PreClassifier()
+    return _pre_classifier
@@ -0,0 +1,216 @@
+"""
+Сжатие промптов этапов под бюджет токенов
+Текст страницы режется на предложения, повторы и шаблонный текст (баннеры cookie, меню,
+встречающиеся на многих сайтах фразы) отбрасываются, результаты прошлых этапов сериализуются
+компактным JSON, текст урезается под бюджет этапа
+"""
+
+import hashlib
+import json
+import os
+import re
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from fetch_scheduler import url_host
+from quota_governor import estimate_tokens
+
+# Границы сегментов: конец предложения (извлечение склеивает блоки без пробела — тогда по заглавной
+# букве после точки), разделители пунктов меню, вырезанные заголовки
+_SEGMENT_SPLIT = re.compile(r"(?<=[.!?…])(?:\s+|(?=[A-ZА-ЯЁ]))|\s+[|•·»]\s+|\n")
+_NORMALIZE = re.compile(r"[\W_]+", re.UNICODE)
+
+# Шаблонные фразы, которые отбрасываются и без статистики (только в коротких сегментах)
+BOILERPLATE_PATTERNS = re.compile(
+    r"cookie|all rights reserved|©|skip to (main )?content|javascript (is )?(disabled|required)",
+    re.IGNORECASE,
+)
+# Длиннее — содержательный текст, а не шаблон
+BOILERPLATE_MAX_CHARS = 200
+
+
+def _normalize(segment: str) -> str:
+    return _NORMALIZE.sub(" ", segment.lower()).strip()
+
+
+# Короче — заголовок не вырезается из текста подстрокой (риск задеть обычные слова)
+HEADER_CUT_MIN_CHARS = 12
+
+
+def split_segments(text: str, cut: Iterable[str] = ()) -> List[str]:
+    """Предложения и пункты меню текста страницы; строки cut вырезаются и служат границами"""
+    text = text or ""
+    for piece in sorted(cut, key=len, reverse=True):
+        if len(piece) >= HEADER_CUT_MIN_CHARS:
+            text = text.replace(piece, "\n")
+    return [segment.strip() for segment in _SEGMENT_SPLIT.split(text) if segment.strip()]
+
+
+def compact_json(value: Any, max_string: int = 300, max_items: int = 10) -> str:
+    """Компактный JSON результата этапа: без пустых полей, длинные строки и списки урезаны"""
+    def prune(item: Any) -> Any:
+        if isinstance(item, dict):
+            pruned = {k: prune(v) for k, v in item.items()}
+            return {k: v for k, v in pruned.items() if v not in (None, "", [], {})}
+        if isinstance(item, (list, tuple)):
+            return [prune(v) for v in item[:max_items]]
+        if isinstance(item, str) and len(item) > max_string:
+            return item[:max_string] + "…"
+        return item
+    return json.dumps(prune(value), ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class CompactPage:
+    """Сегменты текста страницы после удаления повторов и шаблонов"""
+    def __init__(self, segments: List[str], headers: List[str], source_tokens: int):
+        self.segments = segments
+        self.headers = headers
+        self.source_tokens = source_tokens
+
+    def text(self, budget_tokens: int) -> str:
+        """Сегменты по порядку, пока помещаются в бюджет (не поместившийся — обрезается)"""
+        budget_chars = max(0, budget_tokens) * 4
+        parts: List[str] = []
+        used = 0
+        for segment in self.segments:
+            remaining = budget_chars - used
+            if len(segment) + 1 > remaining:
+                if remaining > 1:
+                    parts.append(segment[:remaining - 1])
+                break
+            parts.append(segment)
+            used += len(segment) + 1
+        return " ".join(parts)
+
+
+class PromptCompactor:
+    """Сжатие текста страницы и результатов этапов для промптов.
+
+    Шаблонный текст определяется по частоте: сегмент, встреченный на PROMPT_BOILERPLATE_MIN_SITES
+    разных хостах, считается шаблоном (статистика общая для процесса). Бюджет этапа — оценка
+    токенов всего промпта (как в quota_governor: ~4 символа на токен).
+
+    ENV:
+      PROMPT_COMPACTION_ENABLED      — включить сжатие (true)
+      PROMPT_TOKEN_BUDGET            — бюджет промпта этапа по умолчанию, токенов (900)
+      PROMPT_TOKEN_BUDGETS           — бюджеты этапов: "initial_classification=600,fused=850"
+      PROMPT_MIN_TEXT_TOKENS         — минимум токенов на текст страницы при любом бюджете (150)
+      PROMPT_BOILERPLATE_MIN_SITES   — на скольких хостах сегмент становится шаблоном (5)
+      PROMPT_BOILERPLATE_MAX_KEYS    — лимит сегментов в статистике частоты (50000)
+    """
+
+    # Ниже прежних размеров промптов (~750 токенов у этапа 2, ~1000 у этапа 3 и fused):
+    # освободившееся после удаления повторов и шаблонов место не заполняется заново
+    DEFAULT_BUDGETS = {
+        "initial_classification": 600,
+        "batched_initial_classification": 450,
+        "detailed_analysis": 800,
+        "context_validation": 600,
+        "final_decision": 900,
+        "fused": 850,
+        "multi_initial_classification": 700,
+        "multi_final_decision": 1200,
+        "multi_fused": 1000,
+    }
+
+    def __init__(self):
+        self.enabled = os.getenv("PROMPT_COMPACTION_ENABLED", "true").lower() == "true"
+        self.default_budget = int(os.getenv("PROMPT_TOKEN_BUDGET", "900"))
+        self.budgets = dict(self.DEFAULT_BUDGETS)
+        for item in os.getenv("PROMPT_TOKEN_BUDGETS", "").split(","):
+            stage, _, budget = item.strip().partition("=")
+            if stage and budget:
+                self.budgets[stage] = int(budget)
+        self.min_text_tokens = int(os.getenv("PROMPT_MIN_TEXT_TOKENS", "150"))
+        self.min_sites = int(os.getenv("PROMPT_BOILERPLATE_MIN_SITES", "5"))
+        self.max_keys = int(os.getenv("PROMPT_BOILERPLATE_MAX_KEYS", "50000"))
+        self.stats = {"pages": 0, "segments": 0, "duplicates": 0, "boilerplate": 0}
+        # хэш сегмента -> хэши хостов, на которых он встречался (не больше min_sites)
+        self._seen: "OrderedDict[str, Set[str]]" = OrderedDict()
+
+    def budget(self, stage: str) -> int:
+        return self.budgets.get(stage, self.default_budget)
+
+    @staticmethod
+    def _digest(value: str) -> str:
+        return hashlib.blake2b(value.encode(), digest_size=8).hexdigest()
+
+    def _observe(self, host: str, keys: Iterable[str]) -> Set[str]:
+        """Учет сегментов страницы; возвращает ключи, ставшие шаблонными"""
+        host_key = self._digest(host)
+        frequent = set()
+        for key in keys:
+            hosts = self._seen.get(key)
+            if hosts is None:
+                hosts = self._seen[key] = set()
+            if len(hosts) < self.min_sites:
+                hosts.add(host_key)
+            self._seen.move_to_end(key)
+            if len(hosts) >= self.min_sites:
+                frequent.add(key)
+        while len(self._seen) > self.max_keys:
+            self._seen.popitem(last=False)
+        return frequent
+
+    def prepare(self, content_data: Dict[str, Any]) -> CompactPage:
+        """Сегменты текста страницы без повторов, шаблонов и дублей заголовков/текстов ссылок"""
+        main_text = content_data.get("main_text", "") or ""
+        headers = list(dict.fromkeys(h for h in content_data.get("headers", []) if h))
+        # Заголовки уходят в промпт отдельной строкой (длинные вырезаются из текста), тексты ссылок — навигация
+        elsewhere = {_normalize(h) for h in headers}
+        elsewhere.update(_normalize(link.get("text", "")) for link in content_data.get("links", []) if isinstance(link, dict))
+
+        candidates: List[tuple] = []
+        seen_keys: Set[str] = set()
+        for segment in split_segments(main_text, headers):
+            self.stats["segments"] += 1
+            normalized = _normalize(segment)
+            if not normalized or normalized in seen_keys or normalized in elsewhere:
+                self.stats["duplicates"] += 1
+                continue
+            seen_keys.add(normalized)
+            candidates.append((segment, self._digest(normalized)))
+
+        short_keys = [key for segment, key in candidates if len(segment) <= BOILERPLATE_MAX_CHARS]
+        host = url_host(str(content_data.get("url", "")))
+        frequent = self._observe(host, short_keys) if host else set()
+
+        segments = []
+        for segment, key in candidates:
+            if len(segment) <= BOILERPLATE_MAX_CHARS and (key in frequent or BOILERPLATE_PATTERNS.search(segment)):
+                self.stats["boilerplate"] += 1
+                continue
+            segments.append(segment)
+        self.stats["pages"] += 1
+        return CompactPage(segments, headers, estimate_tokens(main_text))
+
+    def fit(self, page: CompactPage, stage: str, build: Callable[[str], str],
+            max_text_tokens: Optional[int] = None) -> str:
+        """Промпт build(текст страницы) с текстом, урезанным под бюджет этапа (и не длиннее max_text_tokens)"""
+        overhead = estimate_tokens(build(""))
+        text_tokens = max(self.budget(stage) - overhead, self.min_text_tokens)
+        if max_text_tokens is not None:
+            text_tokens = min(text_tokens, max_text_tokens)
+        return build(page.text(text_tokens))
+
+    def fit_summary(self, stage: str, build: Callable[[Callable[[Any], str]], str]) -> str:
+        """Промпт build(сериализатор) из результатов прошлых этапов: компактный JSON,
+        при превышении бюджета этапа — с более короткими строками и списками"""
+        prompt = build(compact_json)
+        if estimate_tokens(prompt) > self.budget(stage):
+            prompt = build(lambda value: compact_json(value, max_string=80, max_items=3))
+        return prompt
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "tracked_segments": len(self._seen), **self.stats}
+
+
+_prompt_compactor: Optional[PromptCompactor] = None
+
+
+def get_prompt_compactor() -> PromptCompactor:
+    """Глобальный компактор процесса: статистика шаблонов общая для всех pipeline"""
+    global _prompt_compactor
+    if _prompt_compactor is None:
+        _prompt_compactor = PromptCompactor()
+    return _prompt_compactor
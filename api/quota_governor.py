@@ -0,0 +1,302 @@
+"""
+Квоты Gemini: token bucket по запросам (RPM) и токенам (TPM)
+Состояние ведер хранится в файле под flock и общее для всех процессов uvicorn и воркеров на хосте
+"""
+
+import asyncio
+import functools
+import heapq
+import itertools
+import logging
+import os
+import struct
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # не POSIX: ведра только внутри процесса
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Чем меньше, тем раньше обслуживается
+PRIORITIES = {"interactive": 0, "batch": 1}
+
+# rpm_level, tpm_level, updated_at
+_STATE = struct.Struct("ddd")
+
+
+def estimate_tokens(prompt: Any, expected_output: int = 0) -> int:
+    """Грубая оценка без запроса к API: ~4 символа на токен плюс ожидаемый ответ"""
+    text = prompt if isinstance(prompt, str) else str(prompt)
+    return len(text) // 4 + 1 + expected_output
+
+
+class Reservation:
+    """Зарезервированная квота одного запроса"""
+    def __init__(self, tokens: int, waited: float):
+        self.tokens = tokens
+        self.waited = waited
+
+
+class QuotaGovernor:
+    """Общие для хоста ведра RPM/TPM с приоритетной очередью ожидающих внутри процесса.
+
+    Ожидающие внутри процесса стоят в куче (приоритет, очередность) и будятся через свои future
+    одной задачей пополнения, которая спит ровно до появления квоты для первого в очереди.
+
+    Между процессами приоритет обеспечивается резервом: batch-запросы не опускают ведра
+    ниже QUOTA_INTERACTIVE_RESERVE от емкости, остаток доступен только interactive.
+
+    ENV:
+      QUOTA_ENABLED               — включить governor (true)
+      GEMINI_RPM                  — запросов в минуту (1000)
+      GEMINI_TPM                  — токенов в минуту (1000000)
+      GEMINI_EXPECTED_OUTPUT_TOKENS — ожидаемый размер ответа в оценке, токенов (512)
+      QUOTA_INTERACTIVE_RESERVE   — доля емкости, недоступная batch (0.2)
+      QUOTA_STATE_PATH            — файл общего состояния (.cache/gemini_quota.bin)
+    """
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None, path: Optional[str] = None,
+                 interactive_reserve: Optional[float] = None, expected_output: Optional[int] = None):
+        self.rpm = rpm or int(os.getenv("GEMINI_RPM", "1000"))
+        self.tpm = tpm or int(os.getenv("GEMINI_TPM", "1000000"))
+        self.path = path or os.getenv("QUOTA_STATE_PATH", os.path.join(".cache", "gemini_quota.bin"))
+        self.interactive_reserve = (
+            interactive_reserve if interactive_reserve is not None
+            else float(os.getenv("QUOTA_INTERACTIVE_RESERVE", "0.2"))
+        )
+        self.expected_output = (
+            expected_output if expected_output is not None
+            else int(os.getenv("GEMINI_EXPECTED_OUTPUT_TOKENS", "512"))
+        )
+        self.poll_interval = 0.05
+        self.stats = {"granted": 0, "waited": 0, "wait_seconds": 0.0, "penalties": 0}
+        self._lock = threading.Lock()
+        self._fd: Optional[int] = None
+        self._local_state: Optional[List[float]] = None
+        self._waiting: List[Tuple[int, int, int, float, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Future] = None
+
+    # --- общее состояние ---
+
+    def _open(self) -> Optional[int]:
+        if fcntl is None:
+            return None
+        if self._fd is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        return self._fd
+
+    def _update(self, requests: int, tokens: int, floor_fraction: float = 0.0,
+                force: bool = False, drain: bool = False, blocking: bool = True) -> float:
+        """Пополнение ведер и списание; 0 — списано, иначе сколько секунд ждать.
+
+        force — списать без проверки (коррекция по факту), drain — опустошить ведра.
+        blocking=False — если блокировку держит другой поток или процесс, BlockingIOError вместо ожидания.
+        """
+        if not self._lock.acquire(blocking=blocking):
+            raise BlockingIOError("quota state is locked by another thread")
+        try:
+            fd = self._open()
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            try:
+                now = time.time()
+                if fd is not None:
+                    raw = os.pread(fd, _STATE.size, 0)
+                    state = list(_STATE.unpack(raw)) if len(raw) == _STATE.size else None
+                else:
+                    state = self._local_state
+                if state is None:
+                    state = [float(self.rpm), float(self.tpm), now]
+
+                elapsed = max(0.0, now - state[2])
+                rpm_level = min(float(self.rpm), state[0] + elapsed * self.rpm / 60.0)
+                tpm_level = min(float(self.tpm), state[1] + elapsed * self.tpm / 60.0)
+
+                wait = 0.0
+                if drain:
+                    rpm_level = min(rpm_level, 0.0)
+                    tpm_level = min(tpm_level, 0.0)
+                else:
+                    if not force:
+                        wait = max(
+                            (requests + floor_fraction * self.rpm - rpm_level) * 60.0 / self.rpm,
+                            (tokens + floor_fraction * self.tpm - tpm_level) * 60.0 / self.tpm,
+                            0.0,
+                        )
+                    if wait == 0.0:
+                        rpm_level -= requests
+                        tpm_level -= tokens
+
+                state = [rpm_level, tpm_level, now]
+                if fd is not None:
+                    os.pwrite(fd, _STATE.pack(*state), 0)
+                else:
+                    self._local_state = state
+                return wait
+            finally:
+                if fd is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+    async def _update_async(self, *args, **kwargs) -> float:
+        """_update без блокировки event loop: при конкуренции за flock ожидание уходит в поток.
+
+        Блокировка держится только на чтение-запись 24 байт, поэтому обычно свободна и поток не нужен.
+        """
+        try:
+            return self._update(*args, blocking=False, **kwargs)
+        except BlockingIOError:
+            return await asyncio.to_thread(self._update, *args, **kwargs)
+
+    def _update_background(self, what: str, *args, **kwargs):
+        """Коррекция, результат которой не нужен вызывающему: при конкуренции — в потоке без ожидания"""
+        try:
+            self._update(*args, blocking=False, **kwargs)
+            return
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            logger.warning(f"Quota {what} failed: {e}")
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None:
+            try:
+                self._update(*args, **kwargs)
+            except OSError as e:
+                logger.warning(f"Quota {what} failed: {e}")
+            return
+
+        def done(future: asyncio.Future):
+            if not future.cancelled() and future.exception() is not None:
+                logger.warning(f"Quota {what} failed: {future.exception()}")
+
+        loop.run_in_executor(None, functools.partial(self._update, *args, **kwargs)).add_done_callback(done)
+
+    # --- асинхронный интерфейс ---
+
+    def estimate(self, prompt: Any) -> int:
+        return min(estimate_tokens(prompt, self.expected_output), self.tpm)
+
+    async def acquire(self, tokens: int, priority: str = "interactive") -> Reservation:
+        """Ожидание квоты на один запрос; внутри процесса очередь упорядочена по приоритету"""
+        tokens = min(tokens, self.tpm)
+        rank = PRIORITIES.get(priority, PRIORITIES["batch"])
+        floor_fraction = self.interactive_reserve if rank > 0 else 0.0
+        started = time.monotonic()
+        if not self._has_waiters() and await self._update_async(1, tokens, floor_fraction) == 0.0:
+            self.stats["granted"] += 1
+            return Reservation(tokens, time.monotonic() - started)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        entry = (rank, next(self._seq), tokens, floor_fraction, future)
+        heapq.heappush(self._waiting, entry)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = loop.create_task(self._dispatch())
+        elif self._waiting[0] is entry and self._wakeup is not None and not self._wakeup.done():
+            # Новый первый в очереди: пересчитать ожидание под его приоритет
+            self._wakeup.set_result(None)
+        # Отмена только помечает future; запись убирает диспетчер, когда она окажется первой
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Квота уже списана, но запрос не состоится
+                self._update_background("refund", -1, -tokens, force=True)
+            raise
+        waited = time.monotonic() - started
+        self.stats["granted"] += 1
+        if waited >= self.poll_interval:
+            self.stats["waited"] += 1
+            self.stats["wait_seconds"] += waited
+        return Reservation(tokens, waited)
+
+    def _has_waiters(self) -> bool:
+        while self._waiting and self._waiting[0][-1].done():
+            heapq.heappop(self._waiting)
+        return bool(self._waiting)
+
+    async def _dispatch(self):
+        """Единственная задача пополнения: выдает квоту ожидающим в порядке (приоритет, очередность)"""
+        loop = asyncio.get_running_loop()
+        try:
+            while self._has_waiters():
+                entry = self._waiting[0]
+                rank, _, tokens, floor_fraction, future = entry
+                if future.get_loop() is not loop:
+                    # Ожидающий из уже закрытого event loop
+                    heapq.heappop(self._waiting)
+                    continue
+                wait = await self._update_async(1, tokens, floor_fraction)
+                if wait == 0.0:
+                    # Пока шло списание, ожидающий мог быть отменен или опережен более приоритетным
+                    if self._waiting and self._waiting[0] is entry:
+                        heapq.heappop(self._waiting)
+                    elif entry in self._waiting:
+                        self._waiting.remove(entry)
+                        heapq.heapify(self._waiting)
+                    if future.done():
+                        self._update_background("refund", -1, -tokens, force=True)
+                    else:
+                        future.set_result(None)
+                    continue
+                # Ведра общие с другими процессами: состояние перечитывается не реже раза в секунду
+                self._wakeup = loop.create_future()
+                await asyncio.wait([self._wakeup], timeout=min(max(wait, self.poll_interval), 1.0))
+        except Exception as e:
+            # Ошибка файла состояния не должна оставлять ожидающих навсегда
+            logger.warning(f"Quota dispatcher failed: {e}")
+            while self._waiting:
+                future = heapq.heappop(self._waiting)[-1]
+                if not future.done() and future.get_loop() is loop:
+                    future.set_exception(e)
+        finally:
+            self._wakeup = None
+
+    def settle(self, reservation: Reservation, actual_tokens: Optional[int]):
+        """Коррекция TPM по фактическому расходу из usage_metadata"""
+        if actual_tokens is None:
+            return
+        delta = actual_tokens - reservation.tokens
+        if delta:
+            self._update_background("settle", 0, delta, force=True)
+
+    def penalize(self):
+        """Ответ 429 / ResourceExhausted: опустошение ведер, чтобы все процессы притормозили"""
+        self.stats["penalties"] += 1
+        self._update_background("penalize", 0, 0, drain=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"rpm": self.rpm, "tpm": self.tpm, "queued": sum(1 for entry in self._waiting if not entry[-1].done()), **self.stats}
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+_quota_governor: Optional[QuotaGovernor] = None
+
+
+def get_quota_governor() -> Optional[QuotaGovernor]:
+    """Глобальный governor процесса (None если отключен через QUOTA_ENABLED=false)"""
+    global _quota_governor
+    if os.getenv("QUOTA_ENABLED", "true").lower() != "true":
+        return None
+    if _quota_governor is None:
+        _quota_governor = QuotaGovernor()
+    return _quota_governor
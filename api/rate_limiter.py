@@ -0,0 +1,214 @@
+"""
+Ограничение частоты запросов (GCRA)
+На ключ хранится одно число — теоретическое время следующего запроса (TAT); неактивные ключи вытесняются.
+Состояние локально для процесса или общее для всех воркеров хоста (mmap-таблица под flock)
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # не POSIX: только локальное состояние
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Слот общей таблицы: хэш ключа (0 — свободен), TAT
+_SLOT = struct.Struct("Qd")
+# Длина цепочки линейного пробирования
+_PROBES = 8
+
+
+class RateRule:
+    """Лимит limit запросов за window секунд (допускается всплеск до limit)"""
+    def __init__(self, limit: int, window: float):
+        self.limit = max(1, limit)
+        self.window = window
+        self.interval = window / self.limit
+        self.burst = window - self.interval
+
+    def scaled(self, factor: float) -> "RateRule":
+        return RateRule(max(1, int(self.limit * factor)), self.window)
+
+
+def _gcra(tat: float, now: float, rule: RateRule) -> Tuple[bool, float, float]:
+    """Решение GCRA: (разрешено, новый TAT, через сколько секунд повторить)"""
+    tat = max(tat, now)
+    allow_at = tat - rule.burst
+    if now < allow_at:
+        return False, tat, allow_at - now
+    return True, tat + rule.interval, 0.0
+
+
+class LocalRateState:
+    """TAT ключей в памяти процесса; ключи с TAT в прошлом эквивалентны новым и удаляются"""
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._tat: "OrderedDict[str, float]" = OrderedDict()
+
+    def check(self, key: str, rule: RateRule, now: float) -> Tuple[bool, float]:
+        allowed, tat, retry_after = _gcra(self._tat.get(key, 0.0), now, rule)
+        if allowed:
+            self._tat[key] = tat
+            self._tat.move_to_end(key)
+        # Начало — давно не обновлявшиеся ключи: снимаем истекшие и сверх лимита
+        while self._tat:
+            oldest_key, oldest_tat = next(iter(self._tat.items()))
+            if oldest_tat > now and len(self._tat) <= self.max_keys:
+                break
+            del self._tat[oldest_key]
+        return allowed, retry_after
+
+    def __len__(self):
+        return len(self._tat)
+
+
+class SharedRateState:
+    """Общая для процессов хоста таблица TAT фиксированного размера в mmap-файле.
+
+    Открытая адресация с коротким пробированием: при коллизии занимается слот с истекшим
+    TAT, иначе самый ранний в цепочке (вытеснение ключа лишь смягчает его лимит).
+    """
+
+    def __init__(self, path: str, slots: int):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._fd: Optional[int] = None
+        self._map: Optional[mmap.mmap] = None
+
+    def _open(self) -> mmap.mmap:
+        if self._map is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            size = _SLOT.size * self.slots
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+        return self._map
+
+    def check(self, key: str, rule: RateRule, now: float) -> Tuple[bool, float]:
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big") or 1
+        with self._lock:
+            table = self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                start = digest % self.slots
+                free, oldest, oldest_tat = None, None, 0.0
+                for probe in range(_PROBES):
+                    index = (start + probe) % self.slots
+                    slot_hash, slot_tat = _SLOT.unpack_from(table, index * _SLOT.size)
+                    if slot_hash == digest:
+                        target, target_tat = index, slot_tat
+                        break
+                    if slot_hash == 0 or slot_tat <= now:
+                        if free is None:
+                            free = index
+                    elif oldest is None or slot_tat < oldest_tat:
+                        oldest, oldest_tat = index, slot_tat
+                else:
+                    # Ключа нет в цепочке — он начинает с нуля в свободном или самом раннем слоте
+                    target, target_tat = (free if free is not None else oldest), 0.0
+                allowed, tat, retry_after = _gcra(target_tat, now, rule)
+                if allowed:
+                    _SLOT.pack_into(table, target * _SLOT.size, digest, tat)
+                return allowed, retry_after
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                os.close(self._fd)
+                self._map = None
+                self._fd = None
+
+
+def _parse_rule(spec: str) -> RateRule:
+    limit, _, window = spec.partition("/")
+    return RateRule(int(limit), float(window or 60))
+
+
+class RateLimiter:
+    """Лимиты по маршрутам и уровням клиентов.
+
+    Ключ — пользователь (если токен уже проверен) или IP, плюс маршрут. Правило маршрута —
+    по самому длинному совпавшему префиксу пути, затем масштабируется множителем уровня
+    (anonymous — запрос без известного пользователя, иначе роль пользователя).
+
+    ENV:
+      RATE_LIMIT_MAX, RATE_LIMIT_WINDOW_SEC — правило по умолчанию (60 за 60 сек)
+      RATE_LIMIT_ROUTES       — правила маршрутов: "/analyze-batch=10/60,/analyze=60/60"
+                                (префикс совпадает с путем или его начальными сегментами)
+      RATE_LIMIT_TIERS        — множители уровней: "anonymous=1,user=1,admin=10"
+      RATE_LIMIT_SHARED       — общее состояние для воркеров хоста (false)
+      RATE_LIMIT_STATE_PATH   — файл общего состояния (.cache/rate_limit.bin)
+      RATE_LIMIT_SHARED_SLOTS — слотов в общей таблице (65536)
+      RATE_LIMIT_MAX_KEYS     — лимит ключей локального состояния (100000)
+    """
+
+    def __init__(self):
+        self.default_rule = RateRule(
+            int(os.getenv("RATE_LIMIT_MAX", "60")), float(os.getenv("RATE_LIMIT_WINDOW_SEC", "60"))
+        )
+        self.routes: List[Tuple[str, RateRule]] = []
+        for item in os.getenv("RATE_LIMIT_ROUTES", "").split(","):
+            prefix, _, spec = item.strip().partition("=")
+            if prefix and spec:
+                self.routes.append((prefix.rstrip("/") or "/", _parse_rule(spec)))
+        self.routes.sort(key=lambda route: len(route[0]), reverse=True)
+        self.tiers: Dict[str, float] = {"anonymous": 1.0}
+        for item in os.getenv("RATE_LIMIT_TIERS", "").split(","):
+            tier, _, factor = item.strip().partition("=")
+            if tier and factor:
+                self.tiers[tier] = float(factor)
+        self.stats = {"allowed": 0, "limited": 0}
+
+        shared = os.getenv("RATE_LIMIT_SHARED", "false").lower() == "true"
+        if shared and fcntl is None:
+            logger.warning("RATE_LIMIT_SHARED requires POSIX file locks, using per-process state")
+            shared = False
+        if shared:
+            self.state = SharedRateState(
+                os.getenv("RATE_LIMIT_STATE_PATH", os.path.join(".cache", "rate_limit.bin")),
+                int(os.getenv("RATE_LIMIT_SHARED_SLOTS", "65536")),
+            )
+        else:
+            self.state = LocalRateState(int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000")))
+
+    def rule_for(self, path: str, tier: str) -> Tuple[str, RateRule]:
+        """(префикс маршрута для ключа, правило с учетом уровня)"""
+        route, rule = path, self.default_rule
+        for prefix, prefix_rule in self.routes:
+            # По границе сегмента: /analyze не захватывает /analyze-batch
+            if path == prefix or path.startswith(prefix.rstrip("/") + "/"):
+                route, rule = prefix, prefix_rule
+                break
+        factor = self.tiers.get(tier, 1.0)
+        return route, (rule if factor == 1.0 else rule.scaled(factor))
+
+    def check(self, path: str, client: str, tier: str = "anonymous") -> Tuple[bool, float]:
+        """(разрешено, Retry-After в секундах)"""
+        route, rule = self.rule_for(path, tier)
+        allowed, retry_after = self.state.check(f"{client}:{route}", rule, time.time())
+        self.stats["allowed" if allowed else "limited"] += 1
+        return allowed, retry_after
+
+    def close(self):
+        if isinstance(self.state, SharedRateState):
+            self.state.close()
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,157 @@
+"""
+Повторное использование результатов анализа по (domain, profile_type)
+Свежий завершенный анализ возвращается без запуска pipeline: LRU процесса, затем индексированный
+запрос к analyses; одновременные анализы одного домена объединяются
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from persistence import Store
+
+logger = logging.getLogger(__name__)
+
+# Поля analyses, достаточные для ответа без повторного анализа
+REUSE_COLUMNS = (
+    "id, domain, url, profile_type, result_classification, result_confidence, result_comment, "
+    "processing_time_seconds, raw_data, created_at"
+)
+
+
+def _timestamp(value: Any) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def analyzed_at(row: Dict[str, Any]) -> Optional[float]:
+    """Время исходного анализа: у копии переиспользованного результата — время оригинала"""
+    reused = (row.get("raw_data") or {}).get("reused") or {}
+    return reused.get("analyzed_at") or _timestamp(row.get("created_at"))
+
+
+def normalize_domain(domain: str) -> str:
+    """Домен в виде, в котором он хранится в analyses и ищется при переиспользовании"""
+    return domain.strip().lower()
+
+
+def reusable(row: Dict[str, Any]) -> bool:
+    """Переиспользуется только результат полного pipeline: не ошибка (error) и не упрощенный
+    fallback-анализ, который выполняется как раз при сбоях Gemini"""
+    raw_data = row.get("raw_data") or {}
+    return "error" not in raw_data and "fallback" not in raw_data
+
+
+class ResultReuseCache:
+    """Поиск свежего результата для (domain, profile_type).
+
+    Копии переиспользованных результатов (raw_data.reused) хранят время исходного анализа,
+    поэтому окно свежести не продлевается повторным использованием.
+
+    ENV:
+      RESULT_REUSE_ENABLED       — включить переиспользование (true)
+      RESULT_REUSE_MAX_AGE       — окно свежести по умолчанию, сек (86400); 0 — не переиспользовать
+      RESULT_REUSE_MEMORY_ITEMS  — размер LRU в памяти (1024)
+    """
+
+    def __init__(self, store_getter: Callable[[], Optional[Store]], max_age: Optional[float] = None,
+                 memory_items: Optional[int] = None):
+        self.store_getter = store_getter
+        self.enabled = os.getenv("RESULT_REUSE_ENABLED", "true").lower() == "true"
+        self.max_age = max_age if max_age is not None else float(os.getenv("RESULT_REUSE_MAX_AGE", "86400"))
+        self.memory_items = memory_items or int(os.getenv("RESULT_REUSE_MEMORY_ITEMS", "1024"))
+        self.stats = {"memory_hits": 0, "store_hits": 0, "misses": 0, "coalesced": 0}
+        self._memory: "OrderedDict[Tuple[str, str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    @staticmethod
+    def _key(domain: str, profile_type: str) -> Tuple[str, str]:
+        return normalize_domain(domain), profile_type
+
+    def remember(self, domain: str, profile_type: str, row: Dict[str, Any]):
+        """Результат, только что сохраненный в analyses (row в формате REUSE_COLUMNS)"""
+        if not reusable(row):
+            return
+        key = self._key(domain, profile_type)
+        self._memory[key] = (analyzed_at(row) or time.time(), row)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    async def lookup(self, domain: str, profile_type: str, max_age: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Строка analyses не старше max_age (по умолчанию RESULT_REUSE_MAX_AGE) или None"""
+        max_age = self.max_age if max_age is None else max_age
+        if not self.enabled or max_age <= 0:
+            return None
+        key = self._key(domain, profile_type)
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry and now - entry[0] <= max_age:
+            self._memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return entry[1]
+
+        store = self.store_getter()
+        if store is None:
+            return None
+        cutoff = datetime.fromtimestamp(now - max_age, tz=timezone.utc).isoformat()
+        try:
+            # Индекс idx_analyses_reuse (domain, profile_type, created_at DESC) WHERE status = 'completed'
+            rows = await store.select(
+                "analyses", REUSE_COLUMNS,
+                {"domain": key[0], "profile_type": profile_type, "status": "completed", "created_at>=": cutoff},
+                limit=5, order="created_at.desc",
+            )
+        except Exception as e:
+            logger.warning(f"Result reuse lookup failed for {domain}: {e}")
+            return None
+        for row in rows:
+            origin = analyzed_at(row)
+            if origin is not None and now - origin <= max_age and reusable(row):
+                self.stats["store_hits"] += 1
+                self._memory[key] = (origin, row)
+                self._memory.move_to_end(key)
+                return row
+        self.stats["misses"] += 1
+        return None
+
+    async def run_once(self, domain: str, profile_type: str, runner: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Выполнение runner с объединением одновременных вызовов для одного ключа: (результат, объединен ли).
+
+        Если ведущий вызов упал или отменен, ожидающие выполняют runner сами.
+        """
+        key = self._key(domain, profile_type)
+        while key in self._inflight:
+            future = self._inflight[key]
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+            else:
+                self.stats["coalesced"] += 1
+                return result, True
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await runner()
+            future.set_result(result)
+            return result, False
+        finally:
+            if not future.done():
+                future.cancel()
+            del self._inflight[key]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "max_age": self.max_age, "memory_items": len(self._memory), **self.stats}
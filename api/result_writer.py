@@ -0,0 +1,307 @@
+"""
+Буферизованная запись результатов батча в хранилище
+Результаты копятся и сбрасываются пачками (по размеру или по времени): bulk insert в analyses,
+upsert в session_domains и обновление счетчиков прогресса сессий
+"""
+
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from persistence import Store
+
+logger = logging.getLogger(__name__)
+
+# Сколько id записанных, но не отмеченных в session_domains строк analyses помнить для повторов задач
+ORPHANS_LIMIT = 10000
+
+
+class SessionDomainWriteError(RuntimeError):
+    """Строка analyses записана, но статус session_domains записать не удалось"""
+    def __init__(self, message: str, analysis_id: Optional[str]):
+        super().__init__(message)
+        self.analysis_id = analysis_id
+
+
+class _PendingWrite:
+    """Результат одной задачи, ожидающий сброса"""
+    def __init__(self, analysis: Optional[Dict[str, Any]], session_id: Optional[str],
+                 session_domain: Optional[Dict[str, Any]], status: str, future: asyncio.Future):
+        self.analysis = analysis
+        self.session_id = session_id
+        self.session_domain = session_domain
+        self.status = status
+        self.future = future
+        self.analysis_id: Optional[str] = None
+        self.error: Optional[Exception] = None
+        # Сбросы, в которых не удалось записать session_domains
+        self.domain_attempts = 0
+
+
+class BatchResultWriter:
+    """Write-behind буфер для результатов батч-анализа.
+
+    write() возвращается после того, как записаны и строка analyses, и статус session_domains,
+    поэтому задача очереди подтверждается только после сохранения. Неудачная вставка пачки
+    повторяется с экспоненциальной паузой, затем строки вставляются по одной: ошибку получают
+    только сами некорректные строки. Ошибка session_domains переносит запись в следующие сбросы;
+    после BATCH_WRITE_MAX_RETRIES сбросов write() выбрасывает SessionDomainWriteError и задача
+    возвращается в очередь. id уже записанной строки analyses запоминается по session_domain.id,
+    поэтому повтор задачи не вставляет дубль.
+
+    ENV:
+      BATCH_WRITE_MAX_ROWS        — размер пачки (50)
+      BATCH_WRITE_FLUSH_INTERVAL  — максимальная задержка сброса, сек (2.0)
+      BATCH_WRITE_MAX_RETRIES     — повторов записи до отказа (3)
+      BATCH_WRITE_CLOSE_TIMEOUT   — ожидание текущего сброса при остановке, сек (30)
+    """
+
+    def __init__(self, store_getter: Callable[[], Optional[Store]], max_rows: Optional[int] = None,
+                 flush_interval: Optional[float] = None, max_retries: Optional[int] = None,
+                 close_timeout: Optional[float] = None):
+        self.store_getter = store_getter
+        self.max_rows = max_rows or int(os.getenv("BATCH_WRITE_MAX_ROWS", "50"))
+        self.flush_interval = flush_interval if flush_interval is not None else float(os.getenv("BATCH_WRITE_FLUSH_INTERVAL", "2.0"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("BATCH_WRITE_MAX_RETRIES", "3"))
+        self.close_timeout = close_timeout if close_timeout is not None else float(os.getenv("BATCH_WRITE_CLOSE_TIMEOUT", "30"))
+        self.stats = {"flushes": 0, "rows": 0, "retries": 0, "failed_rows": 0, "row_fallbacks": 0,
+                      "session_domain_failures": 0, "session_domain_dropped": 0}
+        self._buffer: List[_PendingWrite] = []
+        self._flushing: List[_PendingWrite] = []
+        # Записанные строки с неудавшимся session_domains — повторяются в следующем сбросе
+        self._deferred: List[_PendingWrite] = []
+        # session_domain.id -> id строки analyses, статус которой не удалось записать
+        self._orphans: "OrderedDict[str, str]" = OrderedDict()
+        self._closing = False
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # --- постановка ---
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._closing = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def write(self, analysis: Optional[Dict[str, Any]], session_id: Optional[str] = None,
+                    session_domain: Optional[Dict[str, Any]] = None, status: str = "completed") -> Optional[str]:
+        """Запись результата: строка analyses (или None для отказа) и статус домена сессии.
+
+        session_domain — {"id", "domain", "url"} строки session_domains. Возвращает id строки analyses.
+        """
+        self._ensure_running()
+        future = asyncio.get_running_loop().create_future()
+        item = _PendingWrite(analysis, session_id, session_domain, status, future)
+        if analysis is not None and session_domain and session_domain.get("id"):
+            # Повтор задачи после SessionDomainWriteError: analyses уже записана
+            item.analysis_id = self._orphans.pop(session_domain["id"], None)
+        self._buffer.append(item)
+        if len(self._buffer) >= self.max_rows:
+            self._wakeup.set()
+        return await future
+
+    # --- сброс ---
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        self._buffer, self._deferred = self._deferred + self._buffer, []
+        while self._buffer:
+            batch, self._buffer = self._buffer[:self.max_rows], self._buffer[self.max_rows:]
+            self._flushing = batch
+            try:
+                await self._flush_batch(batch)
+            finally:
+                self._flushing = []
+
+    async def _with_retries(self, what: str, action: Callable[[], Awaitable[Any]]) -> Any:
+        delay = 0.5
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await action()
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    raise
+                self.stats["retries"] += 1
+                logger.warning(f"{what} failed (attempt {attempt + 1}), retrying: {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def _flush_batch(self, batch: List[_PendingWrite]):
+        store = self.store_getter()
+        if store is not None:
+            await self._write_analyses(store, [item for item in batch if item.analysis is not None and item.analysis_id is None])
+        written = [item for item in batch if item.error is None]
+        for item in batch:
+            if item.error is not None:
+                self.stats["failed_rows"] += 1
+                if not item.future.done():
+                    item.future.set_exception(item.error)
+        deferred: List[_PendingWrite] = []
+        if store is not None and written:
+            deferred = await self._write_session_domains(store, written)
+        self.stats["flushes"] += 1
+        for item in written:
+            if item in deferred:
+                continue
+            self.stats["rows"] += 1
+            if not item.future.done():
+                item.future.set_result(item.analysis_id)
+
+    async def _write_analyses(self, store: Store, pending: List[_PendingWrite]):
+        """1. analyses: одна вставка на пачку; после исчерпания повторов — по одной строке"""
+        if not pending:
+            return
+
+        async def insert(items: List[_PendingWrite]):
+            inserted = await store.insert("analyses", [item.analysis for item in items])
+            for item, row in zip(items, inserted):
+                item.analysis_id = row.get("id")
+
+        try:
+            await self._with_retries("Batch analyses insert", lambda: insert(pending))
+            return
+        except Exception as e:
+            if len(pending) == 1:
+                logger.error(f"Analyses insert failed after {self.max_retries + 1} attempts: {e}")
+                pending[0].error = e
+                return
+            logger.warning(f"Batch analyses insert failed, inserting {len(pending)} rows one by one: {e}")
+        self.stats["row_fallbacks"] += 1
+        for item in pending:
+            try:
+                await insert([item])
+            except Exception as e:
+                logger.error(f"Analyses row for {item.analysis.get('domain')} rejected: {e}")
+                item.error = e
+
+    async def _write_session_domains(self, store: Store, batch: List[_PendingWrite]) -> List[_PendingWrite]:
+        """2. session_domains и 3. счетчики прогресса.
+
+        Неудача переносит строки в следующий сброс (их future не разрешаются); возвращает перенесенные.
+        """
+        retry: List[_PendingWrite] = []
+        try:
+            await self._with_retries("Session domains write", lambda: self._upsert_session_domains(store, batch))
+        except Exception as e:
+            failed = [item for item in batch if item.session_id and item.session_domain]
+            self.stats["session_domain_failures"] += len(failed)
+            for item in failed:
+                item.domain_attempts += 1
+                if item.domain_attempts <= self.max_retries:
+                    # Строки analyses уже записаны (analysis_id сохранен) и повторно не вставляются
+                    retry.append(item)
+                else:
+                    self._drop(item, e)
+            logger.error(f"Session domains write failed for {len(failed)} results ({len(retry)} deferred to next flush): {e}")
+            self._deferred.extend(retry)
+
+        sessions: Set[str] = {item.session_id for item in batch if item.session_id}
+        for session_id in sessions:
+            try:
+                await update_session_progress(store, session_id)
+            except Exception as e:
+                logger.warning(f"Session progress update failed for {session_id}: {e}")
+        return retry
+
+    def _drop(self, item: _PendingWrite, error: Exception):
+        """Отказ после всех повторов: задача возвращается в очередь, id analyses — для ее повтора"""
+        self.stats["session_domain_dropped"] += 1
+        domain_id = item.session_domain.get("id")
+        if item.analysis_id and domain_id:
+            self._orphans[domain_id] = item.analysis_id
+            self._orphans.move_to_end(domain_id)
+            while len(self._orphans) > ORPHANS_LIMIT:
+                self._orphans.popitem(last=False)
+        if not item.future.done():
+            item.future.set_exception(SessionDomainWriteError(
+                f"Session domain status for {item.session_domain.get('domain')} was not written: {error}",
+                item.analysis_id,
+            ))
+
+    async def _upsert_session_domains(self, store: Store, batch: List[_PendingWrite]):
+        """upsert по id, без id — обновление по (session_id, domain)"""
+        upserts = []
+        for item in batch:
+            if not item.session_id or not item.session_domain:
+                continue
+            row = {"status": item.status}
+            if item.analysis_id:
+                row["analysis_id"] = item.analysis_id
+            if item.session_domain.get("id"):
+                upserts.append({
+                    "id": item.session_domain["id"],
+                    "session_id": item.session_id,
+                    "domain": item.session_domain["domain"],
+                    "url": item.session_domain["url"],
+                    **row,
+                })
+            else:
+                await store.update(
+                    "session_domains", row,
+                    {"session_id": item.session_id, "domain": item.session_domain["domain"]},
+                )
+        if upserts:
+            await store.upsert("session_domains", upserts, on_conflict="id")
+
+    async def close(self):
+        """Остановка фонового сброса: текущий сброс завершается (не дольше BATCH_WRITE_CLOSE_TIMEOUT),
+        затем записывается остаток буфера"""
+        if self._task is not None:
+            self._closing = True
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), timeout=self.close_timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"Batch result flush did not finish in {self.close_timeout:g}s, cancelling")
+                self._task.cancel()
+                await asyncio.gather(self._task, return_exceptions=True)
+                error = RuntimeError("Result writer closed before the batch was written")
+                for item in self._flushing:
+                    if not item.future.done():
+                        item.future.set_exception(error)
+                self._flushing = []
+            except Exception as e:
+                logger.warning(f"Batch result writer stopped with error: {e}")
+            self._task = None
+        await self.flush()
+        # Записи, не дошедшие до session_domains и при последнем сбросе, возвращают задачи в очередь
+        deferred, self._deferred = self._deferred, []
+        for item in deferred:
+            self._drop(item, RuntimeError("result writer closed"))
+
+
+async def session_counts(store: Store, session_id: str) -> Dict[str, int]:
+    """Число завершенных и неудачных доменов сессии (count без выборки строк)"""
+    counts = {}
+    for status in ("completed", "failed"):
+        counts[status] = await store.count("session_domains", {"session_id": session_id, "status": status})
+    return counts
+
+
+async def update_session_progress(store: Store, session_id: str, final: bool = False) -> Dict[str, int]:
+    counts = await session_counts(store, session_id)
+    update = {
+        "processed_domains": counts["completed"] + counts["failed"],
+        "successful_analyses": counts["completed"],
+        "failed_analyses": counts["failed"],
+    }
+    if final:
+        update["status"] = "completed"
+        update["completed_at"] = datetime.now().isoformat()
+    await store.update("analysis_sessions", update, {"id": session_id})
+    return counts
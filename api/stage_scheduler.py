@@ -0,0 +1,111 @@
+"""
+Планировщик этапов pipeline в виде графа зависимостей
+Этапы, у которых готовы все входы, выполняются конкурентно
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+# Этап получает словарь {имя зависимости: ее результат}
+StageFunc = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class StageNode:
+    """Узел графа: этап и его зависимости"""
+    def __init__(self, name: str, func: StageFunc, deps: Iterable[str] = ()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+
+
+class StageScheduler:
+    """Выполнение DAG этапов с записью времени начала/окончания каждого этапа.
+
+    Узлы добавляются в топологическом порядке: зависимость должна быть добавлена раньше,
+    поэтому циклы невозможны по построению. Пропущенный через skip() этап не выполняется
+    (или отменяется), его результат — None, зависимые этапы продолжают работу.
+    on_complete(имя, результат) вызывается сразу по завершении каждого выполненного этапа.
+    """
+
+    def __init__(self):
+        self.nodes: Dict[str, StageNode] = {}
+        self.outputs: Dict[str, Any] = {}
+        self.timings: Dict[str, Dict[str, float]] = {}
+        self.skipped: Dict[str, str] = {}
+        self.origin = time.time()
+        self.on_complete: Optional[Callable[[str, Any], None]] = None
+        self._running: Dict[asyncio.Task, str] = {}
+
+    def add(self, name: str, func: StageFunc, deps: Iterable[str] = ()) -> "StageScheduler":
+        deps = tuple(deps)
+        if name in self.nodes or name in self.outputs:
+            raise ValueError(f"Stage already registered: {name}")
+        for dep in deps:
+            if dep not in self.nodes and dep not in self.outputs:
+                raise ValueError(f"Unknown dependency '{dep}' for stage '{name}'")
+        self.nodes[name] = StageNode(name, func, deps)
+        return self
+
+    async def timed(self, name: str, awaitable: Awaitable[Any]) -> Any:
+        """Выполнение этапа вне графа с записью таймингов"""
+        started = time.time()
+        try:
+            return await awaitable
+        finally:
+            finished = time.time()
+            self.timings[name] = {
+                "start": round(started - self.origin, 3),
+                "end": round(finished - self.origin, 3),
+                "duration": round(finished - started, 3),
+            }
+
+    def skip(self, names: Iterable[str], reason: str):
+        """Пропуск этапов: еще не запущенные не стартуют, запущенные отменяются"""
+        for name in names:
+            if name in self.outputs or name in self.skipped:
+                continue
+            self.skipped[name] = reason
+        for task, name in self._running.items():
+            if name in self.skipped:
+                task.cancel()
+
+    async def _run_node(self, node: StageNode) -> Any:
+        inputs = {dep: self.outputs[dep] for dep in node.deps}
+        return await self.timed(node.name, node.func(inputs))
+
+    async def run(self) -> Dict[str, Any]:
+        """Запуск всех добавленных узлов; исключение в этапе отменяет остальные"""
+        pending = dict(self.nodes)
+        running = self._running
+        try:
+            while pending or running:
+                for name, node in list(pending.items()):
+                    if name in self.skipped:
+                        del pending[name]
+                        self.outputs[name] = None
+                    elif all(dep in self.outputs for dep in node.deps):
+                        del pending[name]
+                        running[asyncio.create_task(self._run_node(node))] = name
+                if not running:
+                    if pending:
+                        raise RuntimeError(f"Unsatisfiable stages: {', '.join(pending)}")
+                    break
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    if name in self.skipped:
+                        self.outputs[name] = None
+                        continue
+                    self.outputs[name] = task.result()
+                    if self.on_complete:
+                        self.on_complete(name, self.outputs[name])
+        finally:
+            for task in running:
+                task.cancel()
+            # Дожидаемся отмены: слоты LLM и резервы квоты освобождаются до выхода из run()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+            running.clear()
+        self.nodes.clear()
+        return self.outputs
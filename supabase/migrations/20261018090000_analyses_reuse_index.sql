@@ -0,0 +1,4 @@
+-- Поиск свежего завершенного анализа для (domain, profile_type) при переиспользовании результатов
+CREATE INDEX IF NOT EXISTS idx_analyses_reuse
+    ON public.analyses(domain, profile_type, created_at DESC)
+    WHERE status = 'completed';
@@ -0,0 +1,3 @@
+-- Параметры анализа домена батча (profile_type, mode, max_age, force, bypass_llm_cache)
+-- для повторной постановки в очередь после рестарта
+ALTER TABLE public.session_domains ADD COLUMN IF NOT EXISTS job_options JSONB;
@@ -0,0 +1,4 @@
+-- Домен в analyses хранится в нижнем регистре: переиспользование результатов ищет по точному совпадению
+UPDATE public.analyses
+    SET domain = lower(btrim(domain))
+    WHERE domain <> lower(btrim(domain));
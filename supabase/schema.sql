@@ -87,6 +87,7 @@ CREATE TABLE public.session_domains (
     url TEXT NOT NULL,
     analysis_id UUID REFERENCES public.analyses(id) ON DELETE SET NULL,
     status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'processing', 'completed', 'failed')),
+    job_options JSONB,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
@@ -106,6 +107,7 @@ CREATE INDEX idx_analyses_user_id ON public.analyses(user_id);
 CREATE INDEX idx_analyses_domain ON public.analyses(domain);
 CREATE INDEX idx_analyses_status ON public.analyses(status);
 CREATE INDEX idx_analyses_created_at ON public.analyses(created_at);
+CREATE INDEX idx_analyses_reuse ON public.analyses(domain, profile_type, created_at DESC) WHERE status = 'completed';
 CREATE INDEX idx_credit_transactions_user_id ON public.credit_transactions(user_id);
 CREATE INDEX idx_credit_transactions_created_at ON public.credit_transactions(created_at);
 CREATE INDEX idx_analysis_sessions_user_id ON public.analysis_sessions(user_id);